@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+Benchmark the codecs of task and result files (see pysge.serialization) on a
+few payloads, timing the writing and reading of a result file with each
+codec, its size on disk and the ratio of the size to the pickled payload:
+
+- numeric: a large float array (needs numpy) - barely compressible
+- records: a list of dicts of ints and short strings - compressible
+- bytes: random bytes - incompressible
+
+    python benchmarks/bench_codecs.py --size 10000000 --codecs dill+gzip pickle+none
+"""
+import os
+import sys
+import time
+import pickle
+import shutil
+import argparse
+import tempfile
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pysge.completion import write_result, RESULT_FILE
+from pysge.results import load_result
+from pysge.serialization import Codec
+
+DEFAULT_CODECS = [
+    "dill+gzip", "dill+none", "pickle+none", "pickle+gzip:1", "pickle+gzip",
+    "pickle+lz4", "pickle+zstd:1", "pickle+zstd:3",
+]
+
+def make_payloads(size):
+    payloads = {}
+    try:
+        import numpy as np
+        payloads["numeric"] = np.random.normal(size=size // 8)
+    except ImportError:
+        pass
+    payloads["records"] = [
+        {"event": idx, "run": idx // 1000, "label": "jet{}".format(idx % 7)}
+        for idx in range(size // 64)
+    ]
+    payloads["bytes"] = os.urandom(size)
+    return payloads
+
+class Timer(object):
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.elapsed = time.time() - self.start
+
+def bench_codec(tmpdir, payload, codec):
+    with Timer() as t_dump:
+        write_result(payload, tmpdir, codec=codec)
+    path = os.path.join(tmpdir, RESULT_FILE)
+    size = os.path.getsize(path)
+    with Timer() as t_load:
+        load_result(path)
+    return t_dump.elapsed, t_load.elapsed, size
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=10000000,
+                        help="Approximate size of each payload in bytes")
+    parser.add_argument("--codecs", nargs="+", default=DEFAULT_CODECS)
+    options = parser.parse_args()
+
+    logging.getLogger("pysge").setLevel(logging.WARNING)
+    payloads = make_payloads(options.size)
+    print("{:>8} {:>14} {:>8} {:>8} {:>10} {:>7}".format(
+        "payload", "codec", "dump", "load", "size", "ratio",
+    ))
+    for name, payload in payloads.items():
+        raw_size = len(pickle.dumps(payload, protocol=5))
+        for codec_name in options.codecs:
+            try:
+                codec = Codec(codec_name)
+            except ImportError as e:
+                print("{:>8} {:>14} skipped: {}".format(name, codec_name, e))
+                continue
+            tmpdir = tempfile.mkdtemp(prefix="pysge_bench_codecs_")
+            try:
+                t_dump, t_load, size = bench_codec(tmpdir, payload, codec)
+            finally:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+            print("{:>8} {:>14} {:>8.3f} {:>8.3f} {:>10d} {:>7.2f}".format(
+                name, codec_name, t_dump, t_load, size, float(size)/raw_size,
+            ))
+            sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
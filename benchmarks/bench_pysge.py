@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""
+Benchmark the hot paths of pysge against the local fake SGE scheduler
+(pysge.fakesge) as the number of tasks and the payload size grow:
+
+- area: dilling and writing the tasks to the working area
+- submit: submitting the tasks as array jobs with qsub
+- poll: one poll of the monitor (qstat and parsing) with all tasks queued
+- resubmit: finding and resubmitting failed tasks
+- collect: detecting finished tasks and loading their results
+- e2e: sge_submit of no-op tasks run through the fake scheduler
+
+    python benchmarks/bench_pysge.py --ntasks 100 1000 10000 --payload 0 100000
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pysge
+from pysge.area import WorkingArea
+from pysge.submitter import SGETaskSubmitter
+from pysge.monitor import JobMonitor
+from pysge.completion import write_result
+from pysge.results import load_result
+from pysge.fakesge import FakeSGE
+
+def payload_task(x, payload):
+    return x
+
+def make_tasks(ntasks, payload_size):
+    payload = os.urandom(payload_size)
+    return [
+        {"task": payload_task, "args": (idx, payload), "kwargs": {}}
+        for idx in range(ntasks)
+    ]
+
+class Timer(object):
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.elapsed = time.time() - self.start
+
+def bench_area(tmpdir, tasks, **kwargs):
+    area = WorkingArea(tmpdir)
+    with Timer() as t:
+        area.create_areas(tasks, quiet=True, **kwargs)
+    return t.elapsed, area
+
+def bench_submit(area):
+    submitter = SGETaskSubmitter("-N bench -q fake.q")
+    with Timer() as t:
+        submitter.submit_tasks(area.task_paths, quiet=True)
+    return t.elapsed, submitter
+
+def bench_poll(submitter, query):
+    monitor = JobMonitor(submitter, query=query)
+    with Timer() as t:
+        next(monitor.return_finished_jobs(request_user_input=False))
+    return t.elapsed
+
+def bench_resubmit(area):
+    submitter = SGETaskSubmitter("-N bench -q fake.q")
+    # ids that qstat doesn't know about and no results, i.e. all failed
+    for idx, task in enumerate(area.task_paths):
+        submitter.jobid_tasks["0.{}".format(idx+1)] = [task]
+    monitor = JobMonitor(submitter)
+    results = [None]*len(area.task_paths)
+    with Timer() as t:
+        monitor.check_jobs(dict(submitter.jobid_tasks), results, request_user_input=False)
+    return t.elapsed
+
+def bench_collect(area):
+    for task in area.task_paths:
+        write_result(task, task)
+    submitter = SGETaskSubmitter("-N bench -q fake.q")
+    for idx, task in enumerate(area.task_paths):
+        submitter.jobid_tasks["0.{}".format(idx+1)] = [task]
+    monitor = JobMonitor(submitter)
+    results = [None]*len(area.task_paths)
+    with Timer() as t_check:
+        monitor.check_jobs(dict(submitter.jobid_tasks), results, request_user_input=False)
+    with Timer() as t_load:
+        for path in results:
+            load_result(path)
+    return t_check.elapsed, t_load.elapsed
+
+def bench_e2e(tmpdir, tasks):
+    with Timer() as t:
+        pysge.sge_submit(
+            tasks, "bench", tmpdir, options="-q fake.q", quiet=True,
+            sleep=0.5, request_resubmission_options=False,
+        )
+    return t.elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ntasks", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--payload", type=int, nargs="+", default=[0, 100000],
+                        help="Size of the argument of each task in bytes")
+    parser.add_argument("--area-ncores", type=int, default=1)
+    parser.add_argument("--dedup", action="store_true")
+    parser.add_argument("--e2e-max-tasks", type=int, default=1000,
+                        help="Only run the end-to-end benchmark up to this many tasks")
+    parser.add_argument("--latency", type=float, default=0.,
+                        help="Fake scheduling latency of each task in seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.)
+    options = parser.parse_args()
+
+    logging.getLogger("pysge").setLevel(logging.WARNING)
+    tmpdir = tempfile.mkdtemp(prefix="pysge_bench_")
+    header = "{:>8} {:>9} {:>8} {:>8} {:>9} {:>9} {:>9} {:>9} {:>9} {:>8}".format(
+        "ntasks", "payload", "area", "submit", "poll", "poll_xml",
+        "resubmit", "check", "load", "e2e",
+    )
+    print(header)
+    try:
+        for ntasks in options.ntasks:
+            for payload_size in options.payload:
+                tasks = make_tasks(ntasks, payload_size)
+                row = [ntasks, payload_size]
+
+                # tasks stay queued so the submission and polls see them all
+                with FakeSGE(hold=True):
+                    t_area, area = bench_area(
+                        tmpdir, tasks, ncores=options.area_ncores,
+                        dedup=options.dedup,
+                    )
+                    t_submit, submitter = bench_submit(area)
+                    row += [t_area, t_submit]
+                    row.append(bench_poll(submitter, "plain"))
+                    row.append(bench_poll(submitter, "xml"))
+                    row.append(bench_resubmit(area))
+                row += list(bench_collect(area))
+
+                if ntasks <= options.e2e_max_tasks:
+                    with FakeSGE(latency=options.latency, failure_rate=options.failure_rate):
+                        row.append(bench_e2e(tmpdir, tasks))
+                else:
+                    row.append(float("nan"))
+
+                print("{:>8d} {:>9d} {:>8.3f} {:>8.3f} {:>9.4f} {:>9.4f} {:>9.3f} {:>9.3f} {:>9.3f} {:>8.2f}".format(*row))
+                sys.stdout.flush()
+                shutil.rmtree(area.path, ignore_errors=True)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,14 @@
 from .interface import (
-    local_submit, mp_submit, sge_submit, sge_submit_yield, sge_resume
+    local_submit, mp_submit, mp_as_completed, sge_submit, sge_submit_yield, sge_as_completed,
+    sge_map_reduce, sge_hybrid_submit, sge_resume,
 )
+from .results import LazyResults
+from .submitter import shutdown_pools
+from .retry import RetryPolicy
+from .report import profile_report
+from .executor import SGEExecutor, AsyncSGEExecutor, TaskFailed
+from .cache import ResultCache
+from .dag import ResultOf
 
 import logging
 
@@ -1,19 +1,86 @@
 import os
 import datetime
 import tempfile
-import gzip
 import glob
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from tqdm.auto import tqdm
-import dill
 import logging
+from .blobs import BlobStore
+from . import buffers
+from . import pack
+from .completion import DONE_DIR
+from .serialization import (
+    Codec, DEFAULT_CODEC, write_codec, read_codec, check_importable,
+)
 logger = logging.getLogger(__name__)
 
+# Tasks (and blob store) inherited by forked area workers so only indices
+# cross processes
+_forked_tasks = None
+_forked_blobs = None
+
+def _dump_task(
+    path, task, dill_kw, blobs=None, oob_min_size=None, packed=False, codec=None,
+):
+    # in the packed layout the serialized task is returned to be appended to
+    # a pack by the caller instead
+    codec = codec if codec is not None else Codec()
+    if blobs is not None:
+        task = blobs.deflate(task)
+    if packed:
+        return pack.serialize(task, dill_kw, codec=codec)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    file_path = os.path.join(path, "task.p.gz")
+    with open(file_path, 'wb') as f, codec.writer(f) as stream:
+        if oob_min_size is None:
+            codec.dump(task, stream, dill_kw)
+        else:
+            # the worker writes large arrays in the result out-of-band too
+            task = dict(task, oob_min_size=oob_min_size)
+            buffers.dump(
+                task, stream, file_path, dill_kw=dill_kw,
+                min_size=oob_min_size, serializer=codec.serializer,
+            )
+    return path
+
+def _dump_task_star(args):
+    return _dump_task(*args)
+
+def _dump_forked_task(args):
+    path, idx, dill_kw, oob_min_size, packed, codec = args
+    return _dump_task(
+        path, _forked_tasks[idx], dill_kw, _forked_blobs, oob_min_size, packed,
+        codec,
+    )
+
 class WorkingArea(object):
-    def __init__(self, path, resume=False):
+    """
+    Directory (tpd_*) holding the tasks of a submission and their outputs.
+
+    With layout="dirs" each task gets a task_<position> directory with its
+    dilled task, result and logs. layout="packed" appends the tasks to a few
+    pack files with an index instead, and the workers write the results and
+    logs of each array job element to a pack and log files sharded by
+    position (see pysge.pack), keeping the number of files small for large
+    submissions on network filesystems. task_paths are then virtual paths
+    used to identify the tasks.
+
+    Tasks and results are encoded with codec (see pysge.serialization),
+    recorded in the area for the workers and resumes.
+    """
+    def __init__(self, path, resume=False, layout="dirs", codec=DEFAULT_CODEC):
+        if layout not in ("dirs", "packed"):
+            raise ValueError("Unknown layout '{}'".format(layout))
         self.task_paths = None
+        self.layout = layout
+        self.codec = Codec(codec)
 
         if resume:
             self.path = path
+            self.layout = "packed" if pack.is_packed(path) else "dirs"
+            self.codec = read_codec(path)
             self.get_areas()
         else:
             prefix = 'tpd_{:%Y%m%d_%H%M%S}_'.format(datetime.datetime.now())
@@ -23,22 +90,127 @@ class WorkingArea(object):
             self.path = tempfile.mkdtemp(prefix=prefix, dir=os.path.abspath(path))
             if not os.path.exists(self.path):
                 os.makedirs(self.path)
+            os.makedirs(os.path.join(self.path, DONE_DIR))
+            write_codec(self.path, self.codec)
+            if layout == "packed":
+                self._packer = pack.TaskPackWriter(self.path)
+
+    def create_areas(
+        self, tasks, quiet=False, dill_kw={"recurse": False}, ncores=1,
+        pool="thread", dedup=False, oob_min_size=None,
+    ):
+        for _ in self.create_areas_iter(
+            tasks, quiet=quiet, dill_kw=dill_kw, ncores=ncores, pool=pool,
+            dedup=dedup, oob_min_size=oob_min_size,
+        ):
+            pass
+
+    def create_areas_iter(
+        self, tasks, quiet=False, dill_kw={"recurse": False}, ncores=1,
+        pool="thread", chunksize=None, dedup=False, offset=0,
+        oob_min_size=None,
+    ):
+        """
+        Write the tasks to disk, yielding (start, task_paths) for each chunk of
+        chunksize consecutive tasks as soon as the whole chunk is written. If
+        chunksize is None a single chunk with all tasks is yielded at the end.
+
+        With oob_min_size set, numpy arrays of at least this many bytes are
+        written uncompressed to their own buffer files (pickle protocol 5
+        out-of-band buffers) which the worker memory-maps, and likewise for
+        the arrays in the results.
+
+        With offset > 0 the tasks are appended to an area already holding
+        offset tasks, i.e. they're numbered (and start counts) from offset.
+
+        With ncores > 1 the tasks are serialized in a pool of threads
+        (pool="thread") or forked processes (pool="process").
+
+        With dedup=True callables and arguments are written once to a
+        content-addressed BlobStore and the tasks reference them.
+
+        With the pickle serializer a ValueError is raised before anything is
+        written if a task's callable can't be imported on the nodes.
+        """
+        global _forked_tasks, _forked_blobs
+        packed = self.layout == "packed"
+        if packed and oob_min_size is not None:
+            raise ValueError("oob_min_size isn't supported by the packed layout")
+        if self.codec.serializer == "pickle":
+            checked = set()
+            for task in tasks:
+                if id(task["task"]) not in checked:
+                    check_importable(task["task"])
+                    checked.add(id(task["task"]))
+        blobs = BlobStore(self.path, dill_kw=dill_kw) if dedup else None
+        ntasks = len(tasks)
+        chunksize = ntasks if chunksize is None else max(1, int(chunksize))
+        paths = [
+            os.path.join(self.path, 'task_{:05d}'.format(idx))
+            for idx in range(offset, offset+ntasks)
+        ]
 
-    def create_areas(self, tasks, quiet=False, dill_kw={"recurse": False}):
         task_paths = []
         logger.info('Creating paths in {}'.format(self.path))
-        for idx, task in tqdm(
-            enumerate(tasks), total=len(tasks), disable=quiet, ncols=80,
-        ):
-            package_name = 'task_{:05d}'.format(idx)
-            path = os.path.join(self.path, package_name)
-            if not os.path.exists(path):
-                os.makedirs(path)
-            file_path = os.path.join(os.path.join(path, "task.p.gz"))
-            with gzip.open(file_path, 'wb') as f:
-                dill.dump(task, f, **dill_kw)
-            task_paths.append(path)
-        self.task_paths = task_paths
+        workers = None
+        if ncores <= 1:
+            written = (
+                _dump_task(path, task, dill_kw, blobs, oob_min_size, packed, self.codec)
+                for path, task in zip(paths, tasks)
+            )
+        elif pool == "thread":
+            workers = ThreadPool(ncores)
+            written = workers.imap(
+                _dump_task_star,
+                (
+                    (path, task, dill_kw, blobs, oob_min_size, packed, self.codec)
+                    for path, task in zip(paths, tasks)
+                ),
+            )
+        elif pool == "process":
+            _forked_tasks, _forked_blobs = tasks, blobs
+            workers = multiprocessing.get_context("fork").Pool(ncores)
+            written = workers.imap(
+                _dump_forked_task,
+                (
+                    (path, idx, dill_kw, oob_min_size, packed, self.codec)
+                    for idx, path in enumerate(paths)
+                ),
+                chunksize=max(1, min(chunksize, ntasks // (4*ncores))),
+            )
+        else:
+            raise ValueError("Unknown pool '{}'".format(pool))
+
+        try:
+            start, serialized = 0, []
+            for path, output in zip(paths, tqdm(written, total=ntasks, disable=quiet, ncols=80)):
+                task_paths.append(path)
+                if packed:
+                    serialized.append(output)
+                if len(task_paths) - start == chunksize:
+                    if packed:
+                        self._packer.write(serialized)
+                        serialized = []
+                    yield offset+start, task_paths[start:]
+                    start = len(task_paths)
+            if start < len(task_paths):
+                if packed:
+                    self._packer.write(serialized)
+                yield offset+start, task_paths[start:]
+        finally:
+            if workers is not None:
+                workers.terminate()
+            _forked_tasks, _forked_blobs = None, None
+        self.task_paths = (self.task_paths or [])[:offset] + task_paths
 
     def get_areas(self):
-        self.task_paths = list(glob.glob(os.path.join(self.path, "task_*")))
+        if self.layout == "packed":
+            self.task_paths = [
+                os.path.join(self.path, 'task_{:05d}'.format(idx))
+                for idx in range(pack.ntasks(self.path))
+            ]
+        else:
+            self.task_paths = sorted(
+                glob.glob(os.path.join(self.path, "task_*")),
+                key=pack.task_position,
+            )
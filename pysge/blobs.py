@@ -0,0 +1,157 @@
+import os
+import gzip
+import shutil
+import hashlib
+import tempfile
+import dill
+import logging
+logger = logging.getLogger(__name__)
+
+class BlobRef(object):
+    """Reference to an object stored once in a BlobStore"""
+    def __init__(self, key):
+        self.key = key
+
+    def __repr__(self):
+        return "BlobRef({})".format(self.key)
+
+class BlobStore(object):
+    """
+    Content-addressed store of dilled objects inside a working area. Callables
+    and arguments shared by many tasks are written once, keyed by the hash of
+    their dilled bytes, and the tasks hold BlobRefs to them instead.
+    """
+    def __init__(self, path, dill_kw={"recurse": False}, min_size=1024):
+        self.path = os.path.join(path, "blobs")
+        self.dill_kw = dill_kw
+        self.min_size = min_size
+        self._seen = {}
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def put(self, obj):
+        # Objects are kept alive in _seen so their ids can't be reused
+        seen = self._seen.get(id(obj))
+        if seen is not None:
+            return seen[1]
+
+        data = dill.dumps(obj, **self.dill_kw)
+        if len(data) < self.min_size:
+            ref = obj
+        else:
+            ref = BlobRef(hashlib.sha1(data).hexdigest())
+            blob_path = os.path.join(self.path, ref.key + ".p.gz")
+            if not os.path.exists(blob_path):
+                _atomic_write(blob_path, data)
+        self._seen[id(obj)] = (obj, ref)
+        return ref
+
+    def deflate(self, task):
+        return {
+            "task": self.put(task["task"]),
+            "args": [self.put(arg) for arg in task["args"]],
+            "kwargs": {k: self.put(v) for k, v in task["kwargs"].items()},
+        }
+
+def _atomic_write(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, 'wb') as f:
+        with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+            gz.write(data)
+    os.rename(tmp_path, path)
+
+# default size limit of the node-local blob cache in bytes
+CACHE_MAX_BYTES = 1024**3
+
+def _default_cache_dir():
+    # Not $TMPDIR, since SGE removes that at the end of each job
+    return os.path.join("/tmp", "pysge-blobs-{}".format(os.getuid()))
+
+def evict_cache(cache_dir, max_bytes, keep=None):
+    """
+    Remove the least recently used blobs (by mtime) from cache_dir until
+    the blobs left take at most max_bytes, except for the blob at keep.
+    """
+    blobs = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if not name.endswith(".p.gz") or path == keep:
+            continue
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # evicted by another job
+            continue
+        blobs.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in blobs)
+    if keep is not None:
+        total += os.path.getsize(keep)
+    for _, size, path in sorted(blobs):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+def resolve_blobs(task, area_path, cache_dir=None, max_bytes=None):
+    """
+    Replace BlobRefs in a task with their objects. Blobs are copied from the
+    working area to a node-local cache first, so jobs landing on the same
+    host read each blob from the shared filesystem only once. The cache is
+    $PYSGE_BLOB_CACHE, or /tmp/pysge-blobs-<uid> by default, and outlives
+    the jobs. It's kept to max_bytes ($PYSGE_BLOB_CACHE_SIZE, or
+    CACHE_MAX_BYTES by default) by evicting the least recently used blobs
+    whenever one is added.
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get("PYSGE_BLOB_CACHE", _default_cache_dir())
+    if max_bytes is None:
+        max_bytes = int(os.environ.get("PYSGE_BLOB_CACHE_SIZE", CACHE_MAX_BYTES))
+    loaded = {}
+
+    def get(obj):
+        if not isinstance(obj, BlobRef):
+            return obj
+        if obj.key in loaded:
+            return loaded[obj.key]
+
+        file_name = obj.key + ".p.gz"
+        area_blob = os.path.join(area_path, "blobs", file_name)
+        local_path = os.path.join(cache_dir, file_name)
+        try:
+            # mark it as recently used
+            os.utime(local_path, None)
+        except OSError:
+            try:
+                if not os.path.exists(cache_dir):
+                    os.makedirs(cache_dir)
+                fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+                os.close(fd)
+                try:
+                    shutil.copyfile(area_blob, tmp_path)
+                    os.rename(tmp_path, local_path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                evict_cache(cache_dir, max_bytes, keep=local_path)
+            except (IOError, OSError) as e:
+                logger.warning("Node-local blob cache unavailable: {}".format(e))
+                local_path = area_blob
+
+        try:
+            f = gzip.open(local_path, 'rb')
+        except (IOError, OSError):
+            # evicted by another job in the meantime
+            f = gzip.open(area_blob, 'rb')
+        with f:
+            loaded[obj.key] = dill.load(f)
+        return loaded[obj.key]
+
+    return {
+        "task": get(task["task"]),
+        "args": [get(arg) for arg in task["args"]],
+        "kwargs": {k: get(v) for k, v in task["kwargs"].items()},
+    }
@@ -0,0 +1,125 @@
+import os
+import json
+import mmap
+import shutil
+import pickle
+import dill
+
+# Files dilled with out-of-band buffers (pickle protocol 5) have each
+# buffer in its own uncompressed file <path>.<n>.buf and the buffer file
+# names listed in <path>.buffers.json
+BUFFERS_SUFFIX = ".buffers.json"
+
+def _is_ndarray(obj):
+    cls = type(obj)
+    return cls.__name__ == "ndarray" and cls.__module__ == "numpy"
+
+class _BufferPickler(dill.Pickler):
+    # dill pickles numpy arrays with __reduce__, which copies the data
+    # in-band. Large arrays use __reduce_ex__ instead so their data is
+    # passed to the buffer callback as a PickleBuffer.
+    def __init__(self, file, min_size, **kwargs):
+        super(_BufferPickler, self).__init__(file, **kwargs)
+        self.min_size = min_size
+
+    def save(self, obj, save_persistent_id=True):
+        if _is_ndarray(obj) and obj.nbytes >= self.min_size and id(obj) not in self.memo:
+            self.save_reduce(*obj.__reduce_ex__(self.proto), obj=obj)
+            return
+        super(_BufferPickler, self).save(obj, save_persistent_id)
+
+def buffer_paths(path):
+    """Paths to the buffer files of the dilled file path (empty if none)"""
+    try:
+        with open(path + BUFFERS_SUFFIX, 'r') as f:
+            names = json.load(f)
+    except (IOError, OSError, ValueError):
+        return []
+    return [os.path.join(os.path.dirname(path), name) for name in names]
+
+def _write_listing(path, names):
+    listing = path + BUFFERS_SUFFIX
+    if len(names) == 0:
+        if os.path.exists(listing):
+            os.remove(listing)
+        return
+    tmp_path = "{}.{}.tmp".format(listing, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(names, f)
+    os.rename(tmp_path, listing)
+
+def dump(obj, f, path, dill_kw={}, min_size=1<<20, serializer="dill"):
+    """
+    dill (or pickle if serializer is "pickle") obj to the file object f which
+    will be found at path. The data of numpy arrays (and other objects
+    supporting pickle protocol 5 buffers) of at least min_size bytes is
+    written uncompressed to separate buffer files next to path, so load can
+    memory-map it. The buffer files are complete
+    before this returns, so path should be renamed into place afterwards.
+    Return the total size of the buffer files.
+    """
+    names, sizes = [], []
+
+    def buffer_callback(buf):
+        with buf.raw() as data:
+            if data.nbytes < min_size:
+                return True
+            name = "{}.{}.buf".format(os.path.basename(path), len(names))
+            buf_path = os.path.join(os.path.dirname(path), name)
+            tmp_path = "{}.{}.tmp".format(buf_path, os.getpid())
+            with open(tmp_path, 'wb') as bf:
+                bf.write(data)
+            os.rename(tmp_path, buf_path)
+            sizes.append(data.nbytes)
+        names.append(name)
+        return False
+
+    if serializer == "pickle":
+        pickle.Pickler(f, protocol=5, buffer_callback=buffer_callback).dump(obj)
+    else:
+        kwargs = dict(dill_kw)
+        kwargs["protocol"] = max(5, kwargs.get("protocol") or 0)
+        _BufferPickler(f, min_size, buffer_callback=buffer_callback, **kwargs).dump(obj)
+    _write_listing(path, names)
+    return sum(sizes)
+
+def _map(path):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return bytearray()
+        # copy-on-write so the objects built on the buffer stay writeable
+        # while only the pages touched are read
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY))
+
+def load(f, path):
+    """
+    Load the object dilled to the file object f found at path, memory-mapping
+    its out-of-band buffers if it has any.
+    """
+    paths = buffer_paths(path)
+    if len(paths) == 0:
+        return dill.load(f)
+    return dill.load(f, buffers=[_map(p) for p in paths])
+
+def copy(src, dst):
+    """Copy the dilled file src and its buffer files to dst"""
+    names = []
+    for idx, buf_path in enumerate(buffer_paths(src)):
+        name = "{}.{}.buf".format(os.path.basename(dst), idx)
+        tmp_path = "{}.{}.tmp".format(os.path.join(os.path.dirname(dst), name), os.getpid())
+        shutil.copyfile(buf_path, tmp_path)
+        os.rename(tmp_path, os.path.join(os.path.dirname(dst), name))
+        names.append(name)
+    _write_listing(dst, names)
+    tmp_path = "{}.{}.tmp".format(dst, os.getpid())
+    shutil.copyfile(src, tmp_path)
+    os.rename(tmp_path, dst)
+
+def remove(path):
+    """Remove the dilled file path and its buffer files"""
+    for buf_path in buffer_paths(path):
+        if os.path.exists(buf_path):
+            os.remove(buf_path)
+    for p in (path + BUFFERS_SUFFIX, path):
+        if os.path.exists(p):
+            os.remove(p)
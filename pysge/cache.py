@@ -0,0 +1,219 @@
+import os
+import time
+import types
+import shutil
+import hashlib
+import functools
+import dill
+import logging
+from . import buffers
+from .pack import PackRef
+from .serialization import Codec, DEFAULT_CODEC
+logger = logging.getLogger(__name__)
+
+def _hash_code(code, sha1):
+    sha1.update(code.co_code)
+    sha1.update(repr(code.co_names).encode("utf-8"))
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _hash_code(const, sha1)
+        else:
+            sha1.update(repr(const).encode("utf-8"))
+
+def _hash_object(obj, sha1):
+    try:
+        sha1.update(dill.dumps(obj, recurse=True))
+    except Exception:
+        sha1.update(repr(obj).encode("utf-8"))
+
+def callable_hash(func):
+    """
+    Stable hash of a callable from its code, defaults and closure, so it
+    changes when the function is edited even if its name doesn't. Globals
+    the function refers to aren't included.
+    """
+    sha1 = hashlib.sha1()
+    if isinstance(func, functools.partial):
+        sha1.update(callable_hash(func.func).encode("utf-8"))
+        _hash_object((func.args, sorted(func.keywords.items())), sha1)
+    elif isinstance(func, types.MethodType):
+        sha1.update(callable_hash(func.__func__).encode("utf-8"))
+        _hash_object(func.__self__, sha1)
+    elif isinstance(func, types.FunctionType):
+        sha1.update("{}.{}".format(func.__module__, func.__qualname__).encode("utf-8"))
+        _hash_code(func.__code__, sha1)
+        _hash_object((func.__defaults__, func.__kwdefaults__), sha1)
+        for cell in func.__closure__ or ():
+            _hash_object(cell.cell_contents, sha1)
+    else:
+        _hash_object(func, sha1)
+    return sha1.hexdigest()
+
+def args_hash(task):
+    """Stable hash of the args and kwargs of a task"""
+    sha1 = hashlib.sha1()
+    _hash_object((task["args"], sorted(task["kwargs"].items())), sha1)
+    return sha1.hexdigest()
+
+class ResultCache(object):
+    """
+    Results of tasks stored on disk across runs, keyed by the hash of the
+    task's callable (see callable_hash) and the hash of its dilled args and
+    kwargs. Results are stored as path/<callable hash>/<args hash>.p.gz in
+    the same format as the result files of a working area.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the cache (doesn't have to exist).
+
+    max_bytes : int or None (default = None)
+        Evict the least recently used results once the cache holds more than
+        this many bytes.
+
+    max_age : float or None (default = None)
+        Evict results that haven't been used for this many seconds.
+
+    dill_kw : dict
+        Kwargs to pass to dill.dump when storing results.
+
+    codec : str (default = "dill+gzip")
+        Codec results passed to put are stored with (see
+        pysge.serialization). Results of any codec are loaded.
+    """
+    def __init__(
+        self, path, max_bytes=None, max_age=None, dill_kw={},
+        codec=DEFAULT_CODEC,
+    ):
+        self.path = os.path.abspath(path)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.dill_kw = dill_kw
+        self.codec = Codec(codec)
+        self._callable_hashes = {}
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def task_path(self, task):
+        """Path the result of task is (or would be) stored at"""
+        func = task["task"]
+        # the callable is held on to so its id can't be reused
+        key = id(func)
+        if key not in self._callable_hashes:
+            self._callable_hashes[key] = (func, callable_hash(func))
+        return os.path.join(
+            self.path, self._callable_hashes[key][1],
+            "{}.p.gz".format(args_hash(task)),
+        )
+
+    def get(self, task):
+        """Return the path to the cached result of task or None"""
+        path = self.task_path(task)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+        if self.max_age is not None and time.time() - mtime > self.max_age:
+            return None
+        # the modification time records the last use for eviction
+        os.utime(path, None)
+        return path
+
+    def _path_for_store(self, task):
+        path = self.task_path(task)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        return path
+
+    def put(self, task, result):
+        """Store the result of task"""
+        path = self._path_for_store(task)
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            with self.codec.writer(f) as stream:
+                self.codec.dump(result, stream, self.dill_kw)
+        os.rename(tmp_path, path)
+        return path
+
+    def put_file(self, task, result_path):
+        """
+        Store the result file of task (e.g. from a working area) along with
+        its out-of-band buffer files
+        """
+        path = self._path_for_store(task)
+        if isinstance(result_path, PackRef):
+            tmp_path = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                f.write(result_path.read())
+            os.rename(tmp_path, path)
+        else:
+            buffers.copy(result_path, path)
+        return path
+
+    def invalidate(self, task=None, func=None):
+        """
+        Remove the cached result of task, or all cached results of the
+        callable func. Return the number of results removed.
+        """
+        if task is not None:
+            path = self.task_path(task)
+            if not os.path.exists(path):
+                return 0
+            buffers.remove(path)
+            return 1
+        if func is not None:
+            path = os.path.join(self.path, callable_hash(func))
+            if not os.path.isdir(path):
+                return 0
+            nremoved = len([n for n in os.listdir(path) if n.endswith(".p.gz")])
+            shutil.rmtree(path, ignore_errors=True)
+            return nremoved
+        raise ValueError("Either task or func must be given")
+
+    def clear(self):
+        """Remove all cached results"""
+        for name in os.listdir(self.path):
+            shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+        self._callable_hashes = {}
+
+    def evict(self):
+        """
+        Remove results not used for max_age seconds, then the least recently
+        used results until the cache holds at most max_bytes (counting their
+        buffer files). Return the number of results removed.
+        """
+        if self.max_bytes is None and self.max_age is None:
+            return 0
+        entries = []
+        for dirpath, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                if not filename.endswith(".p.gz"):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    mtime = os.path.getmtime(path)
+                    size = sum(
+                        os.path.getsize(p)
+                        for p in [path] + buffers.buffer_paths(path)
+                    )
+                except OSError:
+                    continue
+                entries.append((mtime, size, path))
+        entries.sort()
+
+        now, nbytes = time.time(), sum(size for _, size, _ in entries)
+        nremoved = 0
+        for mtime, size, path in entries:
+            expired = self.max_age is not None and now - mtime > self.max_age
+            full = self.max_bytes is not None and nbytes > self.max_bytes
+            if not (expired or full):
+                break
+            try:
+                buffers.remove(path)
+            except OSError:
+                continue
+            nbytes -= size
+            nremoved += 1
+        if nremoved > 0:
+            logger.info("Evicted {} results from {}".format(nremoved, self.path))
+        return nremoved
@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import zlib
+import hashlib
+import tempfile
+from . import buffers
+from .serialization import Codec
+
+RESULT_FILE = "result.p.gz"
+MARKER_FILE = "result.json"
+# directory of the working area where an event file is dropped per finished
+# task, so the monitor can watch a single directory
+DONE_DIR = "done"
+# directory created by the copy of a task publishing its result. Only one
+# copy can create it, so when a task runs more than once at the same time
+# (speculative copies) the first result wins and the others are dropped
+CLAIM_DIR = "result.claim"
+# a claim this old without a complete result was left by a worker which died
+# while publishing
+CLAIM_TIMEOUT = 300
+
+class _HashingWriter(object):
+    """File wrapper that keeps the size and sha1 of the bytes written"""
+    def __init__(self, f):
+        self.f = f
+        self.size = 0
+        self.sha1 = hashlib.sha1()
+
+    def write(self, data):
+        # pickle protocol 5 writes large buffers as PickleBuffers
+        self.size += memoryview(data).nbytes
+        self.sha1.update(data)
+        return self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+def _claim(path):
+    """
+    Claim the right to publish the result of the task directory path. Return
+    False if another copy of the task has already claimed it.
+    """
+    claim_path = os.path.join(path, CLAIM_DIR)
+    try:
+        os.mkdir(claim_path)
+        return True
+    except OSError:
+        pass
+    if result_complete(path, verify=True):
+        return False
+    try:
+        if time.time() - os.path.getmtime(claim_path) < CLAIM_TIMEOUT:
+            # still being published
+            return False
+        os.rmdir(claim_path)
+        os.mkdir(claim_path)
+    except OSError:
+        return False
+    return True
+
+def write_result(result, path, dill_kw={}, oob_min_size=None, codec=None):
+    """
+    Write result to path/result.p.gz then an atomic completion marker
+    path/result.json holding the size and sha1 of the result file. Both are
+    written to temporary files and renamed so a reader never sees them half
+    written, and only if no other copy of the task has published its result
+    first. With oob_min_size set, large arrays are written to buffer files
+    (see buffers.dump) before the result file. The result is encoded with
+    codec (a Codec, dill+gzip by default). Return the size of the result
+    file and its buffers, or None if another copy published its result
+    first.
+    """
+    codec = codec if codec is not None else Codec()
+    result_path = os.path.join(path, RESULT_FILE)
+    # unique to this copy of the task, as are the names of the buffer files
+    # derived from it
+    fd, tmp_path = tempfile.mkstemp(prefix=RESULT_FILE+".", suffix=".tmp", dir=path)
+    buffers_size = 0
+    with os.fdopen(fd, 'wb') as f:
+        writer = _HashingWriter(f)
+        with codec.writer(writer) as stream:
+            if oob_min_size is None:
+                codec.dump(result, stream, dill_kw)
+            else:
+                buffers_size = buffers.dump(
+                    result, stream, tmp_path, dill_kw=dill_kw,
+                    min_size=oob_min_size, serializer=codec.serializer,
+                )
+    if not _claim(path):
+        buffers.remove(tmp_path)
+        return None
+
+    if os.path.exists(tmp_path + buffers.BUFFERS_SUFFIX):
+        os.rename(tmp_path + buffers.BUFFERS_SUFFIX, result_path + buffers.BUFFERS_SUFFIX)
+    elif os.path.exists(result_path + buffers.BUFFERS_SUFFIX):
+        os.remove(result_path + buffers.BUFFERS_SUFFIX)
+    os.rename(tmp_path, result_path)
+
+    marker_path = os.path.join(path, MARKER_FILE)
+    tmp_path = "{}.{}.tmp".format(marker_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump({"size": writer.size, "sha1": writer.sha1.hexdigest()}, f)
+    os.rename(tmp_path, marker_path)
+    _notify_done(path)
+    return writer.size + buffers_size
+
+def _notify_done(path):
+    done_dir = os.path.join(os.path.dirname(path), DONE_DIR)
+    try:
+        if not os.path.exists(done_dir):
+            os.makedirs(done_dir)
+    except OSError:
+        pass
+    tmp_path = os.path.join(done_dir, ".{}.{}".format(os.path.basename(path), os.getpid()))
+    open(tmp_path, 'w').close()
+    os.rename(tmp_path, os.path.join(done_dir, os.path.basename(path)))
+
+def _stream(path, chunksize=1<<20):
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunksize), b''):
+            yield chunk
+
+def result_complete(path, verify=False):
+    """
+    Check the result in task directory path is complete without unpickling
+    it. The size is compared against the completion marker and, if verify is
+    True, the sha1 is streamed and compared as well. Results written without
+    a marker are checked by streaming through the gzip decompression.
+    """
+    result_path = os.path.join(path, RESULT_FILE)
+    try:
+        with open(os.path.join(path, MARKER_FILE), 'r') as f:
+            marker = json.load(f)
+    except (IOError, OSError, ValueError):
+        marker = None
+
+    try:
+        if marker is None:
+            if not os.path.exists(result_path):
+                return False
+            decompressor = zlib.decompressobj(16+zlib.MAX_WBITS)
+            for chunk in _stream(result_path):
+                decompressor.decompress(chunk, 1<<20)
+                while decompressor.unconsumed_tail:
+                    decompressor.decompress(decompressor.unconsumed_tail, 1<<20)
+            return decompressor.eof
+
+        if os.path.getsize(result_path) != marker["size"]:
+            return False
+        if verify:
+            sha1 = hashlib.sha1()
+            for chunk in _stream(result_path):
+                sha1.update(chunk)
+            return sha1.hexdigest() == marker["sha1"]
+        return True
+    except (IOError, OSError, zlib.error):
+        return False
@@ -0,0 +1,151 @@
+import os
+import json
+import contextlib
+from . import pack
+from .completion import RESULT_FILE, result_complete
+from .results import load_result
+
+# Dependencies between the tasks of a working area, {position: [positions of
+# the tasks it depends on]}, so a resume submits with the same holds
+DEPENDENCIES_FILE = "dependencies.json"
+
+class MissingDependency(RuntimeError):
+    """A task was run before the result of a task it depends on existed"""
+
+# number of ResultOfs created in this process. Without any, no task can
+# have dependencies and the tasks aren't searched for them
+_nresultof = 0
+
+class ResultOf(object):
+    """
+    Placeholder for the result of the task at index in the list of tasks
+    submitted, used in the args or kwargs of a later task (in lists, tuples,
+    sets and dicts). The task is then held by the batch system until the
+    task it depends on has finished and the placeholder is replaced by the
+    result when the task is loaded on the node.
+
+        tasks = [
+            {"task": select, "args": (path,), "kwargs": {}},
+            {"task": fit, "args": (pysge.ResultOf(0),), "kwargs": {}},
+        ]
+    """
+    def __init__(self, index):
+        global _nresultof
+        _nresultof += 1
+        self.index = index
+
+    def __repr__(self):
+        return "ResultOf({})".format(self.index)
+
+    def __reduce__(self):
+        return (_result_of, (self.index,))
+
+# working area and results of the tasks loaded while resolving (see below)
+_resolving = None
+
+def _result_of(index):
+    """Unpickle a ResultOf: its result while resolving, else a ResultOf"""
+    if _resolving is None:
+        return ResultOf(index)
+    return _resolving.load(index)
+
+class _Results(object):
+    def __init__(self, area):
+        self.area = area
+        self.loaded = {}
+        self._refs = None
+
+    def load(self, index):
+        if index in self.loaded:
+            return self.loaded[index]
+        if pack.is_packed(self.area):
+            if self._refs is None:
+                self._refs = pack.ResultIndex(self.area).update()
+            path = self._refs.get(index)
+        else:
+            task_dir = os.path.join(self.area, "task_{:05d}".format(index))
+            path = os.path.join(task_dir, RESULT_FILE) if result_complete(task_dir) else None
+        if path is None:
+            raise MissingDependency(
+                "A task depends on task {} which has no result".format(index)
+            )
+        self.loaded[index] = load_result(path)
+        return self.loaded[index]
+
+@contextlib.contextmanager
+def resolving(area):
+    """
+    Replace the ResultOfs unpickled in this context (e.g. loading a task on
+    the node) by the results of the tasks of the working area they refer to,
+    as they're unpickled so no object is rebuilt. Raises MissingDependency
+    if one has no result.
+    """
+    global _resolving
+    previous, _resolving = _resolving, _Results(area)
+    try:
+        yield
+    finally:
+        _resolving = previous
+
+_CONTAINERS = (list, tuple, set, frozenset, dict)
+
+def _find(obj, memo):
+    """
+    Indices of the ResultOfs in obj, looking inside containers. memo maps
+    the id of each container searched to its indices, so containers shared
+    between tasks are only searched once.
+    """
+    if isinstance(obj, ResultOf):
+        return (obj.index,)
+    if not isinstance(obj, _CONTAINERS):
+        return ()
+    key = id(obj)
+    if key not in memo:
+        memo[key] = ()
+        found = set()
+        for value in (obj.values() if isinstance(obj, dict) else obj):
+            found.update(_find(value, memo))
+        memo[key] = tuple(found)
+    return memo[key]
+
+def dependencies(tasks):
+    """
+    Return {index: [indices of its dependencies]} of the tasks with
+    dependencies, which must be on earlier tasks.
+    """
+    deps = {}
+    if _nresultof == 0:
+        return deps
+    memo = {}
+    for idx, task in enumerate(tasks):
+        task_deps = sorted(set(_find(task["args"], memo) + _find(task["kwargs"], memo)))
+        if len(task_deps) == 0:
+            continue
+        if any(dep < 0 or dep >= idx for dep in task_deps):
+            raise ValueError(
+                "Task {} can only depend on earlier tasks, not {}".format(idx, task_deps)
+            )
+        deps[idx] = task_deps
+    return deps
+
+def levels(ntasks, deps):
+    """Group the task indices by their depth in the dependency graph"""
+    depth = [0]*ntasks
+    for idx in range(ntasks):
+        depth[idx] = 1 + max((depth[dep] for dep in deps.get(idx, [])), default=-1)
+    grouped = [[] for _ in range(max(depth, default=-1)+1)]
+    for idx in range(ntasks):
+        grouped[depth[idx]].append(idx)
+    return grouped
+
+def write_dependencies(area, deps):
+    with open(os.path.join(area, DEPENDENCIES_FILE), 'w') as f:
+        json.dump({str(idx): task_deps for idx, task_deps in deps.items()}, f)
+
+def read_dependencies(area):
+    """{position: [positions]} of the working area (empty if it has none)"""
+    try:
+        with open(os.path.join(area, DEPENDENCIES_FILE), 'r') as f:
+            return {int(idx): task_deps for idx, task_deps in json.load(f).items()}
+    except (IOError, OSError, ValueError):
+        return {}
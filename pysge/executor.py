@@ -0,0 +1,287 @@
+import os
+import time
+import asyncio
+import threading
+import logging
+from concurrent.futures import Executor, Future, CancelledError
+from .area import WorkingArea
+from .submitter import SGETaskSubmitter
+from .monitor import JobMonitor
+from .journal import Journal
+from .retry import RetryPolicy
+from .results import load_result
+from .pack import stderr_location
+from .serialization import check_importable
+logger = logging.getLogger(__name__)
+
+class TaskFailed(RuntimeError):
+    """A task failed and the retry policy gave up on it"""
+
+class SGEExecutor(Executor):
+    """
+    concurrent.futures.Executor running each call on an SGE batch system.
+    Tasks can be submitted at any time (from any number of threads) and are
+    gathered into array jobs: a single background thread dills the calls
+    submitted since its last poll to one working area, submits them as one
+    array job and polls a shared JobMonitor for finished and failed tasks.
+
+    Failed tasks are resubmitted without user input, with the options
+    decided by monitor_kw["retry_policy"] (a default RetryPolicy() if not
+    given, so tasks failing every time aren't resubmitted forever). Futures
+    of tasks the retry policy gives up on raise TaskFailed.
+
+    Parameters
+    ----------
+    label : str
+        Label given to the qsub submission script through -N.
+
+    tmpdir : str
+        Path to temporary directory (doesn't have to exist) where the working
+        area (tpd_YYYYMMDD_hhmmss_xxxxxxxx) of the executor is created.
+
+    options : str (default = "-q hep.q")
+        Additional options to pass to the qsub command. Take care since the
+        following options are already in use: -wd, -V, -e, -o and -t.
+
+    sleep : float (default = 5)
+        Minimum time between queries to the batch system.
+
+    batch_wait : float (default = 0.5)
+        Time to wait after a call is submitted for more calls to gather into
+        the same array job.
+
+    return_files : bool (default = False)
+        Set the futures' results to the paths to the output files instead of
+        loading them into python.
+
+    dill_kw : dict
+        Kwargs to pass to dill.dump
+
+    dedup : bool (default = False)
+        Store identical callables and arguments shared between tasks once in
+        the working area (keyed by their hash) instead of in every task file.
+
+    oob_min_size : int or None (default = None)
+        Write numpy arrays of at least this many bytes in the calls and their
+        results to memory-mapped buffer files. See sge_submit.
+
+    layout : str (default = "dirs")
+        Layout of the working area, "dirs" or "packed". See sge_submit.
+
+    codec : str (default = "dill+gzip")
+        Codec of the calls and results. See sge_submit.
+
+    monitor_kw : dict
+        Kwargs to pass to JobMonitor, e.g. query="xml", max_sleep, watcher or
+        retry_policy (default RetryPolicy()).
+    """
+    def __init__(
+        self, label, tmpdir, options="-q hep.q", sleep=5, batch_wait=0.5,
+        return_files=False, dill_kw={"recurse": False}, dedup=False,
+        monitor_kw={}, oob_min_size=None, layout="dirs", codec="dill+gzip",
+    ):
+        self.sleep = sleep
+        self.batch_wait = batch_wait
+        self.return_files = return_files
+        self.dill_kw = dill_kw
+        self.dedup = dedup
+        self.oob_min_size = oob_min_size
+
+        self.area = WorkingArea(
+            os.path.abspath(tmpdir), layout=layout, codec=codec,
+        )
+        self.submitter = SGETaskSubmitter(
+            " ".join(['-N {}'.format(label), options]),
+            journal=Journal(self.area.path),
+        )
+        monitor_kw = dict(monitor_kw)
+        monitor_kw.setdefault("retry_policy", RetryPolicy())
+        self.monitor = JobMonitor(self.submitter, **monitor_kw)
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pending = []
+        self._futures = {}
+        self._results = []
+        self._finished = set()
+        self._ncompleted = 0
+        self._nfailed = 0
+        self._shutdown = False
+        self._kill = False
+        self._thread = None
+
+    def submit(self, fn, *args, **kwargs):
+        """Schedule fn(*args, **kwargs) to run as an SGE task"""
+        if not callable(fn):
+            raise TypeError("{!r} is not callable".format(fn))
+        if self.area.codec.serializer == "pickle":
+            check_importable(fn)
+        future = Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            self._pending.append((future, {"task": fn, "args": args, "kwargs": kwargs}))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="SGEExecutor", daemon=True,
+                )
+                self._thread.start()
+        self._wakeup.set()
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        """
+        Stop accepting calls. The monitor thread exits once every submitted
+        task has finished. With cancel_futures=True calls not yet submitted
+        to the batch system are cancelled.
+        """
+        with self._lock:
+            self._shutdown = True
+            if cancel_futures:
+                for future, _ in self._pending:
+                    future.cancel()
+                self._pending = []
+        self._wakeup.set()
+        if wait and self._thread is not None:
+            self._thread.join()
+
+    def killall(self):
+        """
+        Shut down, deleting all submitted jobs from the batch system and
+        cancelling their futures.
+        """
+        with self._lock:
+            self._kill = True
+            running = self._thread is not None
+        self.shutdown(wait=running, cancel_futures=True)
+
+    def _run(self):
+        try:
+            while True:
+                if self._kill:
+                    self._killall()
+                    break
+                self._submit_pending()
+                if len(self._futures) > 0:
+                    self.monitor.poll(
+                        self._results, self._finished, area=self.area.path,
+                        request_user_input=False,
+                    )
+                    self._resolve()
+
+                with self._lock:
+                    if self._shutdown and len(self._pending) == 0 and len(self._futures) == 0:
+                        break
+                    wakeup = len(self._pending) == 0
+                if wakeup and self._wakeup.wait(self.monitor.next_sleep(self.sleep)):
+                    # gather the calls submitted shortly after the first
+                    time.sleep(self.batch_wait)
+                self._wakeup.clear()
+        except BaseException as e:
+            logger.exception("SGEExecutor monitor thread failed")
+            with self._lock:
+                self._shutdown = True
+                pending, self._pending = self._pending, []
+            for future in [f for f, _ in pending] + list(self._futures.values()):
+                if not future.done():
+                    future.set_exception(e)
+            self._futures = {}
+        finally:
+            self.monitor.stop_watcher()
+
+    def _killall(self):
+        if len(self.submitter.jobid_tasks) > 0:
+            self.submitter.killall()
+        for future in self._futures.values():
+            future.set_exception(CancelledError())
+        self._futures = {}
+
+    def _submit_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        pending = [
+            (future, task) for future, task in pending
+            if future.set_running_or_notify_cancel()
+        ]
+        if len(pending) == 0:
+            return
+
+        offset = len(self._results)
+        if offset == 0 and self.monitor.watcher is not None:
+            self.monitor.start_watcher(self.area.path)
+        for start, task_paths in self.area.create_areas_iter(
+            [task for _, task in pending], quiet=True, dill_kw=self.dill_kw,
+            dedup=self.dedup, offset=offset, oob_min_size=self.oob_min_size,
+        ):
+            self._results.extend([None]*len(task_paths))
+            self.submitter.submit_tasks(task_paths, start=start, quiet=True)
+        for idx, (future, _) in enumerate(pending):
+            self._futures[offset+idx] = future
+        logger.info("Submitted {} tasks".format(len(pending)))
+
+    def _resolve(self):
+        for pos in self.monitor.completed[self._ncompleted:]:
+            future = self._futures.pop(pos, None)
+            if future is None:
+                continue
+            try:
+                if self.return_files:
+                    future.set_result(self._results[pos])
+                else:
+                    future.set_result(load_result(self._results[pos]))
+            except Exception as e:
+                future.set_exception(e)
+        self._ncompleted = len(self.monitor.completed)
+
+        for pos in self.monitor.failed[self._nfailed:]:
+            future = self._futures.pop(pos, None)
+            if future is not None:
+                future.set_exception(TaskFailed("Task {} failed. See {}".format(
+                    pos, stderr_location(self.area.task_paths[pos]),
+                )))
+        self._nfailed = len(self.monitor.failed)
+
+class AsyncSGEExecutor(object):
+    """
+    asyncio front end of SGEExecutor. submit returns an asyncio future which
+    can be awaited, gathered or passed to asyncio.as_completed. All calls go
+    through one SGEExecutor and therefore share its monitor thread. Use as
+    an async context manager or await shutdown().
+
+    Parameters are passed to SGEExecutor.
+    """
+    def __init__(self, *args, **kwargs):
+        self.executor = SGEExecutor(*args, **kwargs)
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Schedule fn(*args, **kwargs) and return a future of the running event
+        loop
+        """
+        return asyncio.wrap_future(
+            self.executor.submit(fn, *args, **kwargs),
+            loop=asyncio.get_running_loop(),
+        )
+
+    async def map(self, fn, *iterables):
+        """Return the list of results of fn over the iterables"""
+        return await asyncio.gather(*[
+            self.submit(fn, *args) for args in zip(*iterables)
+        ])
+
+    async def shutdown(self, wait=True, cancel_futures=False):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            None, lambda: self.executor.shutdown(wait=wait, cancel_futures=cancel_futures),
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.executor.killall)
+        else:
+            await self.shutdown()
+        return False
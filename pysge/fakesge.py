@@ -0,0 +1,460 @@
+"""
+Local stand-in for SGE's qsub, qstat, qdel and qacct. Array tasks are run on
+local cores, with optional scheduling latency and injected failures, so
+pysge's submission and monitoring can be exercised (and benchmarked) without
+a cluster.
+
+    with FakeSGE(slots=4, latency=0.1, failure_rate=0.05):
+        results = pysge.sge_submit(tasks, "name", "/tmp/pysge-temporaries")
+
+The commands are run as ``python -m pysge.fakesge <command> ...`` through
+wrapper scripts installed in a bin directory put at the front of PATH. State
+lives in the directory given by PYSGE_FAKESGE_DIR.
+"""
+import os
+import sys
+import json
+import time
+import fcntl
+import random
+import signal
+import shutil
+import getpass
+import datetime
+import tempfile
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+COMMANDS = ("qsub", "qstat", "qdel", "qacct")
+
+# qsub options taking a value (-pe takes two)
+_QSUB_VALUE_OPTIONS = (
+    "-wd", "-e", "-o", "-t", "-N", "-q", "-l", "-v", "-P", "-hold_jid",
+    "-hold_jid_ad", "-tc", "-b", "-S", "-j", "-M", "-m", "-A", "-p",
+)
+
+def _root():
+    root = os.environ.get("PYSGE_FAKESGE_DIR")
+    if root is None:
+        sys.stderr.write("PYSGE_FAKESGE_DIR is not set\n")
+        sys.exit(1)
+    return root
+
+def _next_jobid(root):
+    with open(os.path.join(root, "jobid"), 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        jobid = int(f.read() or 0) + 1
+        f.seek(0)
+        f.truncate()
+        f.write(str(jobid))
+    return jobid
+
+def _task_state_path(root, jobid, taskid):
+    return os.path.join(root, "tasks", "{}.{}".format(jobid, taskid))
+
+def _write(path, data):
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+def parse_qsub_args(args):
+    job = {"env": {}, "options": {}, "name": "pysge"}
+    idx = 0
+    while idx < len(args)-1:
+        arg = args[idx]
+        if arg == "-pe":
+            job["options"][arg] = args[idx+1:idx+3]
+            idx += 3
+        elif arg in _QSUB_VALUE_OPTIONS:
+            value = args[idx+1]
+            if arg == "-v":
+                for var in value.split(","):
+                    key, _, val = var.partition("=")
+                    job["env"][key] = val
+            elif arg == "-N":
+                job["name"] = value
+            else:
+                job["options"][arg] = value
+            idx += 2
+        else:
+            idx += 1
+    job["executable"] = args[-1]
+    job["wd"] = job["options"].get("-wd", os.getcwd())
+
+    trange = job["options"].get("-t", "1-1:1")
+    trange, _, step = trange.partition(":")
+    start, _, stop = trange.partition("-")
+    job["tasks"] = list(range(int(start), int(stop or start)+1, int(step or 1)))
+    return job
+
+def qsub(args):
+    root = _root()
+    latency = float(os.environ.get("PYSGE_FAKESGE_QSUB_LATENCY", 0.))
+    if latency > 0.:
+        time.sleep(latency)
+
+    job = parse_qsub_args(args)
+    max_aj_tasks = int(os.environ.get("PYSGE_FAKESGE_MAX_AJ_TASKS", 0))
+    if max_aj_tasks > 0 and len(job["tasks"]) > max_aj_tasks:
+        sys.stderr.write(
+            "Unable to run job: job rejected: the job array has {} tasks, "
+            "more than max_aj_tasks {}.\n".format(len(job["tasks"]), max_aj_tasks)
+        )
+        return 1
+    jobid = _next_jobid(root)
+    job.update({
+        "jobid": jobid,
+        "user": getpass.getuser(),
+        "submit_time": time.time(),
+        "slots": int(os.environ.get("PYSGE_FAKESGE_SLOTS", os.cpu_count() or 1)),
+        "latency": float(os.environ.get("PYSGE_FAKESGE_LATENCY", 0.)),
+        "failure_rate": float(os.environ.get("PYSGE_FAKESGE_FAILURE_RATE", 0.)),
+        "hold": os.environ.get("PYSGE_FAKESGE_HOLD", "0") == "1",
+    })
+    held = "-hold_jid" in job["options"] or "-hold_jid_ad" in job["options"]
+    for taskid in job["tasks"]:
+        _write(_task_state_path(root, jobid, taskid), "hqw" if held else "qw")
+
+    # the runner's process group is killed by qdel
+    job_path = os.path.join(root, "jobs", "{}.json".format(jobid))
+    _write(job_path, json.dumps(job))
+    runner = subprocess.Popen(
+        [sys.executable, "-m", "pysge.fakesge", "_run", str(jobid)],
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL, start_new_session=True,
+    )
+    job["runner_pid"] = runner.pid
+    _write(job_path, json.dumps(job))
+
+    print('Your job-array {}.{}-{}:1 ("{}") has been submitted'.format(
+        jobid, job["tasks"][0], job["tasks"][-1], job["name"],
+    ))
+
+class _Slot(object):
+    """Global limit on the number of tasks running at once, across jobs"""
+    def __init__(self, root, nslots):
+        self.root = root
+        self.nslots = nslots
+        self.f = None
+
+    def __enter__(self):
+        while True:
+            for slot in range(self.nslots):
+                f = open(os.path.join(self.root, "slots", str(slot)), 'a')
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    self.f = f
+                    return self
+                except (IOError, OSError):
+                    f.close()
+            time.sleep(0.01)
+
+    def __exit__(self, *args):
+        self.f.close()
+
+def _held(root, job, taskid):
+    """
+    Whether a task is held: -hold_jid waits for all tasks of the jobs listed
+    to finish and -hold_jid_ad for the task with the same id of each job.
+    """
+    tasks_dir = os.path.join(root, "tasks")
+    for jobid in job["options"].get("-hold_jid", "").split(","):
+        if jobid and any(name.split(".")[0] == jobid for name in os.listdir(tasks_dir)):
+            return True
+    for jobid in job["options"].get("-hold_jid_ad", "").split(","):
+        if jobid and os.path.exists(_task_state_path(root, jobid, taskid)):
+            return True
+    return False
+
+def _run_task(root, job, taskid):
+    jobid = job["jobid"]
+    state_path = _task_state_path(root, jobid, taskid)
+    if _held(root, job, taskid):
+        while _held(root, job, taskid):
+            if not os.path.exists(state_path):
+                # deleted while held
+                return
+            time.sleep(0.1)
+        _write(state_path, "qw")
+    if job["latency"] > 0.:
+        if not os.path.exists(state_path):
+            # deleted while queued
+            return
+        time.sleep(job["latency"])
+
+    with _Slot(root, job["slots"]):
+        if not os.path.exists(state_path):
+            # deleted while queued
+            return
+        start = time.time()
+        _write(state_path, "r {}".format(start))
+
+        env = dict(os.environ)
+        env.update(job["env"])
+        env.update({
+            "JOB_ID": str(jobid), "SGE_TASK_ID": str(taskid), "NSLOTS": "1",
+            "JOB_NAME": job["name"], "QUEUE": "fake.q",
+        })
+        if random.random() < job["failure_rate"]:
+            # node failure - the task dies without running
+            exit_status, failed = 137, "100 : assumedly after job"
+        else:
+            # own process group so qdel can kill a single task
+            proc = subprocess.Popen(
+                ["bash", job["executable"]], cwd=job["wd"], env=env,
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL, start_new_session=True,
+            )
+            _write(state_path, "r {} {}".format(start, proc.pid))
+            exit_status, failed = proc.wait(), "0"
+
+        _write(os.path.join(root, "acct", "{}.{}.json".format(jobid, taskid)), json.dumps({
+            "jobnumber": jobid, "taskid": taskid, "jobname": job["name"],
+            "exit_status": exit_status, "failed": failed,
+            "ru_wallclock": time.time()-start, "maxvmem": "0",
+        }))
+        try:
+            os.remove(state_path)
+        except OSError:
+            pass
+
+def _run(args):
+    root = _root()
+    jobid = int(args[0])
+    with open(os.path.join(root, "jobs", "{}.json".format(jobid)), 'r') as f:
+        job = json.load(f)
+    if job["hold"]:
+        while any(
+            os.path.exists(_task_state_path(root, jobid, taskid))
+            for taskid in job["tasks"]
+        ):
+            time.sleep(1.)
+        return
+
+    pool = ThreadPool(min(job["slots"], len(job["tasks"])))
+    pool.map(lambda taskid: _run_task(root, job, taskid), job["tasks"], chunksize=1)
+    pool.close()
+
+def _format_time(t):
+    return datetime.datetime.fromtimestamp(t).strftime("%m/%d/%Y %H:%M:%S")
+
+def _task_states(root):
+    jobs = {}
+    for name in os.listdir(os.path.join(root, "tasks")):
+        if name.endswith(".tmp"):
+            continue
+        jobid, taskid = name.split(".")
+        try:
+            with open(os.path.join(root, "tasks", name), 'r') as f:
+                state = f.read().split()
+        except (IOError, OSError):
+            continue
+        if len(state) == 0:
+            continue
+        if jobid not in jobs:
+            try:
+                with open(os.path.join(root, "jobs", "{}.json".format(jobid)), 'r') as f:
+                    jobs[jobid] = json.load(f)
+            except (IOError, OSError, ValueError):
+                continue
+        job = jobs[jobid]
+        start = float(state[1]) if len(state) > 1 else job["submit_time"]
+        yield job, int(taskid), state[0], start
+
+def qstat(args):
+    root = _root()
+    user = args[args.index("-u")+1] if "-u" in args else None
+    states = sorted(
+        (s for s in _task_states(root) if user is None or s[0]["user"] == user),
+        key=lambda s: (s[0]["jobid"], s[1]),
+    )
+
+    if "-xml" in args:
+        running, pending = [], []
+        for job, taskid, state, start in states:
+            entry = (
+                '    <job_list state="{}">\n'
+                '      <JB_job_number>{}</JB_job_number>\n'
+                '      <JAT_prio>0.50000</JAT_prio>\n'
+                '      <JB_name>{}</JB_name>\n'
+                '      <JB_owner>{}</JB_owner>\n'
+                '      <state>{}</state>\n'
+                '      <slots>1</slots>\n'
+                '      <tasks>{}</tasks>\n'
+                '    </job_list>\n'
+            ).format(
+                "running" if state == "r" else "pending", job["jobid"],
+                job["name"], job["user"], state, taskid,
+            )
+            (running if state == "r" else pending).append(entry)
+        sys.stdout.write(
+            "<?xml version='1.0'?>\n<job_info>\n  <queue_info>\n{}  </queue_info>\n"
+            "  <job_info>\n{}  </job_info>\n</job_info>\n".format(
+                "".join(running), "".join(pending),
+            )
+        )
+        return
+
+    if len(states) == 0:
+        return
+    print("job-ID  prior   name       user         state submit/start at     queue                          slots ja-task-ID ")
+    print("-"*113)
+    for job, taskid, state, start in states:
+        print("{:>7} 0.50000 {:<10} {:<12} {:<5} {} {:<30} {:>5} {}".format(
+            job["jobid"], job["name"][:10], job["user"][:12], state,
+            _format_time(start), "fake.q@localhost" if state == "r" else "",
+            1, taskid,
+        ))
+
+def _delete_task(root, jobid, taskid):
+    state_path = _task_state_path(root, jobid, taskid)
+    try:
+        with open(state_path, 'r') as f:
+            state = f.read().split()
+        os.remove(state_path)
+    except (IOError, OSError):
+        return False
+    if len(state) > 2:
+        try:
+            os.killpg(int(state[2]), signal.SIGKILL)
+        except OSError:
+            pass
+    return True
+
+def _delete_job(root, jobid):
+    job_path = os.path.join(root, "jobs", "{}.json".format(jobid))
+    if not os.path.exists(job_path):
+        return None
+    with open(job_path, 'r') as f:
+        job = json.load(f)
+    for taskid in job["tasks"]:
+        _delete_task(root, jobid, taskid)
+    try:
+        os.killpg(job["runner_pid"], signal.SIGKILL)
+    except OSError:
+        pass
+    return job
+
+def qdel(args):
+    root = _root()
+    for jobid in args:
+        if "." in jobid:
+            # single array task: jobid.taskid
+            jobnumber, taskid = jobid.split(".")
+            if _delete_task(root, jobnumber, int(taskid)):
+                print("{} has registered the job-array task {} for deletion".format(
+                    getpass.getuser(), jobid,
+                ))
+            continue
+        job = _delete_job(root, jobid)
+        if job is not None:
+            print("{} has registered the job {} for deletion".format(job["user"], job["jobid"]))
+
+def qacct(args):
+    root = _root()
+    jobid = args[args.index("-j")+1]
+    for name in sorted(os.listdir(os.path.join(root, "acct"))):
+        if not name.startswith("{}.".format(jobid)) or not name.endswith(".json"):
+            continue
+        with open(os.path.join(root, "acct", name), 'r') as f:
+            info = json.load(f)
+        print("="*62)
+        for key, value in info.items():
+            print("{:<13}{}".format(key, value))
+
+class FakeSGE(object):
+    """
+    Context manager setting up a fake SGE: a state directory, wrapper scripts
+    for the commands and the environment (PATH, PYTHONPATH and
+    configuration) for pysge to use them.
+
+    Parameters
+    ----------
+    slots : int or None (default = None)
+        Number of tasks run at once. Defaults to the number of cores.
+
+    latency : float (default = 0)
+        Scheduling latency of each task in seconds.
+
+    qsub_latency : float (default = 0)
+        Time each qsub call takes in seconds.
+
+    failure_rate : float (default = 0)
+        Probability each task dies (as on a node failure) without running.
+
+    hold : bool (default = False)
+        Keep all tasks queued until they're deleted, e.g. to measure polling.
+
+    max_aj_tasks : int or None (default = None)
+        Reject array jobs with more tasks than this, as SGE's max_aj_tasks.
+
+    path : str or None (default = None)
+        State directory. A temporary directory (removed on exit) by default.
+    """
+    def __init__(
+        self, slots=None, latency=0., qsub_latency=0., failure_rate=0.,
+        hold=False, max_aj_tasks=None, path=None,
+    ):
+        self.config = {
+            "PYSGE_FAKESGE_SLOTS": str(slots or os.cpu_count() or 1),
+            "PYSGE_FAKESGE_LATENCY": str(latency),
+            "PYSGE_FAKESGE_QSUB_LATENCY": str(qsub_latency),
+            "PYSGE_FAKESGE_FAILURE_RATE": str(failure_rate),
+            "PYSGE_FAKESGE_HOLD": "1" if hold else "0",
+            "PYSGE_FAKESGE_MAX_AJ_TASKS": str(max_aj_tasks or 0),
+        }
+        self.path = path
+        self._cleanup = path is None
+        self._environ = None
+
+    def __enter__(self):
+        if self.path is None:
+            self.path = tempfile.mkdtemp(prefix="pysge_fakesge_")
+        for subdir in ("bin", "jobs", "tasks", "acct", "slots"):
+            if not os.path.exists(os.path.join(self.path, subdir)):
+                os.makedirs(os.path.join(self.path, subdir))
+
+        bin_dir = os.path.join(self.path, "bin")
+        for command in COMMANDS:
+            script = os.path.join(bin_dir, command)
+            with open(script, 'w') as f:
+                f.write('#!/bin/bash\nexec {} -m pysge.fakesge {} "$@"\n'.format(
+                    sys.executable, command,
+                ))
+            os.chmod(script, 0o755)
+
+        package_dir = os.path.dirname(os.path.abspath(__file__))
+        self._environ = dict(os.environ)
+        os.environ.update(self.config)
+        os.environ["PYSGE_FAKESGE_DIR"] = self.path
+        # the worker scripts are found on PATH and import pysge
+        os.environ["PATH"] = os.pathsep.join([bin_dir, package_dir, os.environ.get("PATH", "")])
+        os.environ["PYTHONPATH"] = os.pathsep.join(
+            p for p in [os.path.dirname(package_dir), os.environ.get("PYTHONPATH")] if p
+        )
+        return self
+
+    def __exit__(self, *args):
+        jobs_dir = os.path.join(self.path, "jobs")
+        for name in os.listdir(jobs_dir):
+            if name.endswith(".json"):
+                _delete_job(self.path, name.split(".")[0])
+        os.environ.clear()
+        os.environ.update(self._environ)
+        if self._cleanup:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    command, args = argv[0], argv[1:]
+    if command == "_run":
+        return _run(args)
+    if command not in COMMANDS:
+        sys.stderr.write("Unknown command {}\n".format(command))
+        sys.exit(1)
+    return globals()[command](args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,199 @@
+import os
+import json
+import logging
+import statistics
+import threading
+import collections
+from tqdm.auto import tqdm
+from . import pack
+from . import pysge_worker
+from .completion import result_complete
+from .report import collect_metrics
+from .serialization import read_codec
+from .submitter import get_pool
+logger = logging.getLogger(__name__)
+
+# Runtime estimates of the task functions learned from earlier runs,
+# {function name: seconds}, kept in the temporary directory of the runs
+COSTS_FILE = "costs.json"
+# suffix of the output and metrics files of tasks run locally in a task
+# directory, kept apart from those of the copy in the batch system
+LOCAL_SUFFIX = ".local"
+
+def task_name(task):
+    """Name of a task's function the runtime estimates are keyed by"""
+    func = task["task"]
+    func = getattr(func, "func", func)  # functools.partial
+    return "{}.{}".format(
+        getattr(func, "__module__", None),
+        getattr(func, "__qualname__", type(func).__name__),
+    )
+
+def load_costs(tmpdir):
+    try:
+        with open(os.path.join(tmpdir, COSTS_FILE), 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def update_costs(tmpdir, area, names):
+    """
+    Update the runtime estimates in tmpdir with the median run time of each
+    function in the working area, where names are the function names of its
+    tasks (see task_name). Only the copy of a task which finished first (the
+    one whose result is kept) counts.
+    """
+    winners = {}
+    for metrics in collect_metrics(area):
+        if "run_wall" not in metrics:
+            continue
+        pos = pack.task_position(metrics["task"])
+        if pos not in winners or metrics.get("end_time", 0) < winners[pos].get("end_time", 0):
+            winners[pos] = metrics
+    runtimes = {}
+    for pos, metrics in winners.items():
+        runtimes.setdefault(names[pos], []).append(metrics["run_wall"])
+    if len(runtimes) == 0:
+        return
+    costs = load_costs(tmpdir)
+    costs.update({name: statistics.median(times) for name, times in runtimes.items()})
+    tmp_path = os.path.join(tmpdir, "{}.{}.tmp".format(COSTS_FILE, os.getpid()))
+    with open(tmp_path, 'w') as f:
+        json.dump(costs, f, indent=1, sort_keys=True)
+    os.rename(tmp_path, os.path.join(tmpdir, COSTS_FILE))
+
+def estimate_costs(tasks, costs):
+    """
+    Estimated runtime of each task: its 'seconds' key if given, else the
+    estimate learned for its function, else None
+    """
+    return [
+        task["seconds"] if "seconds" in task else costs.get(task_name(task))
+        for task in tasks
+    ]
+
+def local_order(costs, max_seconds=None, exclude=()):
+    """
+    Indices of the tasks to run locally, cheapest first and those without an
+    estimate last, leaving out tasks estimated to take longer than
+    max_seconds and the indices in exclude.
+    """
+    known = sorted(
+        (idx for idx, cost in enumerate(costs) if cost is not None),
+        key=lambda idx: costs[idx],
+    )
+    unknown = [idx for idx, cost in enumerate(costs) if cost is None]
+    return [
+        idx for idx in known + unknown
+        if idx not in exclude
+        and (max_seconds is None or costs[idx] is None or costs[idx] <= max_seconds)
+    ]
+
+# result pack writer and codec of a local worker process (packed areas)
+_local = None
+
+def _run_local(area, path):
+    """
+    Run the task at path of a working area in this (pool) process as the
+    worker on a node does. Return (path, whether it finished here).
+    """
+    global _local
+    if not pack.is_packed(area):
+        if result_complete(path):
+            return path, False
+        return path, pysge_worker._run_directory(path, LOCAL_SUFFIX)
+
+    if _local is None:
+        # slots are held for the life of the pool process
+        _local = (pack.ResultPackWriter(area), read_codec(area))
+    writer, codec = _local
+    return path, pysge_worker._run_packed(area, pack.task_position(path), writer, codec)
+
+class LocalLane(object):
+    """
+    Run tasks of a working area on a local process pool, one per process at
+    a time in the order given, while the same tasks are queued in the batch
+    system. Tasks known to have finished (skip) aren't started and results
+    are claimed as on the nodes, so the first copy to finish wins.
+    """
+    def __init__(self, area, paths, ncores=4, start_method=None):
+        self.area = area
+        self.finished = []
+        self._paths = collections.deque(paths)
+        self._skip = set()
+        self._lock = threading.Lock()
+        self._pool = get_pool(ncores, start_method=start_method)
+        for _ in range(min(ncores, len(paths))):
+            self._next()
+
+    def skip(self, paths):
+        with self._lock:
+            self._skip.update(paths)
+
+    def _next(self, *args):
+        with self._lock:
+            while len(self._paths) > 0:
+                path = self._paths.popleft()
+                if path not in self._skip:
+                    self._pool.apply_async(
+                        _run_local, (self.area, path),
+                        callback=self._finished, error_callback=self._next,
+                    )
+                    return
+
+    def _finished(self, result):
+        path, success = result
+        if success:
+            self.finished.append(path)
+        self._next()
+
+    def close(self):
+        with self._lock:
+            self._paths.clear()
+        self._pool.terminate()
+        self._pool.join()
+
+def monitor_hybrid(monitor, lane, sleep=5, request_user_input=True, quiet=False):
+    """
+    Monitor the jobs of monitor's submitter as JobMonitor.monitor_jobs does
+    while lane runs the same tasks locally. Array job elements whose tasks
+    have all finished, at least one locally, are deleted. Return the results.
+    """
+    submitter = monitor.submitter
+    ntotal = monitor.ntasks()
+    pbar_run = tqdm(total=ntotal, desc="Running ", disable=quiet, ncols=80)
+    pbar_fin = tqdm(total=ntotal, desc="Finished", disable=quiet, ncols=80)
+
+    killed = set()
+    for running, results in monitor.return_finished_jobs(request_user_input=request_user_input):
+        local = set(lane.finished)
+        lane.skip(
+            task for tasks in submitter.jobid_tasks.values() for task in tasks
+            if results[pack.task_position(task)] is not None
+        )
+        redundant = [
+            jobid for jobid, tasks in submitter.jobid_tasks.items()
+            if jobid not in killed and any(task in local for task in tasks)
+            and all(
+                task in local or results[pack.task_position(task)] is not None
+                for task in tasks
+            )
+        ]
+        if len(redundant) > 0:
+            logger.debug("Deleting {} jobs finished locally".format(len(redundant)))
+            submitter.kill(redundant)
+            killed.update(redundant)
+
+        pbar_run.n = len(running)
+        pbar_fin.n = len(monitor.completed)
+        pbar_run.refresh()
+        pbar_fin.refresh()
+        if len(monitor.completed) + len(monitor.failed) < ntotal:
+            monitor.wait(monitor.next_sleep(sleep))
+
+    pbar_run.close()
+    pbar_fin.close()
+    if not quiet:
+        print("")
+    logger.info("{} of {} tasks finished locally".format(len(lane.finished), ntotal))
+    return results
@@ -1,11 +1,18 @@
 import os
-import dill
-import gzip
+import queue
 import logging
 from tqdm.auto import tqdm
 from .area import WorkingArea
-from .submitter import SGETaskSubmitter, MPTaskSubmitter
+from .submitter import SGETaskSubmitter, PilotSubmitter, MPTaskSubmitter
 from .monitor import JobMonitor
+from .results import LazyResults, load_result
+from .cache import ResultCache
+from .journal import Journal
+from .completion import RESULT_FILE
+from .pack import task_position, ResultIndex
+from .executor import SGEExecutor, TaskFailed
+from . import dag
+from . import hybrid
 
 logger = logging.getLogger(__name__)
 
@@ -17,10 +24,177 @@ def _validate_tasks(tasks):
             return False
     return True
 
+def _tasks_per_job(tasks, tasks_per_job, target_job_seconds):
+    if target_job_seconds is None:
+        return max(1, int(tasks_per_job))
+
+    seconds = [task["seconds"] for task in tasks if "seconds" in task]
+    if len(seconds) == 0:
+        logger.warning(
+            "target_job_seconds given but no task has a 'seconds' estimate. "
+            "Using tasks_per_job={}".format(tasks_per_job)
+        )
+        return max(1, int(tasks_per_job))
+    mean_seconds = float(sum(seconds)) / len(seconds)
+    if mean_seconds <= 0.:
+        return len(tasks)
+    return max(1, int(target_job_seconds // mean_seconds))
+
+def _reduce_files(reducer, paths):
+    """Reduce the results in paths holding at most two in memory"""
+    reduced = load_result(paths[0])
+    for path in paths[1:]:
+        reduced = reducer(reduced, load_result(path))
+    return reduced
+
+def _check_reduced(label, ntasks, indices):
+    """Raise TaskFailed unless the result of every task is being reduced"""
+    failed = sorted(set(range(ntasks)) - set(indices))
+    if len(failed) > 0:
+        raise TaskFailed(
+            "{} of {} tasks of {} failed, not reducing: {}".format(
+                len(failed), ntasks, label, failed,
+            )
+        )
+
+def _cache_lookup(cache, tasks):
+    """
+    Return (cache, results, indices of the tasks to run) with the paths to
+    the cached results of tasks filled in, or (None, None, all indices)
+    without a cache. cache is a ResultCache or the path to one.
+    """
+    if cache is None:
+        return None, None, list(range(len(tasks)))
+    if len(dag.dependencies(tasks)) > 0:
+        raise ValueError("Tasks with dependencies can't be cached")
+    if not isinstance(cache, ResultCache):
+        cache = ResultCache(cache)
+    results = [cache.get(task) for task in tasks]
+    misses = [idx for idx, path in enumerate(results) if path is None]
+    logger.info("Found {} of {} results in the cache".format(
+        len(tasks)-len(misses), len(tasks),
+    ))
+    return cache, results, misses
+
+def _cache_store(cache, tasks, cached, misses, results, files=True):
+    """
+    Store the results of the tasks run (their result files if files is True)
+    in the cache and merge them with the cached results.
+    """
+    if cache is None:
+        return results
+    for idx, result in zip(misses, results):
+        cached[idx] = result
+        if files and result is not None:
+            cache.put_file(tasks[idx], result)
+        elif not files:
+            cache.put(tasks[idx], result)
+    cache.evict()
+    return cached
+
+def _reattach(area, submitter, monitor, state, request_user_input=True):
+    """
+    Continue the run of a working area from its journal's state: tasks are
+    monitored under the job ids they were last submitted with, the finished
+    tasks are skipped without touching their files, the tasks given up on are
+    reported as failed without being resubmitted and tasks never submitted
+    are submitted.
+    """
+    results = [None]*len(area.task_paths)
+    refs = ResultIndex(area.path).update() if area.layout == "packed" else {}
+    unsubmitted, failed = [], []
+    for task in area.task_paths:
+        pos = task_position(task)
+        if pos in state.finished:
+            # results in a packed area are found in its result indices
+            if area.layout == "dirs":
+                results[pos] = os.path.join(task, RESULT_FILE)
+            else:
+                results[pos] = refs.get(pos)
+            continue
+        if pos in state.failed:
+            failed.append(pos)
+            continue
+        if pos not in state.jobs:
+            unsubmitted.append(task)
+            continue
+        jobid, job_options = state.jobs[pos]
+        submitter.jobid_tasks.setdefault(jobid, []).append(task)
+        submitter._task_jobs[task] = jobid
+        if monitor.retry_policy is not None:
+            monitor.retry_policy.attempts[task] = state.attempts[pos] - 1
+            monitor.retry_policy.task_options[task] = job_options
+    logger.info("Resuming: {} finished, {} failed, {} submitted, {} unsubmitted tasks".format(
+        len(state.finished), len(failed),
+        sum(len(tasks) for tasks in submitter.jobid_tasks.values()),
+        len(unsubmitted),
+    ))
+    monitor.resume(results, failed=failed)
+    submitter.submit_task_list(unsubmitted, request_user_input=request_user_input)
+
+def _sge_submitter(label, options, area, pilots=None, monitor_kw={}, submitter_kw={}):
+    job_options = " ".join(['-N {}'.format(label), options])
+    if pilots is None:
+        return SGETaskSubmitter(job_options, journal=Journal(area.path), **submitter_kw)
+    if monitor_kw.get("speculate") is not None:
+        raise ValueError("speculate can't be used with pilots")
+    return PilotSubmitter(job_options, pilots, journal=Journal(area.path), **submitter_kw)
+
+def _create_and_submit(
+    area, submitter, tasks, dryrun=False, quiet=False,
+    dill_kw={"recurse": False}, tasks_per_job=1, target_job_seconds=None,
+    area_ncores=1, area_pool="process", area_chunksize=None, dedup=False,
+    oob_min_size=None,
+):
+    tasks_per_job = _tasks_per_job(tasks, tasks_per_job, target_job_seconds)
+    deps = dag.dependencies(tasks)
+    if len(deps) > 0:
+        if isinstance(submitter, PilotSubmitter):
+            raise ValueError("Tasks with dependencies can't be run by pilots")
+        if submitter.max_shards is not None:
+            # held back shards have no job id to hold their dependents on
+            raise ValueError("Tasks with dependencies can't be used with max_shards")
+        # all tasks are written before submitting the levels of the graph,
+        # each held on the jobs of the one before
+        task_paths = []
+        for _, paths in area.create_areas_iter(
+            tasks, quiet=quiet, dill_kw=dill_kw, ncores=area_ncores, pool=area_pool,
+            dedup=dedup, oob_min_size=oob_min_size,
+        ):
+            task_paths.extend(paths)
+        dag.write_dependencies(area.path, deps)
+        submitter.dependencies = {
+            task_paths[idx]: [task_paths[dep] for dep in task_deps]
+            for idx, task_deps in deps.items()
+        }
+        for level in dag.levels(len(tasks), deps):
+            submitter.submit_dependent(
+                [task_paths[idx] for idx in level], dryrun=dryrun, quiet=quiet,
+                tasks_per_job=tasks_per_job,
+            )
+        return
+
+    if area_chunksize is not None:
+        # chunks must align with the bundles of each array job
+        area_chunksize = tasks_per_job*max(1, -(-area_chunksize // tasks_per_job))
+
+    for start, task_paths in area.create_areas_iter(
+        tasks, quiet=quiet, dill_kw=dill_kw, ncores=area_ncores, pool=area_pool,
+        chunksize=area_chunksize, dedup=dedup, oob_min_size=oob_min_size,
+    ):
+        submitter.submit_tasks(
+            task_paths, start=start, dryrun=dryrun, quiet=quiet,
+            tasks_per_job=tasks_per_job,
+        )
+
 def sge_submit(
     tasks, label, tmpdir, options="-q hep.q", dryrun=False, quiet=False,
     sleep=5, request_resubmission_options=True, return_files=False,
-    dill_kw={"recurse": False},
+    dill_kw={"recurse": False}, tasks_per_job=1, target_job_seconds=None,
+    area_ncores=1, area_pool="process", area_chunksize=None, dedup=False,
+    monitor_kw={},
+    lazy=False, cache=None, oob_min_size=None, layout="dirs", pilots=None,
+    codec="dill+gzip", submitter_kw={},
 ):
     """
     Submit jobs to an SGE batch system. Return a list of the results of each
@@ -30,7 +204,13 @@ def sge_submit(
     ----------
     tasks : list
         A list of dictrionaries with the keys: task, args and kwargs. Each
-        element is run on a node as task(*args, **kwargs).
+        element is run on a node as task(*args, **kwargs). A pysge.ResultOf(i)
+        in the args or kwargs is replaced by the result of task i (an earlier
+        task) on the node. Such tasks are held by the batch system
+        (-hold_jid, or -hold_jid_ad when the tasks they depend on are all run
+        by one element of an array job) until the jobs running their
+        dependencies have finished. A task whose dependency failed fails too
+        and is resubmitted, held on the dependency's resubmission.
 
     label : str
         Label given to the qsub submission script through -N.
@@ -66,6 +246,92 @@ def sge_submit(
 
     dill_kw : dict
         Kwargs to pass to dill.dump
+
+    tasks_per_job : int (default = 1)
+        Number of tasks bundled into a single array job. The tasks of a bundle
+        are run by one python process in sequence (or forked over the job's
+        allocated slots) and each task still writes its own result. Only the
+        failed tasks of a bundle are resubmitted.
+
+    target_job_seconds : float or None (default = None)
+        If set, overrides tasks_per_job such that each bundle runs for roughly
+        this long. Uses the optional 'seconds' key of each task as an estimate
+        of its runtime.
+
+    area_ncores : int (default = 1)
+        Number of workers used to dill and write the tasks to the working area.
+
+    area_pool : str (default = "process")
+        Pool of the area_ncores workers, "process" (forked processes, which
+        dill in parallel) or "thread" (threads, which only overlap the
+        compression and writing since dill holds the GIL).
+
+    area_chunksize : int or None (default = None)
+        Submit the tasks in chunks of this size as soon as each chunk is
+        written to disk, so the first jobs are queued while the rest of the
+        working area is still being created. None submits all tasks at once.
+
+    dedup : bool (default = False)
+        Store identical callables and arguments shared between tasks once in
+        the working area (keyed by their hash) instead of in every task file.
+
+    monitor_kw : dict
+        Kwargs to pass to JobMonitor, e.g. query="xml", max_sleep or
+        retry_policy=RetryPolicy() for unattended runs.
+
+    lazy : bool or dict (default = False)
+        Return a LazyResults sequence which loads each result file when it's
+        accessed instead of a list. A dict is passed as kwargs to LazyResults
+        (e.g. cache_size, cache_bytes, prefetch).
+
+    cache : ResultCache, str or None (default = None)
+        Look up the result of each task in this ResultCache (or one at this
+        path) and only submit the tasks that aren't cached. The results of the
+        tasks run are stored in the cache.
+
+    oob_min_size : int or None (default = None)
+        Write numpy arrays of at least this many bytes in the tasks and their
+        results uncompressed to separate buffer files (pickle protocol 5
+        out-of-band buffers) instead of dilling and gzipping them. The worker
+        and load_result memory-map these files, so only the parts of the
+        arrays used are read.
+
+    layout : str (default = "dirs")
+        Layout of the working area. "dirs" creates a directory per task with
+        its dilled task, result and logs. "packed" appends the tasks to a few
+        pack files with an index, and each array job element writes its
+        results and logs to a pack and log files sharded by task position,
+        which keeps the number of files small for large submissions (best
+        with tasks_per_job > 1). With return_files the results are then
+        PackRefs, which load_result accepts. Not compatible with
+        oob_min_size.
+
+    pilots : int or None (default = None)
+        Submit this many pilot jobs instead of a job per task (or bundle).
+        The tasks are put in a work queue in the working area and each pilot
+        runs tasks claimed from it in one python process until it's empty,
+        so the imports are paid once per pilot and faster nodes run more
+        tasks. Tasks claimed by pilots which die are put back in the queue
+        and new pilots submitted. tasks_per_job and target_job_seconds are
+        ignored. sge_resume runs the tasks still queued as array jobs.
+
+    codec : str (default = "dill+gzip")
+        How tasks and results are serialized and compressed:
+        "<serializer>+<compression>[:<level>]" with serializer dill or pickle
+        (protocol 5, faster but only for callables importable by reference:
+        a ValueError is raised up front for lambdas, closures and functions
+        defined in __main__) and compression none, gzip, lz4 or zstd (the
+        last two need the lz4 or zstandard package), e.g. "pickle+none" or
+        "pickle+zstd:3". Recorded in the working area so the workers and
+        sge_resume use it. See benchmarks/bench_codecs.py for the trade-offs.
+
+    submitter_kw : dict
+        Kwargs to pass to SGETaskSubmitter: shard_size splits array jobs into
+        shards of at most this many elements (e.g. the cluster's
+        max_aj_tasks) and max_shards keeps at most this many shards waiting
+        in the queue, submitting the others as earlier shards start running,
+        e.g. {"shard_size": 1000, "max_shards": 4}. qsub_retries sets how
+        often a rejected qsub is retried before raising a RuntimeError.
     """
     if not _validate_tasks(tasks):
         logger.error(
@@ -73,33 +339,52 @@ def sge_submit(
             "'kwargs': {..}}, ...], where 'task' is callable."
         )
         return []
-    area = WorkingArea(os.path.abspath(tmpdir))
-    submitter = SGETaskSubmitter(" ".join(['-N {}'.format(label), options]))
-    monitor = JobMonitor(submitter)
+    cache, cached, misses = _cache_lookup(cache, tasks)
+    run_tasks = [tasks[idx] for idx in misses]
 
     results = []
-    area.create_areas(tasks, quiet=quiet, dill_kw=dill_kw)
-    try:
-        submitter.submit_tasks(area.task_paths, dryrun=dryrun, quiet=quiet)
-        if not dryrun:
-            results = monitor.monitor_jobs(
-                sleep=sleep, request_user_input=request_resubmission_options,
+    if len(run_tasks) > 0:
+        area = WorkingArea(os.path.abspath(tmpdir), layout=layout, codec=codec)
+        submitter = _sge_submitter(
+            label, options, area, pilots=pilots, monitor_kw=monitor_kw,
+            submitter_kw=submitter_kw,
+        )
+        monitor = JobMonitor(submitter, **monitor_kw)
+        if pilots is not None or submitter.max_shards is not None:
+            # tasks are submitted over time, so the monitor expects them all
+            monitor.resume([None]*len(run_tasks))
+        try:
+            _create_and_submit(
+                area, submitter, run_tasks, dryrun=dryrun, quiet=quiet,
+                dill_kw=dill_kw, tasks_per_job=tasks_per_job,
+                target_job_seconds=target_job_seconds, area_ncores=area_ncores,
+                area_pool=area_pool,
+                area_chunksize=area_chunksize, dedup=dedup,
+                oob_min_size=oob_min_size,
             )
-    except KeyboardInterrupt as e:
-        submitter.killall()
+            if not dryrun:
+                results = monitor.monitor_jobs(
+                    sleep=sleep, request_user_input=request_resubmission_options,
+                    quiet=quiet,
+                )
+        except KeyboardInterrupt as e:
+            submitter.killall()
+    if not dryrun:
+        results = _cache_store(cache, tasks, cached, misses, results)
 
     if return_files:
         return results
 
-    results_not_files = []
-    for path in results:
-        with gzip.open(path, 'rb') as f:
-            results_not_files.append(dill.load(f))
-    return results_not_files
+    if lazy:
+        return LazyResults(results, **(lazy if isinstance(lazy, dict) else {}))
+    return [load_result(path) if path is not None else None for path in results]
 
 def sge_submit_yield(
     tasks, label, tmpdir, options="-q hep.q", quiet=False, sleep=5,
     request_resubmission_options=True, dill_kw={"recurse": False},
+    tasks_per_job=1, target_job_seconds=None, area_ncores=1, area_pool="process",
+    area_chunksize=None, dedup=False, monitor_kw={}, oob_min_size=None,
+    layout="dirs", pilots=None, codec="dill+gzip", submitter_kw={},
 ):
     """
     Submit jobs to an SGE batch system. No monitoring is perfomed and the
@@ -141,6 +426,41 @@ def sge_submit_yield(
 
     dill_kw : dict
         Kwargs to pass to dill.dump
+
+    tasks_per_job : int (default = 1)
+        Number of tasks bundled into a single array job. The tasks of a bundle
+        are run by one python process in sequence (or forked over the job's
+        allocated slots) and each task still writes its own result. Only the
+        failed tasks of a bundle are resubmitted.
+
+    target_job_seconds : float or None (default = None)
+        If set, overrides tasks_per_job such that each bundle runs for roughly
+        this long. Uses the optional 'seconds' key of each task as an estimate
+        of its runtime.
+
+    area_ncores : int (default = 1)
+        Number of workers used to dill and write the tasks to the working area.
+
+    area_pool : str (default = "process")
+        Pool of the area_ncores workers, "process" (forked processes, which
+        dill in parallel) or "thread" (threads, which only overlap the
+        compression and writing since dill holds the GIL).
+
+    area_chunksize : int or None (default = None)
+        Submit the tasks in chunks of this size as soon as each chunk is
+        written to disk, so the first jobs are queued while the rest of the
+        working area is still being created. None submits all tasks at once.
+
+    dedup : bool (default = False)
+        Store identical callables and arguments shared between tasks once in
+        the working area (keyed by their hash) instead of in every task file.
+
+    monitor_kw : dict
+        Kwargs to pass to JobMonitor, e.g. query="xml", max_sleep or
+        retry_policy=RetryPolicy() for unattended runs.
+
+    oob_min_size, layout, pilots, codec, submitter_kw
+        See sge_submit.
     """
 
     if not _validate_tasks(tasks):
@@ -149,25 +469,371 @@ def sge_submit_yield(
             "'kwargs': {..}}, ...], where 'task' is callable."
         )
         return []
-    area = WorkingArea(os.path.abspath(tmpdir))
-    submitter = SGETaskSubmitter(" ".join(['-N {}'.format(label), options]))
-    monitor = JobMonitor(submitter)
+    area = WorkingArea(os.path.abspath(tmpdir), layout=layout, codec=codec)
+    submitter = _sge_submitter(
+        label, options, area, pilots=pilots, monitor_kw=monitor_kw,
+        submitter_kw=submitter_kw,
+    )
+    monitor = JobMonitor(submitter, **monitor_kw)
+    if pilots is not None or submitter.max_shards is not None:
+        # tasks are submitted over time, so the monitor expects them all
+        monitor.resume([None]*len(tasks))
 
-    area.create_areas(tasks, quiet=quiet, dill_kw=dill_kw)
-    submitter.submit_tasks(area.task_paths, quiet=quiet)
+    _create_and_submit(
+        area, submitter, tasks, quiet=quiet, dill_kw=dill_kw,
+        tasks_per_job=tasks_per_job, target_job_seconds=target_job_seconds,
+        area_ncores=area_ncores, area_pool=area_pool,
+        area_chunksize=area_chunksize, dedup=dedup,
+        oob_min_size=oob_min_size,
+    )
     return monitor.request_jobs(
         sleep=sleep, request_user_input=request_resubmission_options,
+        quiet=quiet,
+    )
+
+def sge_as_completed(
+    tasks, label, tmpdir, options="-q hep.q", quiet=False, sleep=5,
+    request_resubmission_options=True, return_files=False,
+    dill_kw={"recurse": False}, tasks_per_job=1, target_job_seconds=None,
+    area_ncores=1, area_pool="process", area_chunksize=None, dedup=False,
+    monitor_kw={},
+    oob_min_size=None, layout="dirs", pilots=None, codec="dill+gzip",
+    submitter_kw={},
+):
+    """
+    Submit jobs to an SGE batch system and return an iterator yielding
+    (index, result) exactly once for each task as soon as it's finished, in
+    the order they finish. index is the position of the task in tasks.
+
+    Parameters
+    ----------
+    tasks : list
+        A list of dictrionaries with the keys: task, args and kwargs. Each
+        element is run on a node as task(*args, **kwargs).
+
+    label : str
+        Label given to the qsub submission script through -N.
+
+    tmpdir : str
+        Path to temporary directory (doesn't have to exist) where pysge stores
+        job infomation. Each call will have a unique identifier in the form
+        tpd_YYYYMMDD_hhmmss_xxxxxxxx. Within this directory exists all tasks in
+        separate directories with a dilled file, stdout and stderr for that
+        particular job.
+
+    options : str (default = "-q hep.q")
+        Additional options to pass to the qsub command. Take care since the
+        following options are already in use: -wd, -V, -e, -o and -t.
+
+    quiet : bool (default = False)
+        Don't print tqdm progress bars. Other prints are controlled by logging.
+
+    sleep : float (default = 5)
+        Minimum time between queries to the batch system.
+
+    request_resubmission_options : bool (default = True)
+        When a job fails the master process will expect an stdin from the user
+        to alter the submission options (e.g. to increase walltime or memory
+        requested). If False it will use the original options.
+
+    return_files : bool (default = False)
+        Yield (index, path) with the path to the output file instead of
+        loading it into python.
+
+    dill_kw : dict
+        Kwargs to pass to dill.dump
+
+    tasks_per_job, target_job_seconds, area_ncores, area_pool, area_chunksize, dedup, oob_min_size, layout, pilots, codec, submitter_kw
+        See sge_submit.
+
+    monitor_kw : dict
+        Kwargs to pass to JobMonitor, e.g. query="xml", max_sleep or
+        retry_policy=RetryPolicy() for unattended runs.
+    """
+    if not _validate_tasks(tasks):
+        logger.error(
+            "Invalid tasks. Ensure tasks=[{'task': .., 'args': [..], "
+            "'kwargs': {..}}, ...], where 'task' is callable."
+        )
+        return
+    area = WorkingArea(os.path.abspath(tmpdir), layout=layout, codec=codec)
+    submitter = _sge_submitter(
+        label, options, area, pilots=pilots, monitor_kw=monitor_kw,
+        submitter_kw=submitter_kw,
+    )
+    monitor = JobMonitor(submitter, **monitor_kw)
+    if pilots is not None or submitter.max_shards is not None:
+        # tasks are submitted over time, so the monitor expects them all
+        monitor.resume([None]*len(tasks))
+
+    try:
+        _create_and_submit(
+            area, submitter, tasks, quiet=quiet, dill_kw=dill_kw,
+            tasks_per_job=tasks_per_job, target_job_seconds=target_job_seconds,
+            area_ncores=area_ncores, area_pool=area_pool,
+            area_chunksize=area_chunksize,
+            dedup=dedup, oob_min_size=oob_min_size,
+        )
+    except KeyboardInterrupt as e:
+        submitter.killall()
+        return
+
+    for idx, path in monitor.as_completed(
+        sleep=sleep, request_user_input=request_resubmission_options,
+        quiet=quiet,
+    ):
+        yield idx, (path if return_files else load_result(path))
+
+def sge_map_reduce(
+    tasks, reducer, label, tmpdir, fanin=None, options="-q hep.q",
+    quiet=False, sleep=5, request_resubmission_options=True,
+    dill_kw={"recurse": False}, tasks_per_job=1, target_job_seconds=None,
+    area_ncores=1, area_pool="process", area_chunksize=None, dedup=False,
+    monitor_kw={},
+    oob_min_size=None, layout="dirs", pilots=None, codec="dill+gzip",
+    submitter_kw={},
+):
+    """
+    Submit jobs to an SGE batch system and reduce their results with
+    reducer(a, b) -> c. Return the reduced result (None if there are no
+    tasks). Results are reduced in the order the tasks finish, hence the
+    reducer must be associative and commutative (e.g. summing histograms).
+    Raise TaskFailed if any task (or reduction job) failed and was given up
+    on, rather than return a reduction of only some of the results.
+
+    Parameters
+    ----------
+    tasks : list
+        A list of dictrionaries with the keys: task, args and kwargs. Each
+        element is run on a node as task(*args, **kwargs).
+
+    reducer : callable
+        Binary function merging two results into one.
+
+    label : str
+        Label given to the qsub submission script through -N.
+
+    tmpdir : str
+        Path to temporary directory (doesn't have to exist) where pysge stores
+        job infomation. See sge_submit.
+
+    fanin : int or None (default = None)
+        If None each result is loaded and reduced into a running total in the
+        master process as soon as it's finished. Otherwise the results are
+        reduced by a tree of reduction jobs on the batch system, each merging
+        fanin results and submitted (through an SGEExecutor) as soon as they
+        have finished, so the reduction runs while the tasks are still
+        running. The master only reduces the last fanin results. Either way
+        at most two results are held in memory at once.
+
+    options : str (default = "-q hep.q")
+        Additional options to pass to the qsub command. Take care since the
+        following options are already in use: -wd, -V, -e, -o and -t.
+
+    quiet : bool (default = False)
+        Don't print tqdm progress bars. Other prints are controlled by logging.
+
+    sleep : float (default = 5)
+        Minimum time between queries to the batch system.
+
+    request_resubmission_options : bool (default = True)
+        When a job fails the master process will expect an stdin from the user
+        to alter the submission options (e.g. to increase walltime or memory
+        requested). If False it will use the original options.
+
+    dill_kw : dict
+        Kwargs to pass to dill.dump
+
+    monitor_kw : dict
+        Kwargs to pass to JobMonitor. The reduction jobs are resubmitted
+        without user input, with monitor_kw["retry_policy"] (see
+        SGEExecutor).
+
+    tasks_per_job, target_job_seconds, area_ncores, area_pool, area_chunksize, dedup, oob_min_size, layout, pilots, codec, submitter_kw
+        See sge_submit.
+    """
+    if fanin is not None and fanin < 2:
+        raise ValueError("fanin must be at least 2, not {}".format(fanin))
+
+    completed = sge_as_completed(
+        tasks, label, tmpdir, options=options, quiet=quiet, sleep=sleep,
+        request_resubmission_options=request_resubmission_options,
+        return_files=fanin is not None, dill_kw=dill_kw,
+        tasks_per_job=tasks_per_job, target_job_seconds=target_job_seconds,
+        area_ncores=area_ncores, area_pool=area_pool,
+        area_chunksize=area_chunksize, dedup=dedup,
+        monitor_kw=monitor_kw, oob_min_size=oob_min_size, layout=layout,
+        pilots=pilots, codec=codec, submitter_kw=submitter_kw,
+    )
+    indices = []
+    if fanin is None:
+        reduced, empty = None, True
+        for idx, result in completed:
+            indices.append(idx)
+            reduced = result if empty else reducer(reduced, result)
+            empty = False
+        _check_reduced(label, len(tasks), indices)
+        return reduced
+
+    # the paths to the results waiting to be reduced at each level of the
+    # tree (the map results being level 0) and the reduction jobs running
+    waiting, running = {}, set()
+    done = queue.Queue()
+    executor = None
+
+    def add(level, path):
+        nonlocal executor
+        waiting.setdefault(level, []).append(path)
+        if len(waiting[level]) == fanin:
+            if executor is None:
+                executor = SGEExecutor(
+                    "{}_reduce".format(label), tmpdir, options=options,
+                    sleep=sleep, return_files=True, dill_kw=dill_kw,
+                    monitor_kw=monitor_kw, oob_min_size=oob_min_size,
+                    layout=layout, codec=codec,
+                )
+            future = executor.submit(_reduce_files, reducer, waiting.pop(level))
+            running.add(future)
+            future.add_done_callback(lambda f: done.put((level+1, f)))
+
+    def collect(block):
+        while len(running) > 0:
+            try:
+                level, future = done.get(block=block)
+            except queue.Empty:
+                return
+            running.discard(future)
+            add(level, future.result())
+
+    try:
+        for idx, path in completed:
+            indices.append(idx)
+            add(0, path)
+            collect(block=False)
+        _check_reduced(label, len(tasks), indices)
+        collect(block=True)
+        # reduce the partial groups left at every level
+        paths = [path for level in sorted(waiting) for path in waiting[level]]
+        while len(paths) > fanin:
+            waiting = {}
+            for path in paths:
+                add(0, path)
+            collect(block=True)
+            paths = [path for level in sorted(waiting) for path in waiting[level]]
+    except BaseException:
+        if executor is not None:
+            executor.killall()
+        raise
+    if executor is not None:
+        executor.shutdown()
+    if len(paths) == 0:
+        return None
+    return _reduce_files(reducer, paths)
+
+def sge_hybrid_submit(
+    tasks, label, tmpdir, options="-q hep.q", ncores=4, local_max_seconds=None,
+    quiet=False, sleep=5, request_resubmission_options=True,
+    return_files=False, dill_kw={"recurse": False}, tasks_per_job=1,
+    target_job_seconds=None, area_ncores=1, area_pool="process", dedup=False,
+    monitor_kw={},
+    lazy=False, oob_min_size=None, layout="dirs", codec="dill+gzip",
+    submitter_kw={}, start_method=None,
+):
+    """
+    Submit jobs to an SGE batch system and, while they're queued, run the
+    same tasks on a local process pool, cheapest first. Whichever runs a
+    task first wins: its result is kept, the other copy's dropped and array
+    job elements whose tasks have all finished locally are deleted. Return a
+    list of the results of each task, as sge_submit.
+
+    The cost of each task is its optional 'seconds' key, or else the median
+    runtime of its function in earlier runs with the same tmpdir (learned
+    from the task metrics of each run and kept in tmpdir/costs.json).
+
+    Parameters
+    ----------
+    tasks, label, tmpdir, options
+        See sge_submit.
+
+    ncores : int (default = 4)
+        Number of local processes running tasks.
+
+    local_max_seconds : float or None (default = None)
+        Only run tasks estimated to take at most this long locally, leaving
+        the longer ones to the batch system. Tasks without an estimate are
+        run locally after those with one.
+
+    start_method : str or None (default = None)
+        multiprocessing start method of the local pool ("fork", "forkserver"
+        or "spawn").
+
+    quiet, sleep, request_resubmission_options, return_files, dill_kw, tasks_per_job, target_job_seconds, area_ncores, area_pool, dedup, monitor_kw, lazy, oob_min_size, layout, codec, submitter_kw
+        See sge_submit.
+    """
+    if not _validate_tasks(tasks):
+        logger.error(
+            "Invalid tasks. Ensure tasks=[{'task': .., 'args': [..], "
+            "'kwargs': {..}}, ...], where 'task' is callable."
+        )
+        return []
+
+    area = WorkingArea(os.path.abspath(tmpdir), layout=layout, codec=codec)
+    submitter = _sge_submitter(
+        label, options, area, monitor_kw=monitor_kw, submitter_kw=submitter_kw,
+    )
+    monitor = JobMonitor(submitter, **monitor_kw)
+    monitor.resume([None]*len(tasks))
+    costs = hybrid.estimate_costs(tasks, hybrid.load_costs(tmpdir))
+    # tasks with dependencies wait for the batch to run what they depend on
+    order = hybrid.local_order(
+        costs, max_seconds=local_max_seconds, exclude=dag.dependencies(tasks),
     )
 
+    results, lane = [], None
+    try:
+        _create_and_submit(
+            area, submitter, tasks, quiet=quiet, dill_kw=dill_kw,
+            tasks_per_job=tasks_per_job, target_job_seconds=target_job_seconds,
+            area_ncores=area_ncores, area_pool=area_pool, dedup=dedup,
+            oob_min_size=oob_min_size,
+        )
+        lane = hybrid.LocalLane(
+            area.path, [area.task_paths[idx] for idx in order], ncores=ncores,
+            start_method=start_method,
+        )
+        results = hybrid.monitor_hybrid(
+            monitor, lane, sleep=sleep,
+            request_user_input=request_resubmission_options, quiet=quiet,
+        )
+    except KeyboardInterrupt as e:
+        submitter.killall()
+    finally:
+        if lane is not None:
+            lane.close()
+    hybrid.update_costs(tmpdir, area.path, [hybrid.task_name(task) for task in tasks])
+
+    if return_files:
+        return results
+
+    if lazy:
+        return LazyResults(results, **(lazy if isinstance(lazy, dict) else {}))
+    return [load_result(path) if path is not None else None for path in results]
+
 def sge_resume(
     label, tmpdir, options="-q hep.q", quiet=False, sleep=5,
-    request_resubmission_options=True, return_files=False,
+    request_resubmission_options=True, return_files=False, monitor_kw={},
+    lazy=False, submitter_kw={},
 ):
     """
     Resubmit jobs based on the temporary directory (with the tpd_*
     subdirectory). The original submission may terminate due to unforseen
     reasons. This will continue where everything left off.
 
+    The journal of the working area is replayed to reattach to the jobs
+    still queued or running and to skip the finished tasks without reading
+    their files. Working areas without a journal have all their tasks
+    checked and the unfinished ones resubmitted.
+
     Parameters
     ----------
     label : str
@@ -194,17 +860,46 @@ def sge_resume(
     return_files : bool (default = False)
         Instead of opening the output files and loading them into python, just
         send the paths to the output files and let the user deal with them.
+
+    monitor_kw : dict
+        Kwargs to pass to JobMonitor, e.g. query="xml", max_sleep or
+        retry_policy=RetryPolicy() for unattended runs.
+
+    lazy : bool or dict (default = False)
+        Return a LazyResults sequence which loads each result file when it's
+        accessed instead of a list. A dict is passed as kwargs to LazyResults
+        (e.g. cache_size, cache_bytes, prefetch).
+
+    submitter_kw : dict
+        Kwargs to pass to SGETaskSubmitter, e.g. shard_size and max_shards.
+        See sge_submit.
     """
     area = WorkingArea(os.path.abspath(tmpdir), resume=True)
-    submitter = SGETaskSubmitter(" ".join(['-N {}'.format(label), options]))
-    for idx in range(len(area.task_paths)):
-        submitter.jobid_tasks['{}'.format(idx)] = area.task_paths[idx]
-    monitor = JobMonitor(submitter)
+    journal = Journal(area.path)
+    submitter = SGETaskSubmitter(
+        " ".join(['-N {}'.format(label), options]), journal=journal,
+        **submitter_kw
+    )
+    deps = dag.read_dependencies(area.path)
+    submitter.dependencies = {
+        area.task_paths[idx]: [area.task_paths[dep] for dep in task_deps]
+        for idx, task_deps in deps.items()
+    }
+    monitor = JobMonitor(submitter, **monitor_kw)
 
     results = []
     try:
+        if journal.exists():
+            _reattach(
+                area, submitter, monitor, journal.replay(),
+                request_user_input=request_resubmission_options,
+            )
+        else:
+            for idx in range(len(area.task_paths)):
+                submitter.jobid_tasks['{}'.format(idx)] = [area.task_paths[idx]]
         results = monitor.monitor_jobs(
             sleep=sleep, request_user_input=request_resubmission_options,
+            quiet=quiet,
         )
     except KeyboardInterrupt as e:
         submitter.killall()
@@ -212,19 +907,21 @@ def sge_resume(
     if return_files:
         return results
 
-    results_not_files = []
-    for path in results:
-        with gzip.open(path, 'rb') as f:
-            results_not_files.append(dill.load(f))
-    return results_not_files
+    if lazy:
+        return LazyResults(results, **(lazy if isinstance(lazy, dict) else {}))
+    return [load_result(path) if path is not None else None for path in results]
 
-def mp_submit(tasks, ncores=4, quiet=False):
+def mp_submit(
+    tasks, ncores=4, quiet=False, chunksize=None, persistent=False,
+    start_method=None, cache=None,
+):
     """
-    Submit multiprocessing jobs. Each task spawns a new child process which is
-    run on an available core. In multiprocessing mode the functions are
-    pickled and sent to each core, hence this is good at testing small scale
-    local submission before submitting to the batch. Return a list of the
-    results of each job (i.e. the return values of the function calls)
+    Submit multiprocessing jobs. Tasks are dilled and dispatched in chunks to
+    a pool of processes running on the available cores. In multiprocessing
+    mode the functions are pickled and sent to each core, hence this is good
+    at testing small scale local submission before submitting to the batch.
+    Return a list of the results of each job (i.e. the return values of the
+    function calls)
 
     Parameters
     ----------
@@ -237,6 +934,21 @@ def mp_submit(tasks, ncores=4, quiet=False):
 
     quiet : bool (default = False)
         Don't print tqdm progress bars. Other prints are controlled by logging.
+
+    chunksize : int or None (default = None)
+        Number of tasks sent to a process at a time. If None it's chosen such
+        that each core receives about 4 chunks.
+
+    persistent : bool (default = False)
+        Keep the pool of processes alive and reuse it in later calls with the
+        same ncores and start_method.
+
+    start_method : str or None (default = None)
+        multiprocessing start method of the pool, e.g. "fork" or
+        "forkserver". None uses the platform default.
+
+    cache : ResultCache, str or None (default = None)
+        See sge_submit.
     """
     if not _validate_tasks(tasks):
         logger.error(
@@ -244,10 +956,63 @@ def mp_submit(tasks, ncores=4, quiet=False):
             "'kwargs': {..}}, ...], where 'task' is callable."
         )
         return []
+    cache, cached, misses = _cache_lookup(cache, tasks)
+    submitter = MPTaskSubmitter()
+    try:
+        results = [
+            result for _, result in submitter.iter_tasks(
+                [tasks[idx] for idx in misses], ncores=ncores, quiet=quiet,
+                chunksize=chunksize, persistent=persistent,
+                start_method=start_method,
+            )
+        ]
+    except KeyboardInterrupt:
+        return []
+    if cached is None:
+        return results
+    cached = [load_result(path) if path is not None else None for path in cached]
+    return _cache_store(cache, tasks, cached, misses, results, files=False)
+
+def mp_as_completed(
+    tasks, ncores=4, quiet=False, ordered=False, chunksize=None,
+    persistent=False, start_method=None,
+):
+    """
+    Submit multiprocessing jobs and return an iterator yielding (index,
+    result) for each task as soon as it's finished.
+
+    Parameters
+    ----------
+    tasks : list
+        A list of dictrionaries with the keys: task, args and kwargs. Each
+        element is run on a node as task(*args, **kwargs).
+
+    ncores : int
+        The number of cores to run on.
+
+    quiet : bool (default = False)
+        Don't print tqdm progress bars. Other prints are controlled by logging.
+
+    ordered : bool (default = False)
+        Yield the results in the order of tasks instead of the order they
+        finish.
+
+    chunksize, persistent, start_method
+        See mp_submit.
+    """
+    if not _validate_tasks(tasks):
+        logger.error(
+            "Invalid tasks. Ensure tasks=[{'task': .., 'args': [..], "
+            "'kwargs': {..}}, ...], where 'task' is callable."
+        )
+        return iter([])
     submitter = MPTaskSubmitter()
-    return submitter.submit_tasks(tasks, ncores=ncores, quiet=quiet)
+    return submitter.iter_tasks(
+        tasks, ncores=ncores, quiet=quiet, chunksize=chunksize,
+        ordered=ordered, persistent=persistent, start_method=start_method,
+    )
 
-def local_submit(tasks, quiet=False):
+def local_submit(tasks, quiet=False, cache=None):
     """
     Submit local jobs. Mainly for testing purposes.
 
@@ -259,6 +1024,9 @@ def local_submit(tasks, quiet=False):
 
     quiet : bool (default = False)
         Don't print tqdm progress bars. Other prints are controlled by logging.
+
+    cache : ResultCache, str or None (default = None)
+        See sge_submit.
     """
     if not _validate_tasks(tasks):
         logger.error(
@@ -266,16 +1034,21 @@ def local_submit(tasks, quiet=False):
             "'kwargs': {..}}, ...], where 'task' is callable."
         )
         return []
+    cache, cached, misses = _cache_lookup(cache, tasks)
 
     results = []
-    pbar = tqdm(total=len(tasks), desc="Finished", disable=quiet, ncols=80)
+    pbar = tqdm(total=len(misses), desc="Finished", disable=quiet, ncols=80)
 
     try:
-        for t in tasks:
+        for t in (tasks[idx] for idx in misses):
             results.append(t["task"](*t["args"], **t["kwargs"]))
             pbar.update()
     except KeyboardInterrupt:
-        results = []
+        pbar.close()
+        return []
 
     pbar.close()
-    return results
+    if cached is None:
+        return results
+    cached = [load_result(path) if path is not None else None for path in cached]
+    return _cache_store(cache, tasks, cached, misses, results, files=False)
@@ -0,0 +1,88 @@
+import os
+import json
+import time
+import logging
+from .pack import task_position
+logger = logging.getLogger(__name__)
+
+JOURNAL_FILE = "journal.jsonl"
+
+class JournalState(object):
+    """State of a working area replayed from its journal"""
+    def __init__(self):
+        # position -> (job id "jobnumber.taskid", job options) of the last
+        # submission of each task
+        self.jobs = {}
+        # position -> number of submissions
+        self.attempts = {}
+        self.finished = set()
+        self.failed = set()
+
+class Journal(object):
+    """
+    Append-only log of the submissions of a working area and of the tasks
+    found finished or given up on, one json object per line. Replaying it
+    lets a resume reattach to the jobs still in the batch system and skip the
+    finished tasks without touching their files. Lines are only ever
+    appended, which is safe on network filesystems, and a line cut short by
+    a crash is ignored.
+    """
+    def __init__(self, area):
+        self.path = os.path.join(area, JOURNAL_FILE)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def _append(self, record):
+        record["time"] = time.time()
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + "\n")
+
+    def submitted(self, jobnumber, first, bundles, job_options):
+        """
+        Record the array job jobnumber whose element first+i runs the tasks
+        in bundles[i].
+        """
+        self._append({
+            "event": "submit", "job": jobnumber, "first": first,
+            "tasks": [[task_position(task) for task in bundle] for bundle in bundles],
+            "options": job_options,
+        })
+
+    def finished(self, positions):
+        if len(positions) > 0:
+            self._append({"event": "finished", "tasks": list(positions)})
+
+    def failed(self, positions):
+        """Record tasks given up on"""
+        if len(positions) > 0:
+            self._append({"event": "failed", "tasks": list(positions)})
+
+    def replay(self):
+        """Return the JournalState of the working area"""
+        state = JournalState()
+        try:
+            with open(self.path, 'r') as f:
+                lines = f.readlines()
+        except (IOError, OSError):
+            return state
+
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logger.warning("Skipping malformed journal line in {}".format(self.path))
+                continue
+            event = record.get("event")
+            if event == "submit":
+                for aid, bundle in enumerate(record["tasks"]):
+                    jobid = "{}.{}".format(record["job"], record["first"]+aid)
+                    for pos in bundle:
+                        state.jobs[pos] = (jobid, record["options"])
+                        state.attempts[pos] = state.attempts.get(pos, 0) + 1
+                        state.failed.discard(pos)
+            elif event == "finished":
+                state.finished.update(record["tasks"])
+            elif event == "failed":
+                state.failed.update(record["tasks"])
+        return state
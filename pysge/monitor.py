@@ -1,11 +1,15 @@
 import os
 import logging
-import gzip
 import time
 import copy
-import dill
+import statistics
+import getpass
+import xml.etree.ElementTree as ET
 from tqdm.auto import tqdm
 from .utils import run_command
+from .completion import result_complete, RESULT_FILE, DONE_DIR
+from .watcher import make_watcher
+from . import pack
 logger = logging.getLogger(__name__)
 
 SGE_JOBSTATUS = {
@@ -44,98 +48,487 @@ SGE_JOBSTATE_CODES = {
     "dr": 5, "dt": 5, "dRr": 5, "ds": 5, "dS": 5, "dT": 5, "dRs": 5, "dRS": 5, "dRT": 5,
 }
 
+def _query_succeeded(out, err, returncode):
+    """
+    Whether a qstat call can be trusted. An empty listing with errors means
+    the query failed rather than that no jobs are left.
+    """
+    if returncode != 0 or (len(out.strip()) == 0 and len(err.strip()) > 0):
+        logger.warning("qstat failed ({}): {}".format(
+            returncode, err.decode('utf-8', 'replace').strip(),
+        ))
+        return False
+    return True
+
+def _expand_tasks(tasks):
+    """Expand an SGE task range string, e.g. '1-9:2,12', into task ids"""
+    if tasks is None:
+        return []
+    taskids = []
+    for trange in tasks.split(","):
+        if "-" not in trange:
+            taskids.append(int(trange))
+            continue
+        trange, _, step = trange.partition(":")
+        start, stop = trange.split("-")
+        taskids.extend(range(int(start), int(stop)+1, int(step or 1)))
+    return taskids
+
 class JobMonitor(object):
-    def __init__(self, submitter):
+    def __init__(
+        self, submitter, verify_checksum=False, query="plain", user=None,
+        max_sleep=None, watcher=None, qstat_interval=60, retry_policy=None,
+        speculate=None, speculate_min_finished=10,
+    ):
+        """
+        Parameters
+        ----------
+        submitter : SGETaskSubmitter
+            Submitter holding the jobs to monitor.
+
+        verify_checksum : bool (default = False)
+            Stream the checksum of each result file instead of only comparing
+            its size with the completion marker.
+
+        query : str (default = "plain")
+            "plain" parses the text output of qstat -g d. "xml" parses the
+            output of qstat -xml in bulk, expanding array task ranges.
+
+        user : str or None (default = None)
+            Only query the jobs of this user. Defaults to the current user.
+
+        max_sleep : float or None (default = None)
+            If set, the time between polls backs off from sleep up to
+            max_sleep while no jobs finish, backing off fastest while all jobs
+            are pending, and resets to sleep when jobs finish.
+
+        watcher : str or None (default = None)
+            Pick up finished tasks from the events dropped by the workers in
+            the working area's done directory as they happen, instead of
+            waiting for the next poll. "inotify", "poll" (for network
+            filesystems) or "auto". qstat is then only used every
+            qstat_interval seconds to catch failed jobs.
+
+        qstat_interval : float (default = 60)
+            Minimum time between queries to the batch system when a watcher
+            is used.
+
+        retry_policy : RetryPolicy or None (default = None)
+            Decides the options failed tasks are resubmitted with, or whether
+            they're given up on, without asking for user input.
+
+        speculate : float or None (default = None)
+            Submit a duplicate of the unfinished tasks of a job once it's been
+            running for this multiple of the median runtime of the finished
+            jobs, so stragglers on slow nodes don't hold up the whole run.
+            Whichever copy finishes first wins and the other is deleted.
+            Runtimes are measured from the first query showing a job running.
+            Not compatible with pilot jobs.
+
+        speculate_min_finished : int (default = 10)
+            Number of jobs which must have finished before speculating.
+        """
         self.submitter = submitter
+        self.verify_checksum = verify_checksum
+        self.query = query
+        self.user = user if user is not None else getpass.getuser()
+        self.max_sleep = max_sleep
+        self.watcher = watcher
+        self.qstat_interval = qstat_interval
+        self.retry_policy = retry_policy
+        self.speculate = speculate
+        self.speculate_min_finished = speculate_min_finished
+        # positions of the tasks in the order their results were found
+        self.completed = []
+        # positions of the tasks given up on by the retry policy
+        self.failed = []
 
-    def monitor_jobs(self, sleep=5, request_user_input=True):
-        jobid_tasks = self.submitter.jobid_tasks
-        ntotal = len(jobid_tasks)
+        self._sleep = None
+        self._nrunning = 0
+        self._npending = 0
+        self._nnew = 0
+        self._watcher = None
+        self._events = []
+        self._job_statuses = {}
+        self._last_query = None
+        self._result_index = None
+        self._initial_results = None
+        self._initial_failed = []
+        # time each job was first seen running and runtimes of the finished
+        # jobs, for speculation
+        self._running_since = {}
+        self._runtimes = []
+        # job id -> job ids of all copies of a speculated job
+        self._copies = {}
+        self._killed = set()
 
-        pbar_run = tqdm(total=ntotal, desc="Running ", ncols=80)
-        pbar_fin = tqdm(total=ntotal, desc="Finished", ncols=80)
+    def resume(self, results, failed=()):
+        """
+        Start from the results of a previous run: a list with an entry per
+        task of the working area, holding the path to the result of the tasks
+        known to be finished and None otherwise, and the positions of the
+        tasks given up on. Only the other tasks are then expected in
+        submitter.jobid_tasks.
+        """
+        self._initial_results = list(results)
+        self._initial_failed = list(failed)
+
+    def ntasks(self):
+        if self._initial_results is not None:
+            return len(self._initial_results)
+        return sum(len(tasks) for tasks in self.submitter.jobid_tasks.values())
+
+    def next_sleep(self, sleep):
+        """Time to wait before the next poll, adapted to the job states"""
+        if self.max_sleep is None or self._sleep is None or self._nnew > 0:
+            self._sleep = sleep
+        elif self._nrunning == 0 and self._npending > 0:
+            # everything is queued - nothing will finish soon
+            self._sleep = min(self._sleep*2, self.max_sleep)
+        elif self._npending > 0:
+            self._sleep = min(self._sleep*1.5, self.max_sleep)
+        else:
+            # draining - the last jobs may finish at any time
+            self._sleep = min(self._sleep*1.2, self.max_sleep)
+        return self._sleep
+
+    def wait(self, timeout):
+        """Wait for up to timeout seconds, returning early on watcher events"""
+        if self._watcher is None:
+            time.sleep(timeout)
+        else:
+            self._events.extend(self._watcher.wait(timeout))
+
+    def collect_events(self, area, results):
+        """Record the tasks the watcher has seen finish"""
+        names, self._events = self._events + self._watcher.poll(), []
+        for name in names:
+            pos = pack.task_position(name)
+            if pos >= len(results) or results[pos] is not None:
+                continue
+            task = os.path.join(area, name)
+            if result_complete(task, verify=self.verify_checksum):
+                results[pos] = os.path.join(task, RESULT_FILE)
+                self.completed.append(pos)
+
+    def monitor_jobs(self, sleep=5, request_user_input=True, quiet=False):
+        ntotal = self.ntasks()
+
+        pbar_run = tqdm(total=ntotal, desc="Running ", disable=quiet, ncols=80)
+        pbar_fin = tqdm(total=ntotal, desc="Finished", disable=quiet, ncols=80)
 
         for running, results in self.return_finished_jobs(request_user_input=request_user_input):
             pbar_run.n = len(running)
-            pbar_fin.n = len([r for r  in results if r is not None])
+            pbar_fin.n = len(self.completed)
             pbar_run.refresh()
             pbar_fin.refresh()
-            time.sleep(sleep)
+            self.wait(self.next_sleep(sleep))
 
         pbar_run.close()
         pbar_fin.close()
-        print("")
+        if not quiet:
+            print("")
         return results
 
-    def request_jobs(self, sleep=5, request_user_input=True):
-        jobid_tasks = self.submitter.jobid_tasks
-        ntotal = len(jobid_tasks)
+    def request_jobs(self, sleep=5, request_user_input=True, quiet=False):
+        ntotal = self.ntasks()
 
-        pbar_run = tqdm(total=ntotal, desc="Running ", ncols=80)
-        pbar_fin = tqdm(total=ntotal, desc="Finished", ncols=80)
+        pbar_run = tqdm(total=ntotal, desc="Running ", disable=quiet, ncols=80)
+        pbar_fin = tqdm(total=ntotal, desc="Finished", disable=quiet, ncols=80)
         try:
             for running, results in self.return_finished_jobs(request_user_input=request_user_input):
                 pbar_run.n = len(running)
-                pbar_fin.n = len([r for r  in results if r is not None])
+                pbar_fin.n = len(self.completed)
                 pbar_run.refresh()
                 pbar_fin.refresh()
-                time.sleep(sleep)
+                self.wait(self.next_sleep(sleep))
                 yield results
         except KeyboardInterrupt as e:
             self.submitter.killall()
 
         pbar_run.close()
         pbar_fin.close()
-        print("")
+        if not quiet:
+            print("")
         yield results
 
+    def as_completed(self, sleep=5, request_user_input=True, quiet=False):
+        """
+        Yield (position, result path) exactly once for each task as soon as
+        it's found to be finished.
+        """
+        ntotal = self.ntasks()
+
+        pbar_run = tqdm(total=ntotal, desc="Running ", disable=quiet, ncols=80)
+        pbar_fin = tqdm(total=ntotal, desc="Finished", disable=quiet, ncols=80)
+        nyielded = 0
+        try:
+            for running, results in self.return_finished_jobs(request_user_input=request_user_input):
+                for pos in self.completed[nyielded:]:
+                    yield pos, results[pos]
+                nyielded = len(self.completed)
+
+                pbar_run.n = len(running)
+                pbar_fin.n = nyielded
+                pbar_run.refresh()
+                pbar_fin.refresh()
+                if nyielded + len(self.failed) < ntotal:
+                    self.wait(self.next_sleep(sleep))
+        except KeyboardInterrupt as e:
+            self.submitter.killall()
+
+        pbar_run.close()
+        pbar_fin.close()
+        if not quiet:
+            print("")
+
     def return_finished_jobs(self, request_user_input=True):
         jobid_tasks = self.submitter.jobid_tasks
-        ntotal = len(jobid_tasks)
-        nremaining = ntotal
+        ntotal = self.ntasks()
 
-        finished, results = [], [None]*ntotal
+        finished, results = set(), [None]*ntotal
+        self.completed = []
+        self.failed = []
+        if self._initial_results is not None:
+            results = list(self._initial_results)
+            self.completed = [pos for pos, path in enumerate(results) if path is not None]
+            self.failed = list(self._initial_failed)
+        nremaining = ntotal - len(self.completed) - len(self.failed)
+
+        self.submitter.refresh()
+        area = self.submitter.area
+        if area is None:
+            # e.g. resumed without submitting
+            area = next((
+                os.path.dirname(tasks[0])
+                for tasks in jobid_tasks.values() if len(tasks) > 0
+            ), None)
+        if area is not None and self.watcher is not None:
+            self.start_watcher(area)
+        self._job_statuses, self._last_query = {}, None
 
         while nremaining>0:
+            job_statuses = self.poll(
+                results, finished, area=area,
+                request_user_input=request_user_input,
+            )
+            nremaining = ntotal - len(self.completed) - len(self.failed)
+            running = [
+                task
+                for jobid in job_statuses.get(1, [])
+                for task in self.submitter.jobid_tasks.get(jobid, [])
+            ]
+            yield running, results
+
+        self.stop_watcher()
+
+        # all jobs finished - final loop
+        yield [], results
+
+    def start_watcher(self, area):
+        """Watch the done directory of the working area for finished tasks"""
+        self._watcher = make_watcher(
+            os.path.join(area, DONE_DIR), backend=self.watcher,
+        )
+
+    def stop_watcher(self):
+        if self._watcher is not None:
+            self._watcher.close()
+            self._watcher = None
+
+    def collect_packed(self, results):
+        """Record the tasks found in the result indices of a packed area"""
+        for pos, ref in self._result_index.update().items():
+            if pos < len(results) and results[pos] is None:
+                results[pos] = ref
+                self.completed.append(pos)
+
+    def poll(self, results, finished, area=None, request_user_input=True):
+        """
+        Look for finished and failed tasks once. Tasks seen by the watcher
+        are recorded and, if due, the batch system is queried and the jobs it
+        no longer knows about are checked (and their failed tasks
+        resubmitted). The ids of jobs whose tasks all finished are added to
+        finished. Return the job statuses of the last query.
+        """
+        ncompleted = len(self.completed)
+        if self._result_index is None and area is not None and pack.is_packed(area):
+            self._result_index = pack.ResultIndex(area)
+        if self._result_index is not None:
+            self.collect_packed(results)
+        if self._watcher is not None:
+            self.collect_events(area, results)
+
+        if (
+            self._watcher is None or self._last_query is None
+            or time.time() - self._last_query >= self.qstat_interval
+        ):
             job_statuses = self.query_jobs()
-            all_queried_jobs = []
-            for state, queried_jobs in job_statuses.items():
-                all_queried_jobs.extend(queried_jobs)
+            if job_statuses is None:
+                # qstat failed: nothing can be told about the jobs this round,
+                # so none are taken as finished (and resubmitted)
+                return self._finish_poll(ncompleted)
+            # after the query, so the tasks of jobs which left the batch
+            # system are all known
+            self.submitter.refresh()
+            self._job_statuses = job_statuses
+            self._last_query = time.time()
+            all_queried_jobs = set()
+            for state, queried_jobs in self._job_statuses.items():
+                all_queried_jobs.update(queried_jobs)
 
             jobs_not_queried = {
-                jobid: task
-                for jobid, task in self.submitter.jobid_tasks.items()
+                jobid: tasks
+                for jobid, tasks in self.submitter.jobid_tasks.items()
                 if jobid not in all_queried_jobs and jobid not in finished
             }
-            finished.extend(self.check_jobs(jobs_not_queried, results, request_user_input=request_user_input))
+            finished.update(self.check_jobs(jobs_not_queried, results, request_user_input=request_user_input))
+            if self.speculate is not None:
+                self.speculate_stragglers(results, finished)
+            # only now, so the jobs submitted (e.g. shards released) aren't
+            # taken as finished
+            self.submitter.after_query(self._job_statuses, self._last_query)
 
-            nremaining = ntotal - len(finished)
-            yield job_statuses.get(1, {}), results
+        return self._finish_poll(ncompleted)
 
-        # all jobs finished - final loop
-        yield {}, results
+    def _finish_poll(self, ncompleted):
+        self._nnew = len(self.completed) - ncompleted
+        if self.submitter.journal is not None:
+            self.submitter.journal.finished(self.completed[ncompleted:])
+        self._nrunning = len(self._job_statuses.get(1, []))
+        self._npending = len(self._job_statuses.get(2, []))
+        return self._job_statuses
 
     def check_jobs(self, jobid_tasks, results, request_user_input=True):
-        finished = []
-        for jobid, task in jobid_tasks.items():
-            pos = int(os.path.basename(task).split("_")[-1])
-            try:
-                with gzip.open(os.path.join(task, "result.p.gz"), 'rb') as f:
-                    dill.load(f)
-                results[pos] = os.path.join(task, "result.p.gz")
+        finished, failed = [], []
+        if self._result_index is not None:
+            # results written since the poll started
+            self.collect_packed(results)
+        for jobid, tasks in jobid_tasks.items():
+            job_failed = []
+            for task in tasks:
+                pos = pack.task_position(task)
+                if results[pos] is not None:
+                    continue
+                if self._result_index is None and result_complete(task, verify=self.verify_checksum):
+                    results[pos] = os.path.join(task, RESULT_FILE)
+                    self.completed.append(pos)
+                else:
+                    job_failed.append(task)
+
+            since = self._running_since.pop(jobid, None)
+            if len(job_failed) == 0:
                 finished.append(jobid)
-            except (IOError, EOFError, dill.UnpicklingError) as e:
-                logger.info('Resubmitting {}: {}'.format(jobid, task))
-                self.submitter.submit_tasks(
-                    [task], start=pos, request_user_input=request_user_input,
-                )
-                self.submitter.jobid_tasks.pop(jobid)
+                if since is not None and jobid not in self._copies:
+                    self._runtimes.append(time.time() - since)
+                continue
+
+            # Only resubmit the tasks of a bundle that failed
+            self.submitter.jobid_tasks.pop(jobid)
+            # unless a speculative copy of the job is still running them
+            copies = [
+                self.submitter.jobid_tasks[job] for job in self._copies.get(jobid, [])
+                if job in self.submitter.jobid_tasks
+            ]
+            job_failed = [
+                task for task in job_failed
+                if not any(task in tasks for tasks in copies)
+            ]
+            for task in job_failed:
+                logger.debug('Resubmitting {}: {}'.format(jobid, task))
+            # a task can be listed under several jobs, e.g. speculative
+            # copies that both died
+            failed_tasks = set(task for _, task in failed)
+            failed.extend((jobid, task) for task in job_failed if task not in failed_tasks)
+
+        if len(failed) > 0:
+            logger.info('Found {} failed tasks'.format(len(failed)))
 
+        # All failures of this poll are resubmitted together as one array job
+        # (per set of options)
+        if self.retry_policy is None:
+            self.submitter.submit_task_list(
+                [task for _, task in failed],
+                request_user_input=request_user_input,
+            )
+            return finished
+
+        task_options = {}
+        nfailed = len(self.failed)
+        for jobid, task in failed:
+            options = self.retry_policy.resubmit_options(
+                jobid, task, self.submitter.job_options,
+            )
+            if options is None:
+                self.failed.append(pack.task_position(task))
+            else:
+                task_options.setdefault(options, []).append(task)
+        if self.submitter.journal is not None:
+            self.submitter.journal.failed(self.failed[nfailed:])
+        for options, tasks in task_options.items():
+            self.submitter.submit_task_list(tasks, job_options=options)
         return finished
 
+    def speculate_stragglers(self, results, finished):
+        """
+        Delete the copies of speculated jobs whose tasks have all finished
+        and submit a duplicate of the unfinished tasks of each job running
+        for longer than speculate times the median runtime of the finished
+        jobs.
+        """
+        now = time.time()
+        jobid_tasks = self.submitter.jobid_tasks
+        running = self._job_statuses.get(1, [])
+        for jobid in running:
+            self._running_since.setdefault(jobid, now)
+
+        # the first copy to finish wins
+        losers = [
+            jobid for jobid in self._copies
+            if jobid in jobid_tasks and jobid not in finished
+            and jobid not in self._killed
+            and all(results[pack.task_position(task)] is not None for task in jobid_tasks[jobid])
+        ]
+        if len(losers) > 0:
+            logger.info("Deleting {} slower copies of speculated jobs".format(len(losers)))
+            self.submitter.kill(losers)
+            self._killed.update(losers)
+
+        if len(self._runtimes) < self.speculate_min_finished:
+            return
+        limit = self.speculate*statistics.median(self._runtimes)
+        for jobid in running:
+            if jobid in self._copies or now - self._running_since[jobid] < limit:
+                continue
+            tasks = [
+                task for task in jobid_tasks.get(jobid, [])
+                if results[pack.task_position(task)] is None
+            ]
+            if len(tasks) == 0:
+                continue
+            logger.info("Speculatively resubmitting {} tasks of {} (running for {:.0f}s)".format(
+                len(tasks), jobid, now - self._running_since[jobid],
+            ))
+            options = None
+            if self.retry_policy is not None:
+                options = self.retry_policy.task_options.get(tasks[0])
+            submitted = set(jobid_tasks)
+            self.submitter.submit_task_list(tasks, job_options=options)
+            copies = [jobid] + [job for job in jobid_tasks if job not in submitted]
+            for job in copies:
+                self._copies[job] = copies
+
     def query_jobs(self):
+        """
+        Return the ids of the queried jobs by state, or None if qstat failed
+        """
+        if self.query == "xml":
+            return self.query_jobs_xml()
+
         job_status = {}
-        out, err = run_command("qstat -g d")
+        out, err, returncode = run_command("qstat -u {} -g d".format(self.user), returncode=True)
+        if not _query_succeeded(out, err, returncode):
+            return None
 
         for l in out.decode('utf-8').splitlines():
             if l.startswith("job-ID") or l.startswith("-----"):
@@ -144,7 +537,7 @@ class JobMonitor(object):
             jobid = ws[0]
             taskid = int(ws[-1])
 
-            if not '{}.{}'.format(jobid, taskid) in self.submitter.jobid_tasks.keys():
+            if not '{}.{}'.format(jobid, taskid) in self.submitter.jobid_tasks:
                 continue
 
             state = SGE_JOBSTATE_CODES[ws[4]]
@@ -153,3 +546,30 @@ class JobMonitor(object):
             job_status[state].append('{}.{}'.format(jobid, taskid))
 
         return job_status
+
+    def query_jobs_xml(self):
+        job_status = {}
+        out, err, returncode = run_command("qstat -u {} -xml".format(self.user), returncode=True)
+        if not _query_succeeded(out, err, returncode):
+            return None
+        jobid_tasks = self.submitter.jobid_tasks
+        try:
+            root = ET.fromstring(out)
+        except ET.ParseError as e:
+            logger.warning("Unable to parse qstat output: {}".format(e))
+            return None
+
+        for job in root.iter("job_list"):
+            jobid = job.findtext("JB_job_number")
+            # Unknown states are treated as running so they're never resubmitted
+            state = SGE_JOBSTATE_CODES.get(job.findtext("state"), 1)
+            keys = [
+                key for key in (
+                    '{}.{}'.format(jobid, taskid)
+                    for taskid in _expand_tasks(job.findtext("tasks"))
+                ) if key in jobid_tasks
+            ]
+            if len(keys) > 0:
+                job_status.setdefault(state, []).extend(keys)
+
+        return job_status
@@ -0,0 +1,307 @@
+import os
+import glob
+import json
+import errno
+import struct
+import hashlib
+from .serialization import Codec, loads
+
+# Packed working area layout, an alternative to one directory per task:
+#
+#   tasks_<n>.pack  serialized tasks appended one after the other. A new
+#                   pack is started once one reaches PACK_BYTES
+#   tasks.idx       fixed size record (pack number, offset, length) per task
+#                   so a worker seeks straight to its task
+#   results/<shard>/<slot>.pack  serialized results of the tasks of the
+#                   shard (SHARD_SIZE consecutive positions) run by the
+#                   processes holding the slot one after the other
+#   results/<shard>/<slot>.idx   json line per result with its position,
+#                   offset, size, sha1 and metrics, written after the result
+#                   is flushed to the pack
+#   results/<shard>/<slot>.lock  directory claimed (mkdir) by the process
+#                   writing to the slot, removed when it's done
+#   logs/<shard>/<slot>.out|err  stdout and stderr of the tasks run in the
+#                   slot, each preceded by a TASK_HEADER line
+#
+# A worker claims the first free slot of a shard, so each file has a single
+# writer at a time and the number of files of a shard is bounded by the
+# number of tasks of the shard running at once rather than by the number of
+# array job elements.
+#
+# Tasks and results are encoded with the codec of the working area (see
+# pysge.serialization).
+#
+# Tasks are identified by their position only, so there is no limit on the
+# number of tasks.
+TASK_INDEX = "tasks.idx"
+TASK_RECORD = struct.Struct("<IQQ")
+PACK_BYTES = 1 << 30
+RESULTS_DIR = "results"
+LOGS_DIR = "logs"
+SHARD_SIZE = 10000
+TASK_HEADER = "# pysge task {}\n"
+
+def is_packed(area):
+    """Whether the working area uses the packed layout"""
+    return os.path.exists(os.path.join(area, TASK_INDEX))
+
+def shard(pos):
+    """Shard directory name of the outputs of the task at position pos"""
+    return "{:d}".format(pos // SHARD_SIZE)
+
+def task_position(task):
+    """Position of a task from its (possibly virtual) task_<pos> path"""
+    return int(os.path.basename(task).split("_")[-1])
+
+def stderr_location(task, jobid=None):
+    """
+    Where to look for the stderr of a task, for messages. In a task
+    directory that of the copy run by the array job (element) jobid, or of
+    the last copy to run if not given.
+    """
+    if os.path.isdir(task):
+        if jobid is not None:
+            return os.path.join(task, "stderr.{}.txt".format(jobid.split(".")[0]))
+        paths = glob.glob(os.path.join(task, "stderr*.txt"))
+        if len(paths) == 0:
+            return os.path.join(task, "stderr.txt")
+        return max(paths, key=os.path.getmtime)
+    return "{} ({})".format(
+        os.path.join(os.path.dirname(task), LOGS_DIR),
+        TASK_HEADER.format(task_position(task)).strip(),
+    )
+
+def ntasks(area):
+    return os.path.getsize(os.path.join(area, TASK_INDEX)) // TASK_RECORD.size
+
+class TaskPackWriter(object):
+    """Append serialized tasks to the packs and index of a working area"""
+    def __init__(self, area, pack_bytes=PACK_BYTES):
+        self.area = area
+        self.pack_bytes = pack_bytes
+        open(os.path.join(area, TASK_INDEX), 'ab').close()
+
+    def write(self, data_list):
+        """Append the serialized tasks (bytes) in data_list in order"""
+        packs = sorted(glob.glob(os.path.join(self.area, "tasks_*.pack")))
+        number = len(packs) - 1 if len(packs) > 0 else 0
+        pack_path = os.path.join(self.area, "tasks_{:d}.pack".format(number))
+
+        records = []
+        pack = open(pack_path, 'ab')
+        try:
+            for data in data_list:
+                if pack.tell() > 0 and pack.tell() + len(data) > self.pack_bytes:
+                    pack.close()
+                    number += 1
+                    pack = open(os.path.join(self.area, "tasks_{:d}.pack".format(number)), 'ab')
+                records.append(TASK_RECORD.pack(number, pack.tell(), len(data)))
+                pack.write(data)
+        finally:
+            pack.close()
+        # the index is only extended once the tasks are in the packs
+        with open(os.path.join(self.area, TASK_INDEX), 'ab') as f:
+            f.write(b"".join(records))
+
+def serialize(obj, dill_kw={}, codec=None):
+    """obj encoded with codec (dill+gzip by default) as stored in the packs"""
+    return (codec if codec is not None else Codec()).dumps(obj, dill_kw)
+
+def read_task(area, pos):
+    """Load the task at position pos from the packs of the working area"""
+    with open(os.path.join(area, TASK_INDEX), 'rb') as f:
+        f.seek(pos*TASK_RECORD.size)
+        number, offset, length = TASK_RECORD.unpack(f.read(TASK_RECORD.size))
+    with open(os.path.join(area, "tasks_{:d}.pack".format(number)), 'rb') as f:
+        f.seek(offset)
+        return loads(f.read(length))
+
+class PackRef(object):
+    """Location of a result in a result pack"""
+    def __init__(self, path, offset, size):
+        self.path = path
+        self.offset = offset
+        self.size = size
+
+    def read(self):
+        """The serialized result"""
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            return f.read(self.size)
+
+    def load(self):
+        return loads(self.read())
+
+    def __repr__(self):
+        return "PackRef({!r}, {}, {})".format(self.path, self.offset, self.size)
+
+def _claim_slot(area, shard_name):
+    """
+    Claim the first free slot of a shard of the result packs. Return its
+    path (without extension) in the results directory.
+    """
+    path = os.path.join(area, RESULTS_DIR, shard_name)
+    for directory in (path, os.path.join(area, LOGS_DIR, shard_name)):
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+    slot = 0
+    while True:
+        try:
+            os.mkdir(os.path.join(path, "{:d}.lock".format(slot)))
+            return os.path.join(path, "{:d}".format(slot))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        slot += 1
+
+class ResultPackWriter(object):
+    """
+    Results of the tasks run by this process, appended to slots claimed in
+    the shards of the tasks. Only the holder of a slot writes to its files,
+    so it's safe on network filesystems without file locking. The slots are
+    given back by close, those of processes killed on the way stay claimed.
+    """
+    def __init__(self, area):
+        self.area = area
+        self._slots = {}
+
+    def claim(self, pos):
+        """
+        Claim a slot in the shard of the task at pos if not held yet. Return
+        the (directory, name) of the log files of the slot.
+        """
+        shard_name = shard(pos)
+        if shard_name not in self._slots:
+            slot = _claim_slot(self.area, shard_name)
+            index_path = slot + ".idx"
+            # a previous holder killed while writing a record leaves a
+            # partial line, which mustn't swallow the next record
+            try:
+                with open(index_path, 'rb') as f:
+                    f.seek(-1, os.SEEK_END)
+                    partial = f.read(1) != b"\n"
+            except (IOError, OSError):
+                partial = False
+            if partial:
+                with open(index_path, 'a') as f:
+                    f.write("\n")
+            self._slots[shard_name] = slot
+        return (
+            os.path.join(self.area, LOGS_DIR, shard_name),
+            os.path.basename(self._slots[shard_name]),
+        )
+
+    def write(self, pos, data, metrics=None):
+        """Append the serialized result of the task at pos"""
+        self.claim(pos)
+        slot = self._slots[shard(pos)]
+        with open(slot + ".pack", 'ab') as f:
+            offset = f.tell()
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        record = {
+            "pos": pos, "offset": offset, "size": len(data),
+            "sha1": hashlib.sha1(data).hexdigest(),
+        }
+        if metrics is not None:
+            record["metrics"] = metrics
+        with open(slot + ".idx", 'a') as f:
+            f.write(json.dumps(record) + "\n")
+
+    def close(self):
+        """Give back the claimed slots"""
+        for slot in self._slots.values():
+            try:
+                os.rmdir(slot + ".lock")
+            except OSError:
+                pass
+        self._slots = {}
+
+def iter_result_records(area, offsets=None, skip_shards=()):
+    """
+    Yield (pack path, record) for the results in the packs of the working
+    area, leaving out the shards in skip_shards. If offsets is given ({index
+    path: bytes read}) only records added since the last call are read, from
+    the indices which grew, and offsets is updated.
+    """
+    try:
+        shards = os.listdir(os.path.join(area, RESULTS_DIR))
+    except (IOError, OSError):
+        return
+    for shard_name in shards:
+        if shard_name in skip_shards:
+            continue
+        for index_path in glob.glob(os.path.join(area, RESULTS_DIR, shard_name, "*.idx")):
+            start = offsets.get(index_path, 0) if offsets is not None else 0
+            try:
+                if start > 0 and os.path.getsize(index_path) <= start:
+                    continue
+                with open(index_path, 'rb') as f:
+                    f.seek(start)
+                    data = f.read()
+            except (IOError, OSError):
+                continue
+            # ignore a line still being written
+            end = data.rfind(b"\n") + 1
+            if offsets is not None:
+                offsets[index_path] = start + end
+            pack_path = index_path[:-len(".idx")] + ".pack"
+            for line in data[:end].splitlines():
+                try:
+                    yield pack_path, json.loads(line.decode("utf-8"))
+                except ValueError:
+                    continue
+
+class ResultIndex(object):
+    """
+    Incremental reader of the result indices of a packed working area.
+    Shards whose tasks all have a result aren't read again.
+    """
+    def __init__(self, area):
+        self.area = area
+        self._offsets = {}
+        self._found = {}
+        self._complete = set()
+
+    def update(self):
+        """Return {position: PackRef} of the results found since the last call"""
+        refs = {}
+        for pack_path, record in iter_result_records(self.area, self._offsets, self._complete):
+            pos = record["pos"]
+            refs[pos] = PackRef(pack_path, record["offset"], record["size"])
+            self._found.setdefault(shard(pos), set()).add(pos)
+
+        # tasks can be added to the area later on, so this is redone each time
+        total = ntasks(self.area)
+        self._complete = set(
+            shard_name for shard_name, positions in self._found.items()
+            if len(positions) >= min(SHARD_SIZE, total - int(shard_name)*SHARD_SIZE)
+        )
+        return refs
+
+def task_log(area, pos, stream="err"):
+    """
+    Output (stream "out" or "err") of the last run of the task at pos, or
+    None if it hasn't run.
+    """
+    header = TASK_HEADER.format(pos)
+    log, log_mtime = None, None
+    # only the slots of the task's shard can have run it
+    for path in glob.glob(os.path.join(area, LOGS_DIR, shard(pos), "*.{}".format(stream))):
+        try:
+            with open(path, 'r') as f:
+                text = f.read()
+            mtime = os.path.getmtime(path)
+        except (IOError, OSError):
+            continue
+        idx = text.rfind(header)
+        if idx < 0 or (log_mtime is not None and mtime < log_mtime):
+            continue
+        end = text.find(TASK_HEADER.split("{")[0], idx + len(header))
+        log = text[idx + len(header):end if end >= 0 else len(text)]
+        log_mtime = mtime
+    return log
@@ -1,23 +1,285 @@
 #!/usr/bin/env python
-import gzip
-import dill
 import os
+import sys
+import json
+import time
+import socket
+import resource
+import traceback
+import multiprocessing
+from pysge import buffers
+from pysge import pack
+from pysge import workqueue
+from pysge import dag
+from pysge.serialization import read_codec, reader
+from pysge.blobs import resolve_blobs
+from pysge.completion import write_result, result_complete
 
-def main():
+class Timer(object):
+    """Wall and CPU time of a phase"""
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.wall, self.cpu = time.time(), time.process_time()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics["{}_wall".format(self.name)] = time.time() - self.wall
+        self.metrics["{}_cpu".format(self.name)] = time.process_time() - self.cpu
+
+def main(suffix=""):
+    """
+    Run the task of the task directory (the working directory). Its metrics
+    are written to metrics<suffix>.json, only by the copy of the task which
+    publishes its result. Return whether this copy published it.
+    """
     cwd = os.getcwd()
-    with gzip.open("task.p.gz", 'rb') as f:
-        task = dill.load(f)
+    codec = read_codec(os.path.dirname(cwd))
+    metrics = {
+        "hostname": socket.gethostname(),
+        "job_id": os.environ.get("JOB_ID"),
+        "sge_task_id": os.environ.get("SGE_TASK_ID"),
+        "start_time": time.time(),
+        "input_size": sum(
+            os.path.getsize(path) for path in
+            ["task.p.gz"] + buffers.buffer_paths(os.path.join(cwd, "task.p.gz"))
+        ),
+    }
+    if "PYSGE_SUBMIT_TIME" in os.environ:
+        metrics["queue_wait"] = metrics["start_time"] - float(os.environ["PYSGE_SUBMIT_TIME"])
+
+    # results of the tasks this task depends on replace their ResultOfs
+    with Timer(metrics, "load"), dag.resolving(os.path.dirname(cwd)):
+        with open("task.p.gz", 'rb') as f:
+            task = buffers.load(reader(f), os.path.join(cwd, "task.p.gz"))
+        oob_min_size = task.get("oob_min_size")
+        task = resolve_blobs(task, os.path.dirname(cwd))
 
     print("Task = {}\n\nargs = {}\n\nkwargs = {}\n".format(
         task["task"], task["args"], task["kwargs"],
     ))
-    result = task["task"](*task["args"], **task["kwargs"])
+    with Timer(metrics, "run"):
+        result = task["task"](*task["args"], **task["kwargs"])
 
     # Just incase the user wants to change directory within the task
     os.chdir(cwd)
 
-    with gzip.open("result.p.gz", 'wb') as f:
-        dill.dump(result, f)
+    with Timer(metrics, "dump"):
+        metrics["output_size"] = write_result(
+            result, cwd, oob_min_size=oob_min_size, codec=codec,
+        )
+    if metrics["output_size"] is None:
+        print("Result already published by another copy of the task")
+        return False
+
+    # ru_maxrss is in kB on Linux
+    metrics["peak_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+    metrics["end_time"] = time.time()
+    with open("metrics{}.json".format(suffix), 'w') as f:
+        json.dump(metrics, f)
+    return True
+
+def element_positions():
+    """Positions of the tasks run by this array job element"""
+    taskid = int(os.environ["SGE_TASK_ID"])
+    if "PYSGE_TASKLIST" in os.environ:
+        with open(os.environ["PYSGE_TASKLIST"], 'r') as f:
+            names = f.read().splitlines()[taskid-1].split()
+        return [pack.task_position(name) for name in names]
+    ntasks = int(os.environ.get("PYSGE_TASKS_PER_JOB", 1))
+    first = (taskid - 1)*ntasks
+    last = first + ntasks
+    if "PYSGE_NTASKS" in os.environ:
+        last = min(last, int(os.environ["PYSGE_NTASKS"]))
+    return list(range(first, last))
+
+def _redirect_output(log_dir, name):
+    """Append stdout and stderr of this process to log_dir/name.out|err"""
+    if not os.path.exists(log_dir):
+        try:
+            os.makedirs(log_dir)
+        except OSError:
+            pass
+    for fd, stream in ((1, "out"), (2, "err")):
+        log = os.open(
+            os.path.join(log_dir, "{}.{}".format(name, stream)),
+            os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+        )
+        os.dup2(log, fd)
+        os.close(log)
+
+def _run_packed(area, pos, writer, codec):
+    """
+    Run the task at position pos of a packed working area and append its
+    result, encoded with codec, to writer, with its output in the logs of
+    the writer's slot. Return whether it succeeded.
+    """
+    _redirect_output(*writer.claim(pos))
+    for f in (sys.stdout, sys.stderr):
+        f.write(pack.TASK_HEADER.format(pos))
+        f.flush()
+    metrics = {
+        "hostname": socket.gethostname(),
+        "job_id": os.environ.get("JOB_ID"),
+        "sge_task_id": os.environ.get("SGE_TASK_ID"),
+        "start_time": time.time(),
+    }
+    if "PYSGE_SUBMIT_TIME" in os.environ:
+        metrics["queue_wait"] = metrics["start_time"] - float(os.environ["PYSGE_SUBMIT_TIME"])
+    success = True
+    try:
+        with Timer(metrics, "load"), dag.resolving(area):
+            task = resolve_blobs(pack.read_task(area, pos), area)
+
+        print("Task = {}\n\nargs = {}\n\nkwargs = {}\n".format(
+            task["task"], task["args"], task["kwargs"],
+        ))
+        with Timer(metrics, "run"):
+            result = task["task"](*task["args"], **task["kwargs"])
+        os.chdir(area)
+
+        with Timer(metrics, "dump"):
+            data = pack.serialize(result, codec=codec)
+        metrics["output_size"] = len(data)
+        # peak of the whole process so far, tasks run in one process
+        metrics["peak_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+        metrics["end_time"] = time.time()
+        writer.write(pos, data, metrics=metrics)
+    except Exception:
+        traceback.print_exc()
+        success = False
+        os.chdir(area)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return success
+
+def _run_directory(path, suffix="", log_suffix=None):
+    """
+    Run the task directory path in this process, with its output in
+    stdout<log_suffix>.txt and stderr<log_suffix>.txt (log_suffix defaults
+    to suffix) and its metrics in metrics<suffix>.json. A suffix keeps the
+    files of another copy of the task running elsewhere intact. Return
+    whether it succeeded and published its result.
+    """
+    cwd = os.getcwd()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    success = True
+    try:
+        log_suffix = suffix if log_suffix is None else log_suffix
+        for fd, name in ((1, "stdout{}.txt"), (2, "stderr{}.txt")):
+            log = os.open(
+                os.path.join(path, name.format(log_suffix)),
+                os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+            )
+            os.dup2(log, fd)
+            os.close(log)
+        os.chdir(path)
+        success = main(suffix)
+    except Exception:
+        traceback.print_exc()
+        success = False
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.chdir(cwd)
+        for fd, saved_fd in zip((1, 2), saved):
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
+    return success
+
+def _run_bundled(path):
+    # the logs are per job, so a copy of the task (speculative or
+    # resubmitted) in another job keeps its own, and another copy publishing
+    # the result first isn't a failure
+    log_suffix = ".{}".format(os.environ.get("JOB_ID", "0"))
+    return _run_directory(path, log_suffix=log_suffix) or result_complete(path)
+
+def main_bundle():
+    """
+    Run the task directories of this array job element (the working
+    directory is the working area) in this interpreter, each with its output
+    in its own stdout.<job id>.txt and stderr.<job id>.txt. The tasks are
+    spread over the NSLOTS allocated to the job by forking this process.
+    """
+    area = os.getcwd()
+    paths = [
+        os.path.join(area, "task_{:05d}".format(pos)) for pos in element_positions()
+    ]
+    if len(paths) == 0:
+        # array elements aligned with an upstream job (-hold_jid_ad) which
+        # have no task to run
+        return 0
+    nslots = min(int(os.environ.get("NSLOTS", 1)), len(paths))
+    if nslots > 1:
+        pool = multiprocessing.get_context("fork").Pool(nslots)
+        try:
+            successes = pool.map(_run_bundled, paths, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        successes = [_run_bundled(path) for path in paths]
+    return 0 if all(successes) else 1
+
+def main_packed():
+    """
+    Run the tasks of this array job element from a packed working area (the
+    working directory) in sequence, appending their results and output to
+    the result pack and logs of a slot claimed in their shard.
+    """
+    area = os.getcwd()
+    positions = element_positions()
+    if len(positions) == 0:
+        # array elements aligned with an upstream job (-hold_jid_ad) which
+        # have no task to run
+        return 0
+    writer = pack.ResultPackWriter(area)
+    codec = read_codec(area)
+
+    nfailed = 0
+    try:
+        for pos in positions:
+            if not _run_packed(area, pos, writer, codec):
+                nfailed += 1
+    finally:
+        writer.close()
+    return 1 if nfailed > 0 else 0
+
+def main_pilot():
+    """
+    Pilot job: run tasks claimed from the work queue of the working area
+    (the working directory) one after the other in this process until the
+    queue is empty.
+    """
+    area = os.getcwd()
+    pilot = "{}.{}".format(os.environ.get("JOB_ID", "0"), os.environ["SGE_TASK_ID"])
+    packed = pack.is_packed(area)
+    codec = read_codec(area)
+    writer = pack.ResultPackWriter(area) if packed else None
+
+    nfailed = 0
+    try:
+        for task in workqueue.claim_iter(area, pilot):
+            if packed:
+                success = _run_packed(area, pack.task_position(task), writer, codec)
+            else:
+                success = _run_bundled(os.path.join(area, task))
+            if not success:
+                nfailed += 1
+    finally:
+        if writer is not None:
+            writer.close()
+    return 1 if nfailed > 0 else 0
 
 if __name__ == "__main__":
+    if "--pilot" in sys.argv[1:]:
+        sys.exit(main_pilot())
+    if "--packed" in sys.argv[1:]:
+        sys.exit(main_packed())
+    if "--bundle" in sys.argv[1:]:
+        sys.exit(main_bundle())
     main()
@@ -1,8 +1,19 @@
 #!/bin/bash
 ulimit -c 0
-taskid=$((SGE_TASK_ID - 1))
-path=task_$(printf "%05d" ${taskid})
-cd $path
-date > $PWD/stdout.txt
-{ time pysge_worker.py ; } >> $PWD/stdout.txt 2> $PWD/stderr.txt
-date >> $PWD/stdout.txt
+
+if [ -n "${PYSGE_PILOT}" ]; then
+    # pilot job - run tasks claimed from the working area's work queue
+    # until it's empty
+    exec pysge_worker.py --pilot
+fi
+
+if [ -f tasks.idx ]; then
+    # packed working area (the job's working directory) - the worker reads
+    # the tasks of this element from the packs and writes its own logs
+    exec pysge_worker.py --packed
+fi
+
+# task directories - the worker runs the tasks of this element (its line of
+# PYSGE_TASKLIST or a bundle of PYSGE_TASKS_PER_JOB consecutive tasks) in one
+# interpreter, each with its own stdout.<job id>.txt and stderr.<job id>.txt
+exec pysge_worker.py --bundle
@@ -0,0 +1,146 @@
+import os
+import glob
+import json
+import logging
+from . import pack
+logger = logging.getLogger(__name__)
+
+REPORT_METRICS = (
+    "queue_wait", "load_wall", "load_cpu", "run_wall", "run_cpu", "dump_wall",
+    "dump_cpu", "peak_rss", "input_size", "output_size",
+)
+
+def collect_metrics(path):
+    """
+    Read the metrics.json (metrics.local.json if it ran locally, see
+    sge_hybrid_submit) written by each task of a working area (tpd_*
+    directory), or stored with the results of a packed working area. Each dict
+    gets the task directory under the key "task".
+    """
+    if pack.is_packed(path):
+        return [
+            dict(record["metrics"], task=os.path.join(path, "task_{:05d}".format(record["pos"])))
+            for _, record in pack.iter_result_records(path)
+            if "metrics" in record
+        ]
+    metrics = []
+    metrics_paths = sorted(
+        glob.glob(os.path.join(path, "task_*", "metrics.json"))
+        + glob.glob(os.path.join(path, "task_*", "metrics.local.json"))
+    )
+    for metrics_path in metrics_paths:
+        try:
+            with open(metrics_path, 'r') as f:
+                task_metrics = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            logger.warning("Unable to read {}: {}".format(metrics_path, e))
+            continue
+        task_metrics["task"] = os.path.dirname(metrics_path)
+        metrics.append(task_metrics)
+    return metrics
+
+def percentile(values, q):
+    """q-th percentile (0-100) of sorted values with linear interpolation"""
+    if len(values) == 0:
+        return None
+    pos = (len(values)-1)*q/100.
+    low = int(pos)
+    high = min(low+1, len(values)-1)
+    return values[low] + (values[high]-values[low])*(pos-low)
+
+def histogram(values, nbins=10):
+    """List of (low edge, high edge, count) over the range of values"""
+    if len(values) == 0:
+        return []
+    low, high = min(values), max(values)
+    width = (high-low)/float(nbins) if high > low else 1.
+    counts = [0]*nbins
+    for value in values:
+        counts[min(int((value-low)/width), nbins-1)] += 1
+    return [(low+idx*width, low+(idx+1)*width, count) for idx, count in enumerate(counts)]
+
+def profile_report(
+    path, quantiles=(0, 50, 90, 99, 100), nslowest=10, nbins=10, quiet=False,
+):
+    """
+    Aggregate the per-task metrics of a working area into a report, e.g. to
+    right-size -l h_vmem and spot hot tasks. Return a dict with:
+
+    - "ntasks": the number of tasks with metrics
+    - "percentiles": {metric: {quantile: value}} for the time (s) spent in the
+      queue, loading, running and dumping each task, the peak RSS and the
+      input and output sizes (bytes)
+    - "slowest": the metrics of the nslowest tasks by run_wall
+    - "memory_histogram": (low, high, count) bins of peak RSS
+
+    The report is also printed unless quiet is True.
+
+    Parameters
+    ----------
+    path : str
+        Path to the working area (tpd_* directory).
+    """
+    metrics = collect_metrics(path)
+    percentiles = {}
+    for name in REPORT_METRICS:
+        values = sorted(m[name] for m in metrics if m.get(name) is not None)
+        if len(values) > 0:
+            percentiles[name] = {q: percentile(values, q) for q in quantiles}
+
+    report = {
+        "ntasks": len(metrics),
+        "percentiles": percentiles,
+        "slowest": sorted(
+            metrics, key=lambda m: m.get("run_wall", 0.), reverse=True,
+        )[:nslowest],
+        "memory_histogram": histogram(
+            [m["peak_rss"] for m in metrics if "peak_rss" in m], nbins=nbins,
+        ),
+    }
+    if not quiet:
+        print(format_report(report))
+    return report
+
+def _format_value(name, value):
+    if name.endswith("_rss") or name.endswith("_size"):
+        for unit in ("B", "kB", "MB", "GB"):
+            if abs(value) < 1024.:
+                return "{:.1f}{}".format(value, unit)
+            value /= 1024.
+        return "{:.1f}TB".format(value)
+    return "{:.2f}s".format(value)
+
+def format_report(report):
+    lines = ["Metrics of {} tasks".format(report["ntasks"])]
+    if report["ntasks"] == 0:
+        return lines[0]
+
+    quantiles = sorted(next(iter(report["percentiles"].values())).keys())
+    lines.append("{:<12}".format("metric") + "".join(
+        "{:>11}".format("p{}".format(q)) for q in quantiles
+    ))
+    for name in REPORT_METRICS:
+        if name not in report["percentiles"]:
+            continue
+        lines.append("{:<12}".format(name) + "".join(
+            "{:>11}".format(_format_value(name, report["percentiles"][name][q]))
+            for q in quantiles
+        ))
+
+    lines.append("")
+    lines.append("Slowest tasks")
+    for m in report["slowest"]:
+        lines.append("  {} {} on {}".format(
+            os.path.basename(m["task"]), _format_value("run_wall", m.get("run_wall", 0.)),
+            m.get("hostname"),
+        ))
+
+    lines.append("")
+    lines.append("Peak RSS")
+    nmax = max(count for _, _, count in report["memory_histogram"])
+    for low, high, count in report["memory_histogram"]:
+        lines.append("  {:>9} - {:>9} {:>6} {}".format(
+            _format_value("peak_rss", low), _format_value("peak_rss", high),
+            count, "#"*int(round(40.*count/nmax)),
+        ))
+    return "\n".join(lines)
@@ -0,0 +1,131 @@
+import os
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from . import buffers
+from .pack import PackRef
+from .serialization import reader
+
+try:
+    from collections.abc import Sequence
+except ImportError:
+    from collections import Sequence
+
+def load_result(path):
+    if isinstance(path, PackRef):
+        return path.load()
+    with open(path, 'rb') as f:
+        return buffers.load(reader(f), path)
+
+class LazyResults(Sequence):
+    """
+    Sequence of task results loaded from their result files on access. Loaded
+    results are kept in an LRU cache bounded by cache_size items and,
+    optionally, cache_bytes bytes of result files on disk. During sequential
+    iteration (or indexing) the next prefetch results are loaded in
+    background threads.
+
+    Parameters
+    ----------
+    paths : list
+        Paths to the result files (or PackRefs to results in the packs of a
+        packed working area). None entries give None results.
+
+    cache_size : int (default = 16)
+        Maximum number of results held in the cache.
+
+    cache_bytes : int or None (default = None)
+        Maximum total size of the result files (as stored on disk) held in
+        the cache. The most recently used result is always kept.
+
+    prefetch : int (default = 0)
+        Number of results after the one accessed to load in the background.
+    """
+    def __init__(self, paths, cache_size=16, cache_bytes=None, prefetch=0):
+        self.paths = list(paths)
+        self.cache_size = cache_size
+        self.cache_bytes = cache_bytes
+        self.prefetch = prefetch
+
+        self._cache = collections.OrderedDict()
+        self._cache_nbytes = 0
+        self._futures = {}
+        self._executor = None
+        self._last = None
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return LazyResults(
+                self.paths[idx], cache_size=self.cache_size,
+                cache_bytes=self.cache_bytes, prefetch=self.prefetch,
+            )
+        if idx < 0:
+            idx += len(self.paths)
+        if not 0 <= idx < len(self.paths):
+            raise IndexError("LazyResults index out of range")
+
+        sequential = self._last is not None and idx == self._last + 1
+        self._last = idx
+        if self.prefetch > 0 and (sequential or idx == 0):
+            self._prefetch(idx)
+
+        if idx in self._cache:
+            self._cache.move_to_end(idx)
+            return self._cache[idx][0]
+
+        path = self.paths[idx]
+        future = self._futures.pop(idx, None)
+        if future is not None:
+            result = future.result()
+        elif path is None:
+            result = None
+        else:
+            result = load_result(path)
+        self._store(idx, result)
+        return result
+
+    def __iter__(self):
+        for idx in range(len(self.paths)):
+            yield self[idx]
+
+    def _store(self, idx, result):
+        path = self.paths[idx]
+        if isinstance(path, PackRef):
+            nbytes = path.size
+        else:
+            nbytes = os.path.getsize(path) if path is not None else 0
+        self._cache[idx] = (result, nbytes)
+        self._cache_nbytes += nbytes
+        while len(self._cache) > 1 and (
+            len(self._cache) > self.cache_size or (
+                self.cache_bytes is not None
+                and self._cache_nbytes > self.cache_bytes
+            )
+        ):
+            _, (_, evicted_nbytes) = self._cache.popitem(last=False)
+            self._cache_nbytes -= evicted_nbytes
+
+    def _prefetch(self, idx):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.prefetch)
+        # drop prefetches that will no longer be used
+        for fidx in [i for i in self._futures if i < idx]:
+            self._futures.pop(fidx).cancel()
+        for fidx in range(idx+1, min(idx+1+self.prefetch, len(self.paths))):
+            path = self.paths[fidx]
+            if fidx in self._cache or fidx in self._futures or path is None:
+                continue
+            self._futures[fidx] = self._executor.submit(load_result, path)
+
+    def close(self):
+        """Stop prefetching and clear the cache"""
+        for future in self._futures.values():
+            future.cancel()
+        self._futures = {}
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self._cache.clear()
+        self._cache_nbytes = 0
@@ -0,0 +1,205 @@
+import os
+import re
+import logging
+from .utils import run_command
+from . import pack
+logger = logging.getLogger(__name__)
+
+FAILURE_OOM = "oom"
+FAILURE_WALLTIME = "walltime"
+FAILURE_NODE = "node"
+FAILURE_USER = "user"
+FAILURE_DEPENDENCY = "dependency"
+
+_OOM_PATTERNS = ("MemoryError", "std::bad_alloc", "Cannot allocate memory", "Out of memory")
+_WALLTIME_PATTERNS = ("h_rt", "wallclock", "SIGXCPU")
+_MEMORY_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+def _parse_memory(value):
+    match = re.match(r"^([0-9.]+)([KMGT]?)", value.strip(), re.IGNORECASE)
+    if match is None:
+        return None
+    return float(match.group(1))*_MEMORY_UNITS[match.group(2).upper()]
+
+def _parse_time(value):
+    ws = value.strip().split(":")
+    try:
+        return sum(float(w)*60**idx for idx, w in enumerate(reversed(ws)))
+    except ValueError:
+        return None
+
+def _format_time(seconds):
+    seconds = int(round(seconds))
+    return "{:d}:{:02d}:{:02d}".format(seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+def scale_resource(options, name, factor):
+    """
+    Scale the value of -l name=... (h_vmem or h_rt) in the qsub options by
+    factor. Options without the resource are returned unchanged.
+    """
+    regex = re.compile(r"(?P<key>\b{}=)(?P<value>[^,\s]+)".format(name))
+    match = regex.search(options)
+    if match is None:
+        logger.warning("No {} in options '{}' to scale".format(name, options))
+        return options
+
+    value = match.group("value")
+    if name == "h_rt":
+        seconds = _parse_time(value)
+        if seconds is None:
+            return options
+        new_value = _format_time(seconds*factor)
+    else:
+        unit = re.sub(r"^[0-9.]+", "", value)
+        number = float(value[:len(value)-len(unit)])*factor
+        new_value = "{:g}{}".format(number, unit)
+    return options[:match.start("value")] + new_value + options[match.end("value"):]
+
+class RetryPolicy(object):
+    """
+    Decide how failed tasks are resubmitted without user input. Each failure
+    is classified from the stderr of the copy of the task that failed and
+    the job's accounting
+    information (qacct) as out-of-memory, walltime, node failure, missing
+    dependency (see pysge.ResultOf) or user exception. Memory and walltime
+    failures are resubmitted with h_vmem and h_rt scaled up, node and
+    dependency failures with the same options, while user exceptions fail
+    fast. Each task is retried at most max_retries times.
+
+    Parameters
+    ----------
+    max_retries : int (default = 3)
+        Maximum number of resubmissions of each task.
+
+    memory_factor : float (default = 2)
+        Factor h_vmem is multiplied by after an out-of-memory failure.
+
+    walltime_factor : float (default = 2)
+        Factor h_rt is multiplied by after a walltime failure.
+
+    retry_user_errors : bool (default = False)
+        Resubmit tasks that raised an exception in the user's function.
+
+    use_qacct : bool (default = True)
+        Query qacct for the exit status and resources used by failed jobs.
+    """
+    def __init__(
+        self, max_retries=3, memory_factor=2., walltime_factor=2.,
+        retry_user_errors=False, use_qacct=True,
+    ):
+        self.max_retries = max_retries
+        self.memory_factor = memory_factor
+        self.walltime_factor = walltime_factor
+        self.retry_user_errors = retry_user_errors
+        self.use_qacct = use_qacct
+
+        self.attempts = {}
+        self.task_options = {}
+        self._accounting = {}
+
+    def accounting(self, jobid):
+        """
+        qacct information of job jobid (jobnumber.taskid) as a dict, empty if
+        qacct is missing or fails (e.g. accounting is disabled)
+        """
+        if not self.use_qacct or "." not in jobid:
+            return {}
+        jobnumber, taskid = jobid.split(".", 1)
+        if jobnumber not in self._accounting:
+            try:
+                out, err, returncode = run_command(
+                    "qacct -j {}".format(jobnumber), returncode=True,
+                )
+            except OSError as e:
+                out, err, returncode = b"", str(e).encode("utf-8"), None
+            if returncode != 0:
+                logger.warning("qacct failed for job {}: {}".format(
+                    jobnumber, err.decode("utf-8").strip(),
+                ))
+                # don't run it again for this job
+                self._accounting[jobnumber] = {}
+                return {}
+            tasks = {}
+            for block in out.decode("utf-8").split("=====")[1:]:
+                info = {}
+                for line in block.splitlines():
+                    ws = line.split(None, 1)
+                    if len(ws) == 2:
+                        info[ws[0]] = ws[1].strip()
+                if "taskid" in info:
+                    tasks[info["taskid"]] = info
+            if len(tasks) == 0:
+                # accounting not written yet - don't cache
+                return {}
+            self._accounting[jobnumber] = tasks
+        return self._accounting[jobnumber].get(taskid, {})
+
+    def classify(self, jobid, task, job_options):
+        if os.path.isdir(task):
+            try:
+                with open(pack.stderr_location(task, jobid), 'r') as f:
+                    stderr = f.read()[-10000:]
+            except (IOError, OSError):
+                stderr = None
+        else:
+            # packed working area
+            stderr = pack.task_log(
+                os.path.dirname(task), pack.task_position(task), "err",
+            )
+            stderr = stderr[-10000:] if stderr is not None else None
+        info = self.accounting(jobid)
+
+        if stderr is not None and any(p in stderr for p in _OOM_PATTERNS):
+            return FAILURE_OOM
+        requested = re.search(r"\bh_vmem=([^,\s]+)", job_options)
+        if requested is not None and "maxvmem" in info:
+            limit, used = _parse_memory(requested.group(1)), _parse_memory(info["maxvmem"])
+            if limit is not None and used is not None and used >= 0.95*limit:
+                return FAILURE_OOM
+
+        if stderr is not None and any(p in stderr for p in _WALLTIME_PATTERNS):
+            return FAILURE_WALLTIME
+        requested = re.search(r"\bh_rt=([^,\s]+)", job_options)
+        if requested is not None and "ru_wallclock" in info:
+            limit = _parse_time(requested.group(1))
+            used = re.match(r"[0-9.]+", info["ru_wallclock"])
+            used = float(used.group()) if used is not None else None
+            if limit is not None and used is not None and used >= 0.95*limit:
+                return FAILURE_WALLTIME
+
+        if stderr is not None and "MissingDependency" in stderr:
+            # ran before the result of a task it depends on was written
+            return FAILURE_DEPENDENCY
+        if stderr is not None and "Traceback" in stderr:
+            return FAILURE_USER
+        return FAILURE_NODE
+
+    def resubmit_options(self, jobid, task, job_options):
+        """
+        Return the options to resubmit the failed task with or None if it
+        shouldn't be resubmitted.
+        """
+        options = self.task_options.get(task, job_options)
+        failure = self.classify(jobid, task, options)
+        attempts = self.attempts.get(task, 0)
+
+        if failure == FAILURE_USER and not self.retry_user_errors:
+            logger.error("{} raised an exception, not retrying. See {}".format(
+                task, pack.stderr_location(task, jobid),
+            ))
+            return None
+        if attempts >= self.max_retries:
+            logger.error("{} failed {} times ({}), not retrying".format(
+                task, attempts+1, failure,
+            ))
+            return None
+
+        if failure == FAILURE_OOM:
+            options = scale_resource(options, "h_vmem", self.memory_factor)
+        elif failure == FAILURE_WALLTIME:
+            options = scale_resource(options, "h_rt", self.walltime_factor)
+        logger.info("{} failed ({}), resubmitting with '{}'".format(task, failure, options))
+
+        self.attempts[task] = attempts + 1
+        self.task_options[task] = options
+        return options
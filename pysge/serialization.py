@@ -0,0 +1,196 @@
+import io
+import os
+import gzip
+import json
+import pickle
+import inspect
+import functools
+import importlib
+import dill
+
+# Codecs of the task and result files, named "<serializer>+<compression>" with
+# an optional ":<level>", e.g. "dill+gzip", "pickle+none", "pickle+gzip:1" or
+# "pickle+zstd:3":
+#
+#   serializer   dill (any callable, slower) or pickle (protocol 5, C
+#                pickler - tasks must be importable by reference)
+#   compression  none, gzip (zlib, level 1-9), lz4 or zstd (level 1-22) if
+#                the lz4 or zstandard packages are installed
+#
+# The codec of a working area is recorded in its CODEC_FILE for the workers.
+# Files are decoded whatever codec wrote them: the compression is recognised
+# by its magic bytes and dill loads pickles too.
+DEFAULT_CODEC = "dill+gzip"
+CODEC_FILE = "codec.json"
+SERIALIZERS = ("dill", "pickle")
+COMPRESSIONS = ("none", "gzip", "lz4", "zstd")
+
+_MAGIC = (
+    (b"\x1f\x8b", "gzip"),
+    (b"\x04\x22\x4d\x18", "lz4"),
+    (b"\x28\xb5\x2f\xfd", "zstd"),
+)
+
+def _import(compression):
+    try:
+        if compression == "lz4":
+            import lz4.frame
+            return lz4.frame
+        import zstandard
+        return zstandard
+    except ImportError:
+        raise ImportError(
+            "The {} codec requires the {} package".format(
+                compression, "lz4" if compression == "lz4" else "zstandard",
+            )
+        )
+
+class _Unclosed(object):
+    """File wrapper whose close only flushes, like the compressed writers"""
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, data):
+        return self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class Codec(object):
+    """Serializer and compression of task and result files (see above)"""
+    def __init__(self, name=DEFAULT_CODEC):
+        serializer, _, compression = name.partition("+")
+        compression, _, level = (compression or "none").partition(":")
+        if serializer not in SERIALIZERS:
+            raise ValueError("Unknown serializer '{}'".format(serializer))
+        if compression not in COMPRESSIONS:
+            raise ValueError("Unknown compression '{}'".format(compression))
+        if compression in ("lz4", "zstd"):
+            _import(compression)
+        self.serializer = serializer
+        self.compression = compression
+        self.level = int(level) if level else None
+
+    @property
+    def name(self):
+        name = "{}+{}".format(self.serializer, self.compression)
+        if self.level is not None:
+            name += ":{}".format(self.level)
+        return name
+
+    def __repr__(self):
+        return "Codec({!r})".format(self.name)
+
+    def writer(self, f):
+        """
+        Compressing file object writing to the binary file object f. Closing
+        it finishes the compressed stream but leaves f open.
+        """
+        if self.compression == "gzip":
+            level = 9 if self.level is None else self.level
+            return gzip.GzipFile(fileobj=f, mode='wb', compresslevel=level)
+        elif self.compression == "lz4":
+            return _import("lz4").LZ4FrameFile(
+                f, mode='wb', compression_level=self.level or 0,
+            )
+        elif self.compression == "zstd":
+            compressor = _import("zstd").ZstdCompressor(level=self.level or 3)
+            return compressor.stream_writer(f, closefd=False)
+        return _Unclosed(f)
+
+    def dump(self, obj, f, dill_kw={}):
+        """Serialize obj to the file object f (uncompressed)"""
+        if self.serializer == "pickle":
+            pickle.dump(obj, f, protocol=5)
+        else:
+            dill.dump(obj, f, **dill_kw)
+
+    def dumps(self, obj, dill_kw={}):
+        """Serialized and compressed obj"""
+        data = io.BytesIO()
+        with self.writer(data) as f:
+            self.dump(obj, f, dill_kw)
+        return data.getvalue()
+
+def check_importable(func):
+    """
+    Raise ValueError unless func (the function of a functools.partial, the
+    class of a method's instance or of a callable object) is defined at the
+    top level of an importable module other than __main__. The pickle
+    serializer stores such objects by reference, so anything else pickles
+    in the master but can't be loaded on the nodes.
+    """
+    target = func.func if isinstance(func, functools.partial) else func
+    if inspect.ismethod(target):
+        owner = target.__self__
+        target = owner if inspect.isclass(owner) else type(owner)
+    elif not (
+        inspect.isfunction(target) or inspect.isclass(target)
+        or inspect.isbuiltin(target)
+    ):
+        target = type(target)
+
+    module = getattr(target, "__module__", None)
+    qualname = getattr(target, "__qualname__", "")
+    found = None
+    if module not in (None, "__main__") and "<" not in qualname:
+        try:
+            found = importlib.import_module(module)
+            for attr in qualname.split("."):
+                found = getattr(found, attr)
+        except (ImportError, AttributeError):
+            found = None
+    if found is not target:
+        raise ValueError(
+            "{!r} ({}.{}) can't be imported on the nodes, which the pickle "
+            "serializer needs. Define it in an importable module or use the "
+            "dill serializer".format(func, module, qualname)
+        )
+
+def _compression(head):
+    for magic, compression in _MAGIC:
+        if head.startswith(magic):
+            return compression
+    return "none"
+
+def reader(f):
+    """
+    Decompressing file object reading from the binary file object f, which
+    must be seekable, whatever compression it was written with.
+    """
+    head = f.read(4)
+    f.seek(-len(head), os.SEEK_CUR)
+    compression = _compression(head)
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=f, mode='rb')
+    elif compression == "lz4":
+        return _import("lz4").LZ4FrameFile(f, mode='rb')
+    elif compression == "zstd":
+        decompressor = _import("zstd").ZstdDecompressor()
+        return io.BufferedReader(decompressor.stream_reader(f, closefd=False))
+    return f
+
+def loads(data):
+    """Load an object from bytes written by any codec"""
+    return dill.load(reader(io.BytesIO(data)))
+
+def write_codec(area, codec):
+    with open(os.path.join(area, CODEC_FILE), 'w') as f:
+        json.dump({"codec": codec.name}, f)
+
+def read_codec(area):
+    """Codec of the working area (dill+gzip for areas without a record)"""
+    try:
+        with open(os.path.join(area, CODEC_FILE), 'r') as f:
+            return Codec(json.load(f)["codec"])
+    except (IOError, OSError, ValueError, KeyError):
+        return Codec()
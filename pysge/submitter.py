@@ -2,62 +2,333 @@ import os
 import re
 import logging
 import time
+import tempfile
+import uuid
+import atexit
+import collections
+import multiprocessing
 from builtins import input
-from multiprocessing import Pool
 from tqdm.auto import tqdm
+import dill
 
 from .utils import run_command
+from . import workqueue
 
 logger = logging.getLogger(__name__)
 
 class SGETaskSubmitter(object):
-    submit_command = 'qsub -wd {wd} -V -e /dev/null -o /dev/null -t {start}-{njobs}:1 {job_opts} {executable}'
+    """
+    Submit tasks to SGE as array jobs, each element running one task or a
+    bundle of tasks.
+
+    Parameters
+    ----------
+    job_options : str
+        Options passed to qsub.
+
+    journal : Journal or None (default = None)
+        Journal recording each submission.
+
+    shard_size : int or None (default = None)
+        Maximum number of elements of an array job (e.g. the cluster's
+        max_aj_tasks). Larger submissions are split into array jobs (shards)
+        of at most this many elements.
+
+    max_shards : int or None (default = None)
+        Maximum number of shards with elements waiting in the queue. Further
+        shards are held back and submitted by release_shards, called (through
+        after_query) by the JobMonitor after each query of the batch system,
+        as the elements of earlier shards start running (a sliding window).
+
+    qsub_retries : int (default = 3)
+        Number of times a rejected qsub is retried (with a growing wait)
+        before raising a RuntimeError.
+    """
+    submit_command = 'qsub -wd {wd} -V {env}-e /dev/null -o /dev/null -t {start}-{njobs}:1 {job_opts} {executable}'
     regex_submit = re.compile('Your job-array (?P<jobid>[0-9]+)\.(?P<start>[0-9]+)-(?P<stop>[0-9]+):1 \(".*"\) has been submitted')
-    def __init__(self, job_options):
+    def __init__(
+        self, job_options, journal=None, shard_size=None, max_shards=None,
+        qsub_retries=3,
+    ):
         self.job_options = job_options
+        self.shard_size = shard_size
+        self.max_shards = max_shards
+        self.qsub_retries = qsub_retries
+        # working area of the tasks submitted
+        self.area = None
         self.jobid_tasks = {}
+        # Journal recording each submission, if any
+        self.journal = journal
+        # task -> tasks whose results it needs (see pysge.dag). Submissions
+        # of a task are held until the jobs running these have finished
+        self.dependencies = {}
+        # task -> job id of its last submission and job number -> task id
+        # range of each submission, to hold on them
+        self._task_jobs = {}
+        self._job_ranges = {}
+        # job number -> submission time of the shards in the window and the
+        # shards held back, submitted in order as the window drains
+        self._shards = {}
+        self._held_shards = collections.deque()
+        self._executable = None
+
+    @property
+    def executable(self):
+        if self._executable is None:
+            self._executable = run_command("which pysge_worker.sh")[0].decode("utf-8").strip()
+        return self._executable
 
     def submit_tasks(
         self, tasks, start=0, dryrun=False, request_user_input=False,
-        quiet=False,
+        quiet=False, tasks_per_job=1,
+    ):
+        if tasks is None or len(tasks) <= 0:
+            return
+
+        if start % tasks_per_job != 0:
+            raise ValueError(
+                "start={} is not a multiple of tasks_per_job={}".format(
+                    start, tasks_per_job,
+                )
+            )
+
+        # Each array element runs a bundle of tasks_per_job consecutive tasks
+        bundles = [
+            tasks[idx:idx+tasks_per_job]
+            for idx in range(0, len(tasks), tasks_per_job)
+        ]
+        env = ""
+        if tasks_per_job > 1:
+            env = "-v PYSGE_TASKS_PER_JOB={},PYSGE_NTASKS={} ".format(
+                tasks_per_job, start+len(tasks),
+            )
+        self._submit_bundles(
+            bundles, start // tasks_per_job, env, dryrun=dryrun,
+            request_user_input=request_user_input,
+        )
+
+    def submit_task_list(
+        self, tasks, dryrun=False, request_user_input=False, quiet=False,
+        job_options=None,
     ):
+        """
+        Submit tasks that aren't contiguous (e.g. failed tasks to resubmit) as
+        a single array job. A task-list file is written to the working area
+        with the task directory of each array element on its own line, which
+        pysge_worker.sh reads by SGE_TASK_ID. job_options overrides the
+        submitter's options for this submission.
+
+        Tasks with dependencies are held (-hold_jid) until the jobs last
+        submitted to run the tasks they depend on have finished, which are
+        submitted first if they're in tasks too. Hence they're submitted as
+        an array job per set of jobs they're held on.
+        """
         if tasks is None or len(tasks) <= 0:
             return
 
-        curdir = os.getcwd()
-        njobs = len(tasks)
-        executable = run_command("which pysge_worker.sh")[0].decode("utf-8")
+        pending = list(tasks)
+        while len(pending) > 0:
+            submitting = set(pending)
+            ready = [
+                task for task in pending
+                if not any(dep in submitting for dep in self.dependencies.get(task, []))
+            ]
+            holds = {}
+            for task in ready:
+                jobs = tuple(sorted(set(
+                    jobid.split(".")[0] for jobid in self._dependency_jobs(task)
+                )))
+                holds.setdefault(jobs, []).append(task)
+            for jobs, held_tasks in holds.items():
+                self._submit_list(
+                    [[task] for task in held_tasks],
+                    hold="-hold_jid {} ".format(",".join(jobs)) if len(jobs) > 0 else "",
+                    dryrun=dryrun, request_user_input=request_user_input,
+                    job_options=job_options,
+                )
+            ready = set(ready)
+            pending = [task for task in pending if task not in ready]
 
-        job_opts = self.job_options
-        if request_user_input:
+    def submit_dependent(
+        self, tasks, dryrun=False, request_user_input=False, quiet=False,
+        tasks_per_job=1,
+    ):
+        """
+        Submit tasks whose dependencies have all been submitted. Tasks whose
+        dependencies are all run by one element of an array job are
+        submitted as an array job with the same range held element by
+        element (-hold_jid_ad), so each starts as soon as its inputs exist.
+        The others are submitted with submit_task_list (tasks without
+        dependencies in bundles of tasks_per_job).
+        """
+        aligned, others = {}, []
+        for task in tasks:
+            jobids = set(self._dependency_jobs(task))
+            if len(jobids) != 1:
+                others.append(task)
+                continue
+            jobnumber, taskid = jobids.pop().split(".")
+            aligned.setdefault(jobnumber, {}).setdefault(int(taskid), []).append(task)
+
+        for jobnumber, elements in aligned.items():
+            first, last = self._job_ranges[jobnumber]
+            self._submit_list(
+                [elements.get(taskid, []) for taskid in range(first, last+1)],
+                first=first-1, hold="-hold_jid_ad {} ".format(jobnumber),
+                dryrun=dryrun, request_user_input=request_user_input,
+            )
+
+        independent = [task for task in others if len(self.dependencies.get(task, [])) == 0]
+        if len(independent) > 0:
+            self._submit_list(
+                [
+                    independent[idx:idx+tasks_per_job]
+                    for idx in range(0, len(independent), tasks_per_job)
+                ],
+                dryrun=dryrun, request_user_input=request_user_input,
+            )
+        self.submit_task_list(
+            [task for task in others if len(self.dependencies.get(task, [])) > 0],
+            dryrun=dryrun, request_user_input=request_user_input,
+        )
+
+    def _dependency_jobs(self, task):
+        """Job ids of the last submissions of the dependencies of task"""
+        return [
+            self._task_jobs[dep] for dep in self.dependencies.get(task, [])
+            if dep in self._task_jobs
+        ]
+
+    def _submit_list(
+        self, bundles, first=0, hold="", dryrun=False, request_user_input=False,
+        job_options=None,
+    ):
+        # task list with the bundle of array element first+i on line first+i,
+        # where bundles may be empty
+        tasks = [task for bundle in bundles for task in bundle]
+        if len(tasks) == 0:
+            return
+        wd = os.path.dirname(tasks[0])
+        fd, tasklist = tempfile.mkstemp(prefix="tasklist_", suffix=".txt", dir=wd)
+        with os.fdopen(fd, 'w') as f:
+            f.write("\n"*first)
+            for bundle in bundles:
+                f.write("{}\n".format(" ".join(os.path.basename(task) for task in bundle)))
+        self._submit_bundles(
+            bundles, first, "-v PYSGE_TASKLIST={} ".format(tasklist),
+            dryrun=dryrun, request_user_input=request_user_input,
+            job_options=job_options, wd=wd, hold=hold,
+        )
+
+    def refresh(self):
+        """Update jobid_tasks after each query. Nothing to do for array jobs"""
+        pass
+
+    def _submit_bundles(
+        self, bundles, first, env, dryrun=False, request_user_input=False,
+        job_options=None, wd=None, hold="",
+    ):
+        njobs = len(bundles)
+        job_opts = self.job_options if job_options is None else job_options
+        if request_user_input and job_options is None:
             job_opts = input(
                 "Using job options '{}'. Insert new options or nothing to use "
                 "the default\n:".format(job_opts)
             )
             job_opts = job_opts if job_opts != "" else self.job_options
 
+        env += hold
+        wd = wd if wd is not None else os.path.dirname(bundles[0][0])
+        self.area = wd
+
+        # shards of at most shard_size elements, held back while max_shards
+        # shards are waiting in the queue
+        shard_size = self.shard_size or njobs
+        for idx in range(0, njobs, shard_size):
+            shard = (bundles[idx:idx+shard_size], first+idx, env, job_opts, wd)
+            if not dryrun and self.max_shards is not None and (
+                len(self._held_shards) > 0 or len(self._shards) >= self.max_shards
+            ):
+                self._held_shards.append(shard)
+            else:
+                self._submit_shard(*shard, dryrun=dryrun)
+        if len(self._held_shards) > 0:
+            logger.info("Holding back {} shards".format(len(self._held_shards)))
+
+    def after_query(self, job_statuses, query_time):
+        """
+        Called by the JobMonitor after each query of the batch system, with
+        the states of the array job elements queried at query_time, once the
+        jobs that left the batch system have been checked.
+        """
+        self.release_shards(job_statuses, query_time)
+
+    def release_shards(self, job_statuses, query_time):
+        """
+        Submit held back shards while fewer than max_shards shards have
+        elements waiting in the queue. job_statuses are the states of the
+        array job elements queried at query_time (see JobMonitor).
+        """
+        if len(self._shards) == 0 and len(self._held_shards) == 0:
+            return
+        waiting = set(jobid.split(".")[0] for jobid in job_statuses.get(2, []))
+        self._shards = {
+            jobnumber: submit_time for jobnumber, submit_time in self._shards.items()
+            if jobnumber in waiting or submit_time >= query_time
+        }
+        nreleased = 0
+        while len(self._held_shards) > 0 and len(self._shards) < self.max_shards:
+            self._submit_shard(*self._held_shards.popleft())
+            nreleased += 1
+        if nreleased > 0:
+            logger.info("Released {} shards, {} held back".format(
+                nreleased, len(self._held_shards),
+            ))
+
+    def _submit_shard(self, bundles, first, env, job_opts, wd, dryrun=False):
+        njobs = len(bundles)
+        # submission time so workers can measure their time in the queue
+        submit_time = time.time()
+        env = "-v PYSGE_SUBMIT_TIME={:.3f} ".format(submit_time) + env
         cmd = self.submit_command.format(
-            executable=executable, start=start+1, njobs=njobs+start,
-            job_opts=job_opts, wd=os.path.dirname(tasks[0]),
+            executable=self.executable, start=first+1, njobs=njobs+first,
+            env=env, job_opts=job_opts, wd=wd,
         )
         if not dryrun:
-            out, err = run_command(cmd)
-            match = self.regex_submit.search(out.decode("utf-8"))
-            if match is None:
-                logger.error("Command: {}".format(cmd))
-                logger.error("Malformed qsub submission string: {}".format(repr(out.decode("utf-8"))))
-                logger.error("Skipping and returning on the next resubmission round")
-                return
+            for attempt in range(self.qsub_retries+1):
+                out, err = run_command(cmd)
+                match = self.regex_submit.search(out.decode("utf-8"))
+                if match is not None:
+                    break
+                logger.warning("qsub rejected the submission ({}): {}".format(
+                    attempt+1, repr((out + err).decode("utf-8").strip()),
+                ))
+                if attempt < self.qsub_retries:
+                    time.sleep(2**attempt)
+            else:
+                raise RuntimeError(
+                    "qsub rejected the submission {} times. Command: {}".format(
+                        self.qsub_retries+1, cmd,
+                    )
+                )
             jobid = int(match.group("jobid"))
             start = int(match.group("start"))
             stop = int(match.group("stop"))
             logger.info('Submitted {}.{}-{}:1'.format(jobid, start, stop))
+            if self.journal is not None:
+                self.journal.submitted(jobid, start, bundles, job_opts)
+            if self.max_shards is not None:
+                self._shards[str(jobid)] = submit_time
         else:
             print(cmd)
             jobid = 0
+            start = first+1
 
+        self._job_ranges[str(jobid)] = (start, start+njobs-1)
         for aid in range(njobs):
-            self.jobid_tasks['{}.{}'.format(jobid, aid+start)] = tasks[aid]
+            self.jobid_tasks['{}.{}'.format(jobid, aid+start)] = bundles[aid]
+            for task in bundles[aid]:
+                self._task_jobs[task] = '{}.{}'.format(jobid, aid+start)
 
     def killall(self):
         jids = []
@@ -68,35 +339,198 @@ class SGETaskSubmitter(object):
         cmd = "qdel {}".format(" ".join(jids))
         run_command(cmd)
 
-class MPTaskSubmitter(object):
-    def submit_tasks(self, tasks, ncores=4, sleep=1, quiet=False):
+    def kill(self, jobids):
+        """Delete the array job elements jobids ("jobnumber.taskid")"""
+        if len(jobids) > 0:
+            run_command("qdel {}".format(" ".join(jobids)))
+
+class PilotSubmitter(SGETaskSubmitter):
+    """
+    Submit npilots long-lived pilot jobs instead of a job per task. The tasks
+    are put in the working area's work queue (see pysge.workqueue) and each
+    pilot runs tasks claimed from the queue in one python process until the
+    queue is empty, so imports are paid once per pilot and faster nodes run
+    more tasks.
+
+    jobid_tasks maps each pilot to the tasks it has claimed, refreshed
+    before every poll. The monitor then treats the unfinished tasks of a
+    pilot that's left the batch system as failed, and resubmitting them puts
+    them back in the queue. Tasks still queued belong to no pilot. Pilots
+    exit when they find the queue empty, so after each query of the batch
+    system (and whenever tasks are queued) pilots are submitted until
+    npilots are in the batch system or there's one per queued task.
+    """
+    def __init__(self, job_options, npilots, journal=None, **kwargs):
+        super(PilotSubmitter, self).__init__(job_options, journal=journal, **kwargs)
+        self.npilots = npilots
+        self.area = None
+        self._claimed = {}
+        # pilots in the batch system (or submitted since the last query) and
+        # their submission times
+        self._pilots = {}
+
+    def submit_tasks(
+        self, tasks, start=0, dryrun=False, request_user_input=False,
+        quiet=False, tasks_per_job=1,
+    ):
         if tasks is None or len(tasks) <= 0:
             return
+        self.area = os.path.dirname(tasks[0])
+        workqueue.enqueue(self.area, [os.path.basename(task) for task in tasks])
+        self.top_up(dryrun=dryrun, request_user_input=request_user_input)
 
-        results = []
-        pool = Pool(processes=ncores)
-        pbar = tqdm(total=len(tasks), desc="Finished", disable=quiet, ncols=80)
+    def top_up(self, dryrun=False, request_user_input=False, job_options=None):
+        """
+        Submit pilots until npilots are in the batch system or there's one
+        per queued task. With job_options (e.g. raised resources of retried
+        tasks) at least one pilot is submitted if tasks are queued.
+        """
+        nqueued = len(workqueue.queued_tasks(self.area))
+        npilots = min(self.npilots - len(self._pilots), nqueued)
+        if job_options is not None and nqueued > 0:
+            npilots = max(npilots, 1)
+        if npilots > 0:
+            self.submit_pilots(
+                npilots, dryrun=dryrun, request_user_input=request_user_input,
+                job_options=job_options,
+            )
 
-        try:
-            for task in tasks:
-                results.append(
-                    pool.apply_async(task['task'], task['args'], task['kwargs'])
-                )
+    def submit_pilots(
+        self, npilots, dryrun=False, request_user_input=False, job_options=None,
+    ):
+        submitted = set(self.jobid_tasks)
+        submit_time = time.time()
+        self._submit_bundles(
+            [[] for _ in range(npilots)], 0, "-v PYSGE_PILOT=1 ", dryrun=dryrun,
+            request_user_input=request_user_input, job_options=job_options,
+            wd=self.area,
+        )
+        self._pilots.update(
+            (pilot, submit_time) for pilot in self.jobid_tasks if pilot not in submitted
+        )
 
-            nremaining = len(tasks)
-            while nremaining > 0:
-                nfinished = sum(r.ready() for r in results)
-                nremaining = len(tasks) - nfinished
-                pbar.n = nfinished
-                pbar.refresh()
-                time.sleep(sleep)
+    def after_query(self, job_statuses, query_time):
+        super(PilotSubmitter, self).after_query(job_statuses, query_time)
+        if self.area is None:
+            return
+        queried = set(
+            jobid for jobids in job_statuses.values() for jobid in jobids
+        )
+        self._pilots = {
+            pilot: submit_time for pilot, submit_time in self._pilots.items()
+            if pilot in queried or submit_time >= query_time
+        }
+        self.top_up()
 
-            results = [r.get() for r in results]
-        except KeyboardInterrupt:
-            pool.terminate()
-            results = []
+    def submit_task_list(
+        self, tasks, dryrun=False, request_user_input=False, quiet=False,
+        job_options=None,
+    ):
+        """
+        Put the claimed tasks back in the queue (tasks still queued are left
+        as they are) and top up the pilots to run them.
+        """
+        if tasks is None or len(tasks) <= 0:
+            return
+        for task in tasks:
+            claimed = self._claimed.pop(os.path.basename(task), None)
+            if claimed is not None:
+                workqueue.requeue(self.area, claimed)
+        self.top_up(
+            dryrun=dryrun, request_user_input=request_user_input,
+            job_options=job_options,
+        )
+
+    def refresh(self):
+        if self.area is None:
+            return
+        claimed = workqueue.claimed_tasks(self.area)
+        self._claimed = {}
+        for jobid in self.jobid_tasks:
+            names = claimed.get(jobid, [])
+            self._claimed.update((name.rsplit(".", 2)[0], name) for name in names)
+            self.jobid_tasks[jobid] = [
+                os.path.join(self.area, name.rsplit(".", 2)[0]) for name in names
+            ]
+
+# Persistent pools reused across calls, keyed by (ncores, start_method)
+_pools = {}
+
+def get_pool(ncores, start_method=None, persistent=False):
+    key = (ncores, start_method)
+    if persistent and key in _pools:
+        return _pools[key]
+    pool = multiprocessing.get_context(start_method).Pool(processes=ncores)
+    if persistent:
+        _pools[key] = pool
+    return pool
+
+def shutdown_pools():
+    """Close and join the persistent multiprocessing pools"""
+    for key in list(_pools.keys()):
+        pool = _pools.pop(key)
         pool.close()
-        pbar.close()
-        print("")
+        pool.join()
+
+atexit.register(shutdown_pools)
+
+# Callables loaded in this (worker) process, keyed by id in the master
+_loaded_callables = {}
+
+def _run_dilled_task(item):
+    # callables are dilled so closures and functions defined after a
+    # persistent pool was started can still be run. Each worker only loads a
+    # given callable once.
+    idx, key, payload, args, kwargs = item
+    if key not in _loaded_callables:
+        if len(_loaded_callables) >= 64:
+            _loaded_callables.clear()
+        _loaded_callables[key] = dill.loads(payload)
+    return idx, _loaded_callables[key](*args, **kwargs)
+
+def _dilled_tasks(tasks):
+    # ids are only unique within this call, where the tasks keep them alive
+    token = uuid.uuid4().hex
+    dilled = {}
+    for idx, task in enumerate(tasks):
+        func = task['task']
+        if id(func) not in dilled:
+            dilled[id(func)] = ((token, id(func)), dill.dumps(func))
+        key, payload = dilled[id(func)]
+        yield idx, key, payload, task['args'], task['kwargs']
 
-        return results
+class MPTaskSubmitter(object):
+    def iter_tasks(
+        self, tasks, ncores=4, quiet=False, chunksize=None, ordered=True,
+        persistent=False, start_method=None,
+    ):
+        """
+        Yield (index, result) for each task. Tasks are dispatched to the pool
+        in chunks (by default sized so each core receives ~4 chunks) and
+        results are yielded as each one completes, in task order if ordered
+        is True. With persistent=True the pool is kept alive and reused by
+        later calls with the same ncores and start_method ("fork",
+        "forkserver" or "spawn").
+        """
+        if tasks is None or len(tasks) <= 0:
+            return
+
+        if chunksize is None:
+            chunksize = max(1, -(-len(tasks) // (4*ncores)))
+        pool = get_pool(ncores, start_method=start_method, persistent=persistent)
+        pbar = tqdm(total=len(tasks), desc="Finished", disable=quiet, ncols=80)
+
+        imap = pool.imap if ordered else pool.imap_unordered
+        try:
+            for idx, result in imap(_run_dilled_task, _dilled_tasks(tasks), chunksize=chunksize):
+                pbar.update()
+                yield idx, result
+        except BaseException:
+            pool.terminate()
+            if persistent:
+                _pools.pop((ncores, start_method), None)
+            raise
+        finally:
+            if not persistent:
+                pool.close()
+            pbar.close()
@@ -4,6 +4,8 @@ except ModuleNotFoundError:
     import subprocess as sp
 import shlex
 
-def run_command(cmd):
+def run_command(cmd, returncode=False):
     p = sp.run(shlex.split(cmd), stdout=sp.PIPE, stderr=sp.PIPE)
+    if returncode:
+        return p.stdout, p.stderr, p.returncode
     return p.stdout, p.stderr
@@ -0,0 +1,151 @@
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+logger = logging.getLogger(__name__)
+
+# inotify(7) constants
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+IN_CREATE = 0x00000100
+IN_MOVED_TO = 0x00000080
+_EVENT_HEADER = struct.Struct("iIII")
+
+NETWORK_FILESYSTEMS = ("nfs", "nfs4", "cifs", "smbfs", "lustre", "gpfs", "fuse.sshfs")
+
+def _filesystem_type(path):
+    """Type of the filesystem path lives on, from /proc/mounts"""
+    path = os.path.realpath(path)
+    best, fstype = "", None
+    try:
+        with open("/proc/mounts", 'r') as f:
+            for line in f:
+                ws = line.split()
+                if len(ws) < 3:
+                    continue
+                mount = ws[1]
+                if (path == mount or path.startswith(mount.rstrip("/") + "/")) and len(mount) > len(best):
+                    best, fstype = mount, ws[2]
+    except (IOError, OSError):
+        pass
+    return fstype
+
+class PollingWatcher(object):
+    """
+    Watch a directory for new files by listing it, only when its mtime
+    changes. Works on network filesystems where inotify doesn't see writes
+    from other hosts.
+    """
+    def __init__(self, path, interval=1.):
+        self.path = path
+        self.interval = interval
+        self._seen = set()
+        self._mtime = None
+
+    def poll(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return []
+        # mtime granularity can hide files added within the same tick
+        if mtime == self._mtime and time.time() - mtime > 2.:
+            return []
+        self._mtime = mtime
+        names = [n for n in os.listdir(self.path) if not n.startswith(".")]
+        new = [n for n in names if n not in self._seen]
+        self._seen.update(new)
+        return new
+
+    def wait(self, timeout):
+        """Block for up to timeout seconds and return the new file names"""
+        end = time.time() + timeout
+        while True:
+            new = self.poll()
+            remaining = end - time.time()
+            if len(new) > 0 or remaining <= 0:
+                return new
+            time.sleep(min(self.interval, remaining))
+
+    def close(self):
+        pass
+
+class InotifyWatcher(object):
+    """Watch a directory for new files with Linux inotify"""
+    def __init__(self, path):
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("libc not found")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.path = path
+
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        wd = self._libc.inotify_add_watch(
+            self.fd, path.encode("utf-8"), IN_CREATE | IN_MOVED_TO,
+        )
+        if wd < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+
+        # files created before the watch was added
+        self._pending = [n for n in os.listdir(path) if not n.startswith(".")]
+
+    def _read(self):
+        try:
+            data = os.read(self.fd, 1<<16)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        names, offset = [], 0
+        while offset < len(data):
+            _, _, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset+length].rstrip(b"\0").decode("utf-8")
+            offset += length
+            if name and not name.startswith("."):
+                names.append(name)
+        return names
+
+    def poll(self):
+        names, self._pending = self._pending, []
+        names.extend(self._read())
+        return names
+
+    def wait(self, timeout):
+        """Block for up to timeout seconds and return the new file names"""
+        names = self.poll()
+        if len(names) > 0:
+            return names
+        ready, _, _ = select.select([self.fd], [], [], max(timeout, 0))
+        return self._read() if ready else []
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+def make_watcher(path, backend="auto", interval=1.):
+    """
+    Create a watcher for new files in path. backend is "inotify", "poll" or
+    "auto", which uses inotify unless path is on a network filesystem or
+    inotify is unavailable.
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    if backend == "auto":
+        backend = "poll" if _filesystem_type(path) in NETWORK_FILESYSTEMS else "inotify"
+    if backend == "inotify":
+        try:
+            return InotifyWatcher(path)
+        except (OSError, AttributeError) as e:
+            logger.info("inotify unavailable ({}), polling instead".format(e))
+    elif backend != "poll":
+        raise ValueError("Unknown watcher backend '{}'".format(backend))
+    return PollingWatcher(path, interval=interval)
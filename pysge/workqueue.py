@@ -0,0 +1,81 @@
+import os
+import random
+
+# File-based work queue of a working area for pilot jobs. Each queued task
+# is an empty file queue/<task name>. A pilot claims a task by renaming its
+# file to claimed/<task name>.<job id>.<array task id>, which only one pilot
+# can do.
+QUEUE_DIR = "queue"
+CLAIMED_DIR = "claimed"
+
+def _makedirs(path):
+    if not os.path.exists(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            pass
+
+def enqueue(area, names):
+    """Add the tasks (task directory names) to the queue"""
+    queue = os.path.join(area, QUEUE_DIR)
+    _makedirs(queue)
+    _makedirs(os.path.join(area, CLAIMED_DIR))
+    for name in names:
+        open(os.path.join(queue, name), 'a').close()
+
+def claim_iter(area, pilot):
+    """
+    Yield the names of the tasks claimed from the queue by pilot (a name
+    unique to the pilot job) one at a time until the queue is empty. The
+    queue is listed once and shuffled so pilots rarely race for the same
+    task, and only listed again once the listing is used up.
+    """
+    queue = os.path.join(area, QUEUE_DIR)
+    claimed = os.path.join(area, CLAIMED_DIR)
+    while True:
+        try:
+            names = os.listdir(queue)
+        except OSError:
+            return
+        if len(names) == 0:
+            return
+        random.shuffle(names)
+        for name in names:
+            try:
+                os.rename(
+                    os.path.join(queue, name),
+                    os.path.join(claimed, "{}.{}".format(name, pilot)),
+                )
+            except OSError:
+                # claimed by another pilot
+                continue
+            yield name
+
+def claimed_tasks(area):
+    """Return {pilot: [claimed file names]} of the claimed tasks"""
+    pilots = {}
+    try:
+        names = os.listdir(os.path.join(area, CLAIMED_DIR))
+    except OSError:
+        return pilots
+    for name in names:
+        task, jobnumber, taskid = name.rsplit(".", 2)
+        pilots.setdefault("{}.{}".format(jobnumber, taskid), []).append(name)
+    return pilots
+
+def queued_tasks(area):
+    try:
+        return os.listdir(os.path.join(area, QUEUE_DIR))
+    except OSError:
+        return []
+
+def requeue(area, claimed_name):
+    """Put a claimed task (its claimed file name) back in the queue"""
+    task = claimed_name.rsplit(".", 2)[0]
+    try:
+        os.rename(
+            os.path.join(area, CLAIMED_DIR, claimed_name),
+            os.path.join(area, QUEUE_DIR, task),
+        )
+    except OSError:
+        pass
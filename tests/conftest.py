@@ -0,0 +1,17 @@
+import os
+import pytest
+from pysge.fakesge import FakeSGE
+
+@pytest.fixture
+def sge_pythonpath(monkeypatch):
+    """Let the fake SGE's workers import the task functions in sge_tasks"""
+    tests_dir = os.path.dirname(os.path.abspath(__file__))
+    monkeypatch.setenv("PYTHONPATH", os.pathsep.join(
+        p for p in [tests_dir, os.environ.get("PYTHONPATH")] if p
+    ))
+
+@pytest.fixture
+def fake_sge(tmp_path, sge_pythonpath):
+    """A fake SGE whose workers can import the task functions in sge_tasks"""
+    with FakeSGE(slots=4, path=str(tmp_path / "sge")) as sge:
+        yield sge
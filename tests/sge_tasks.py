@@ -0,0 +1,35 @@
+"""Task functions for the tests, importable by the fake SGE's workers"""
+import os
+import time
+
+def square(x):
+    return x*x
+
+def fail_once(x, flag_dir):
+    """Raise the first time it's called for x, return x*x after that"""
+    flag = os.path.join(flag_dir, str(x))
+    if not os.path.exists(flag):
+        open(flag, 'w').close()
+        raise RuntimeError("first attempt of {}".format(x))
+    return x*x
+
+def fail(x):
+    raise ValueError(x)
+
+def pid(x):
+    return os.getpid()
+
+def slow_once(x, flag_dir, delay):
+    """Sleep for delay seconds the first time it's called for x"""
+    flag = os.path.join(flag_dir, str(x))
+    if not os.path.exists(flag):
+        open(flag, 'w').close()
+        time.sleep(delay)
+    return x*x
+
+def scale(array, factor):
+    """The array times factor, and whether array was memory-mapped"""
+    base = array
+    while getattr(base, "base", None) is not None:
+        base = base.base
+    return array*factor, type(getattr(base, "obj", None)).__name__ == "mmap"
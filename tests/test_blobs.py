@@ -0,0 +1,27 @@
+import os
+import pysge
+from pysge.blobs import evict_cache
+
+def test_evict_cache(tmp_path):
+    for idx in range(4):
+        path = tmp_path / "{}.p.gz".format(idx)
+        path.write_bytes(b"x"*100)
+        os.utime(str(path), (idx, idx))
+    evict_cache(str(tmp_path), 250, keep=str(tmp_path / "0.p.gz"))
+    # the least recently used go first, but not the one kept
+    assert sorted(os.listdir(str(tmp_path))) == ["0.p.gz", "3.p.gz"]
+
+def test_dedup_cache(fake_sge, tmp_path, monkeypatch):
+    cache_dir = tmp_path / "blobs"
+    monkeypatch.setenv("PYSGE_BLOB_CACHE", str(cache_dir))
+    monkeypatch.setenv("PYSGE_BLOB_CACHE_SIZE", str(150*1024))
+    args = [os.urandom(100*1024) for _ in range(3)]
+    tasks = [{"task": len, "args": (args[idx % 3],), "kwargs": {}} for idx in range(6)]
+    results = pysge.sge_submit(
+        tasks, "test", str(tmp_path), dedup=True, quiet=True, sleep=0.2,
+        request_resubmission_options=False,
+    )
+    assert results == [100*1024]*6
+    blobs = [path for path in cache_dir.iterdir() if path.name.endswith(".p.gz")]
+    assert 0 < len(blobs) < 3
+    assert not any(path.name.endswith(".tmp") for path in cache_dir.iterdir())
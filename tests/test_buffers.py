@@ -0,0 +1,59 @@
+import os
+import glob
+import pytest
+import pysge
+import sge_tasks
+from pysge import buffers
+
+np = pytest.importorskip("numpy")
+
+def _dump(obj, path, **kwargs):
+    with open(path, 'wb') as f:
+        return buffers.dump(obj, f, path, **kwargs)
+
+def _load(path):
+    with open(path, 'rb') as f:
+        return buffers.load(f, path)
+
+@pytest.mark.parametrize("serializer", ["dill", "pickle"])
+def test_dump_load(tmp_path, serializer):
+    path = str(tmp_path / "obj.p")
+    obj = {"large": np.arange(1000, dtype=np.float64), "small": np.arange(10)}
+    assert _dump(obj, path, min_size=1024, serializer=serializer) == 8000
+    # only the large array is out-of-band
+    assert len(buffers.buffer_paths(path)) == 1
+    loaded = _load(path)
+    assert np.array_equal(loaded["large"], obj["large"])
+    assert np.array_equal(loaded["small"], obj["small"])
+    # memory-mapped copy-on-write, so still writeable without touching the file
+    loaded["large"][0] = -1.
+    assert _load(path)["large"][0] == 0.
+
+def test_copy_remove(tmp_path):
+    src, dst = str(tmp_path / "src.p"), str(tmp_path / "dst.p")
+    _dump([np.ones(512)], src, min_size=1024)
+    buffers.copy(src, dst)
+    assert np.array_equal(_load(dst)[0], np.ones(512))
+    buffers.remove(src)
+    assert sorted(os.listdir(str(tmp_path))) == ["dst.p", "dst.p.0.buf", "dst.p.buffers.json"]
+
+def test_submit_oob(fake_sge, tmp_path):
+    array = np.arange(100000, dtype=np.float64)
+    tasks = [{"task": sge_tasks.scale, "args": (array, idx), "kwargs": {}} for idx in range(3)]
+    results = pysge.sge_submit(
+        tasks, "test", str(tmp_path), oob_min_size=1<<16, quiet=True,
+        sleep=0.2, request_resubmission_options=False,
+    )
+    for idx, (result, mapped) in enumerate(results):
+        assert np.array_equal(result, array*idx)
+        assert mapped
+    # the arrays in and out are in buffer files
+    area = glob.glob(str(tmp_path / "tpd_*"))[0]
+    assert len(glob.glob(os.path.join(area, "task_*", "*.buf"))) == 6
+
+def test_packed_oob(fake_sge, tmp_path):
+    with pytest.raises(ValueError):
+        pysge.sge_submit(
+            [{"task": sge_tasks.square, "args": (1,), "kwargs": {}}], "test",
+            str(tmp_path), oob_min_size=1<<16, layout="packed", quiet=True,
+        )
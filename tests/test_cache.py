@@ -0,0 +1,78 @@
+import os
+import time
+import functools
+import pytest
+import pysge
+import sge_tasks
+from pysge.cache import ResultCache, callable_hash
+from pysge.results import load_result
+
+SUBMIT_KW = dict(quiet=True, sleep=0.2, request_resubmission_options=False)
+
+def _task(func, *args, **kwargs):
+    return {"task": func, "args": args, "kwargs": kwargs}
+
+def test_callable_hash():
+    def make(offset):
+        def func(x, y=1):
+            return x + offset
+        return func
+    assert callable_hash(sge_tasks.square) == callable_hash(sge_tasks.square)
+    # the closure is part of the hash
+    assert callable_hash(make(1)) == callable_hash(make(1))
+    assert callable_hash(make(1)) != callable_hash(make(2))
+    assert callable_hash(sge_tasks.square) != callable_hash(sge_tasks.fail)
+    partial = functools.partial(sge_tasks.fail_once, flag_dir="a")
+    assert callable_hash(partial) != callable_hash(functools.partial(sge_tasks.fail_once, flag_dir="b"))
+
+def test_put_get_invalidate(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    task = _task(sge_tasks.square, 3)
+    assert cache.get(task) is None
+    cache.put(task, 9)
+    assert load_result(cache.get(task)) == 9
+    assert cache.get(_task(sge_tasks.square, 4)) is None
+    cache.put(_task(sge_tasks.square, 4), 16)
+    cache.put(_task(sge_tasks.fail, 1), None)
+    assert cache.invalidate(task=task) == 1
+    assert cache.get(task) is None
+    assert cache.invalidate(func=sge_tasks.square) == 1
+    assert cache.get(_task(sge_tasks.fail, 1)) is not None
+    cache.clear()
+    assert cache.get(_task(sge_tasks.fail, 1)) is None
+
+def test_evict(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    tasks = [_task(sge_tasks.square, idx) for idx in range(3)]
+    for idx, task in enumerate(tasks):
+        path = cache.put(task, b"x"*1000)
+        os.utime(path, (idx, idx))
+    size = os.path.getsize(cache.task_path(tasks[0]))
+    cache.max_bytes = 2*size
+    # the least recently used goes first
+    assert cache.evict() == 1
+    assert [cache.get(task) is not None for task in tasks] == [False, True, True]
+    cache.max_bytes, cache.max_age = None, 60
+    os.utime(cache.task_path(tasks[1]), (time.time()-120,)*2)
+    assert cache.evict() == 1
+    assert cache.get(tasks[2]) is not None
+
+def test_local_submit_cache(tmp_path):
+    tasks = [_task(sge_tasks.square, idx) for idx in range(3)]
+    assert pysge.local_submit(tasks, quiet=True, cache=str(tmp_path)) == [0, 1, 4]
+    # only the misses are run
+    cache = ResultCache(str(tmp_path))
+    cache.put(tasks[1], "cached")
+    assert pysge.local_submit(tasks, quiet=True, cache=cache) == [0, "cached", 4]
+
+@pytest.mark.parametrize("layout", ["dirs", "packed"])
+def test_sge_submit_cache(fake_sge, tmp_path, layout):
+    cache = ResultCache(str(tmp_path / "cache"))
+    tasks = [_task(sge_tasks.square, idx) for idx in range(4)]
+    kwargs = dict(layout=layout, cache=cache, **SUBMIT_KW)
+    assert pysge.sge_submit(tasks[:2], "test", str(tmp_path), **kwargs) == [0, 1]
+    assert pysge.sge_submit(tasks, "test", str(tmp_path), **kwargs) == [0, 1, 4, 9]
+    # the cached tasks weren't submitted again, and nothing is the third time
+    assert len(os.listdir(os.path.join(fake_sge.path, "acct"))) == 4
+    assert pysge.sge_submit(tasks, "test", str(tmp_path), **kwargs) == [0, 1, 4, 9]
+    assert len(os.listdir(os.path.join(fake_sge.path, "acct"))) == 4
@@ -0,0 +1,38 @@
+import pytest
+import pysge
+import sge_tasks
+from pysge import dag
+
+SUBMIT_KW = dict(quiet=True, sleep=0.2, request_resubmission_options=False)
+
+def _pipeline(n):
+    """map -> merge -> fit chained by ResultOf"""
+    tasks = [{"task": sge_tasks.square, "args": (idx,), "kwargs": {}} for idx in range(n)]
+    tasks.append({"task": sum, "args": ([pysge.ResultOf(idx) for idx in range(n)],), "kwargs": {}})
+    tasks.append({"task": sge_tasks.square, "args": (), "kwargs": {"x": pysge.ResultOf(n)}})
+    return tasks
+
+def test_dependencies():
+    tasks = _pipeline(3)
+    deps = dag.dependencies(tasks)
+    assert deps == {3: [0, 1, 2], 4: [3]}
+    assert dag.levels(len(tasks), deps) == [[0, 1, 2], [3], [4]]
+    with pytest.raises(ValueError):
+        dag.dependencies([{"task": abs, "args": (pysge.ResultOf(0),), "kwargs": {}}])
+
+@pytest.mark.parametrize("layout", ["dirs", "packed"])
+def test_result_of(fake_sge, tmp_path, layout):
+    results = pysge.sge_submit(
+        _pipeline(4), "test", str(tmp_path), layout=layout, **SUBMIT_KW
+    )
+    assert results == [0, 1, 4, 9, 14, 196]
+
+def test_result_of_bundled(fake_sge, tmp_path):
+    results = pysge.sge_submit(
+        _pipeline(5), "test", str(tmp_path), tasks_per_job=2, **SUBMIT_KW
+    )
+    assert results == [0, 1, 4, 9, 16, 30, 900]
+
+def test_result_of_pilots(fake_sge, tmp_path):
+    with pytest.raises(ValueError):
+        pysge.sge_submit(_pipeline(2), "test", str(tmp_path), pilots=1, **SUBMIT_KW)
@@ -0,0 +1,40 @@
+import asyncio
+import pytest
+import pysge
+import sge_tasks
+
+EXECUTOR_KW = dict(
+    sleep=0.2, batch_wait=0.1,
+    monitor_kw={"retry_policy": pysge.RetryPolicy(max_retries=0, use_qacct=False)},
+)
+
+def test_executor(fake_sge, tmp_path):
+    with pysge.SGEExecutor("test", str(tmp_path), **EXECUTOR_KW) as executor:
+        future = executor.submit(sge_tasks.square, 3)
+        assert future.result() == 9
+        # submitted after the first array job
+        assert list(executor.map(sge_tasks.square, range(5))) == [idx*idx for idx in range(5)]
+
+def test_executor_failure(fake_sge, tmp_path):
+    with pysge.SGEExecutor("test", str(tmp_path), **EXECUTOR_KW) as executor:
+        good = executor.submit(sge_tasks.square, 2)
+        bad = executor.submit(sge_tasks.fail, 1)
+        assert good.result() == 4
+        with pytest.raises(pysge.TaskFailed):
+            bad.result()
+
+def test_executor_shutdown(fake_sge, tmp_path):
+    executor = pysge.SGEExecutor("test", str(tmp_path), **EXECUTOR_KW)
+    future = executor.submit(sge_tasks.square, 4)
+    executor.shutdown(wait=True)
+    assert future.result(timeout=0) == 16
+    with pytest.raises(RuntimeError):
+        executor.submit(sge_tasks.square, 5)
+
+def test_async_executor(fake_sge, tmp_path):
+    async def run():
+        async with pysge.AsyncSGEExecutor("test", str(tmp_path), **EXECUTOR_KW) as executor:
+            single = await executor.submit(sge_tasks.square, 3)
+            results = await executor.map(sge_tasks.square, range(4))
+        return single, results
+    assert asyncio.run(run()) == (9, [0, 1, 4, 9])
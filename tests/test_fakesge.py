@@ -0,0 +1,282 @@
+import os
+import glob
+import operator
+import pytest
+import pysge
+import sge_tasks
+from pysge.fakesge import FakeSGE
+
+SUBMIT_KW = dict(quiet=True, sleep=0.2, request_resubmission_options=False)
+
+def _tasks(func, n, *args):
+    return [{"task": func, "args": (idx,) + args, "kwargs": {}} for idx in range(n)]
+
+def _array_tasks(sge):
+    """<job id>.<task id> of the array job elements sge has accounted for"""
+    return sorted(
+        name[:-len(".json")] for name in os.listdir(os.path.join(sge.path, "acct"))
+    )
+
+@pytest.mark.parametrize("layout", ["dirs", "packed"])
+def test_submit(fake_sge, tmp_path, layout):
+    results = pysge.sge_submit(
+        _tasks(sge_tasks.square, 7), "test", str(tmp_path), layout=layout,
+        **SUBMIT_KW
+    )
+    assert results == [idx*idx for idx in range(7)]
+
+@pytest.mark.parametrize("layout", ["dirs", "packed"])
+def test_bundling(fake_sge, tmp_path, layout):
+    results = pysge.sge_submit(
+        _tasks(sge_tasks.square, 10), "test", str(tmp_path), layout=layout,
+        tasks_per_job=4, **SUBMIT_KW
+    )
+    assert results == [idx*idx for idx in range(10)]
+    assert _array_tasks(fake_sge) == ["1.1", "1.2", "1.3"]
+
+@pytest.mark.parametrize("layout", ["dirs", "packed"])
+def test_bundle_in_one_process(fake_sge, tmp_path, layout):
+    pids = pysge.sge_submit(
+        _tasks(sge_tasks.pid, 6), "test", str(tmp_path), layout=layout,
+        tasks_per_job=3, **SUBMIT_KW
+    )
+    assert len(set(pids[:3])) == 1
+    assert len(set(pids[3:])) == 1
+    assert pids[0] != pids[3]
+    if layout == "dirs":
+        # the tasks still have their own logs
+        area = glob.glob(str(tmp_path / "tpd_*"))[0]
+        assert len(glob.glob(os.path.join(area, "task_*", "stderr*.txt"))) == 6
+
+@pytest.mark.parametrize("layout", ["dirs", "packed"])
+def test_resubmission(fake_sge, tmp_path, layout):
+    flag_dir = str(tmp_path / "flags")
+    os.makedirs(flag_dir)
+    results = pysge.sge_submit(
+        _tasks(sge_tasks.fail_once, 5, flag_dir), "test", str(tmp_path),
+        layout=layout, tasks_per_job=2, **SUBMIT_KW
+    )
+    assert results == [idx*idx for idx in range(5)]
+    assert len(os.listdir(flag_dir)) == 5
+
+def test_retry_policy_gives_up(fake_sge, tmp_path):
+    tasks = _tasks(sge_tasks.square, 3) + _tasks(sge_tasks.fail, 1)
+    results = pysge.sge_submit(
+        tasks, "test", str(tmp_path),
+        monitor_kw={"retry_policy": pysge.RetryPolicy(use_qacct=False)},
+        **SUBMIT_KW
+    )
+    assert results == [0, 1, 4, None]
+    # a user error isn't retried
+    assert _array_tasks(fake_sge) == ["1.1", "1.2", "1.3", "1.4"]
+
+@pytest.mark.parametrize("layout", ["dirs", "packed"])
+def test_resume(fake_sge, tmp_path, layout):
+    tasks = _tasks(sge_tasks.square, 6)
+    results = pysge.sge_submit(
+        tasks, "test", str(tmp_path), layout=layout, **SUBMIT_KW
+    )
+    area = glob.glob(str(tmp_path / "tpd_*"))[0]
+    assert pysge.sge_resume("test", area, **SUBMIT_KW) == results
+    # finished tasks aren't submitted again
+    assert len(_array_tasks(fake_sge)) == 6
+
+@pytest.mark.parametrize("layout", ["dirs", "packed"])
+def test_pilots(fake_sge, tmp_path, layout):
+    results = pysge.sge_submit(
+        _tasks(sge_tasks.square, 12), "test", str(tmp_path), layout=layout,
+        pilots=2, area_chunksize=4,
+        monitor_kw={"retry_policy": pysge.RetryPolicy(max_retries=0, use_qacct=False)},
+        **SUBMIT_KW
+    )
+    assert results == [idx*idx for idx in range(12)]
+
+def test_speculation(fake_sge, tmp_path):
+    flag_dir = str(tmp_path / "flags")
+    os.makedirs(flag_dir)
+    # only the straggler (task 0) is slow the first time, the others are
+    # flagged as already run
+    for idx in range(1, 6):
+        open(os.path.join(flag_dir, str(idx)), 'w').close()
+    results = pysge.sge_submit(
+        _tasks(sge_tasks.slow_once, 6, flag_dir, 60), "test", str(tmp_path),
+        monitor_kw={"speculate": 2., "speculate_min_finished": 3},
+        **SUBMIT_KW
+    )
+    assert results == [idx*idx for idx in range(6)]
+    area = glob.glob(str(tmp_path / "tpd_*"))[0]
+    # both copies of the straggler kept their own logs
+    logs = sorted(os.listdir(os.path.join(area, "task_00000")))
+    assert [log for log in logs if log.startswith("stderr")] == ["stderr.1.txt", "stderr.2.txt"]
+
+def test_result_claim(tmp_path):
+    from pysge.completion import write_result, RESULT_FILE
+    from pysge.results import load_result
+    path = str(tmp_path)
+    assert write_result(1, path) is not None
+    # a second copy of the task doesn't overwrite the published result
+    assert write_result(2, path) is None
+    assert load_result(os.path.join(path, RESULT_FILE)) == 1
+
+def test_classify_reads_failed_copy(tmp_path):
+    task = tmp_path / "task_00000"
+    task.mkdir()
+    (task / "stderr.1.txt").write_text(u"MemoryError\n")
+    (task / "stderr.2.txt").write_text(u"ValueError: 0\n")
+    policy = pysge.RetryPolicy(use_qacct=False)
+    assert policy.classify("1.1", str(task), "") == pysge.retry.FAILURE_OOM
+    assert policy.classify("2.1", str(task), "") != pysge.retry.FAILURE_OOM
+
+@pytest.mark.parametrize("layout", ["dirs", "packed"])
+def test_resume_running(fake_sge, tmp_path, layout):
+    flag_dir = str(tmp_path / "flags")
+    os.makedirs(flag_dir)
+    # submitted without being monitored, so the jobs are still running on
+    # resume
+    pysge.sge_submit_yield(
+        _tasks(sge_tasks.slow_once, 4, flag_dir, 2), "test", str(tmp_path),
+        layout=layout, quiet=True, sleep=0.2, request_resubmission_options=False,
+    )
+    area = glob.glob(str(tmp_path / "tpd_*"))[0]
+    results = pysge.sge_resume("test", area, **SUBMIT_KW)
+    assert results == [idx*idx for idx in range(4)]
+    # reattached to the running jobs instead of resubmitting the tasks
+    assert _array_tasks(fake_sge) == ["1.1", "1.2", "1.3", "1.4"]
+
+def test_resume_given_up(fake_sge, tmp_path):
+    tasks = _tasks(sge_tasks.square, 3) + _tasks(sge_tasks.fail, 1)
+    pysge.sge_submit(
+        tasks, "test", str(tmp_path),
+        monitor_kw={"retry_policy": pysge.RetryPolicy(use_qacct=False)},
+        **SUBMIT_KW
+    )
+    area = glob.glob(str(tmp_path / "tpd_*"))[0]
+    # the failed task is reported without prompting for options or being
+    # resubmitted
+    results = pysge.sge_resume(
+        "test", area, quiet=True, sleep=0.2, request_resubmission_options=True,
+    )
+    assert results == [0, 1, 4, None]
+    assert len(_array_tasks(fake_sge)) == 4
+
+@pytest.mark.parametrize("layout", ["dirs", "packed"])
+def test_lazy(fake_sge, tmp_path, layout):
+    tasks = _tasks(sge_tasks.square, 6) + _tasks(sge_tasks.fail, 1)
+    results = pysge.sge_submit(
+        tasks, "test", str(tmp_path), layout=layout,
+        lazy={"cache_size": 2, "prefetch": 2},
+        monitor_kw={"retry_policy": pysge.RetryPolicy(use_qacct=False)},
+        **SUBMIT_KW
+    )
+    assert isinstance(results, pysge.LazyResults)
+    assert len(results) == 7
+    assert list(results) == [idx*idx for idx in range(6)] + [None]
+    assert len(results._cache) == 2
+    assert results[-2] == 25
+    assert list(results[1:3]) == [1, 4]
+    results.close()
+
+    area = glob.glob(str(tmp_path / "tpd_*"))[0]
+    assert list(pysge.sge_resume("test", area, lazy=True, **SUBMIT_KW)) == list(results)
+
+@pytest.mark.parametrize("layout", ["dirs", "packed"])
+@pytest.mark.parametrize("fanin", [None, 2, 3])
+def test_map_reduce(fake_sge, tmp_path, layout, fanin):
+    total = pysge.sge_map_reduce(
+        _tasks(sge_tasks.square, 10), operator.add, "test", str(tmp_path),
+        fanin=fanin, layout=layout, **SUBMIT_KW
+    )
+    assert total == sum(idx*idx for idx in range(10))
+    if fanin is not None:
+        # a reduction job per group of fanin results, up the tree, except
+        # for the last fanin results reduced in the master
+        areas = glob.glob(str(tmp_path / "tpd_*"))
+        assert len(areas) == 2
+        assert len(_array_tasks(fake_sge)) > 10
+
+@pytest.mark.parametrize("fanin", [None, 2])
+def test_map_reduce_failure(fake_sge, tmp_path, fanin):
+    tasks = _tasks(sge_tasks.square, 4) + _tasks(sge_tasks.fail, 1)
+    with pytest.raises(pysge.TaskFailed):
+        pysge.sge_map_reduce(
+            tasks, operator.add, "test", str(tmp_path), fanin=fanin,
+            monitor_kw={"retry_policy": pysge.RetryPolicy(use_qacct=False)},
+            **SUBMIT_KW
+        )
+
+def test_map_reduce_small(fake_sge, tmp_path):
+    # no more results than fanin are reduced in the master only
+    assert pysge.sge_map_reduce(
+        _tasks(sge_tasks.square, 3), operator.add, "test", str(tmp_path),
+        fanin=4, **SUBMIT_KW
+    ) == 5
+    assert len(glob.glob(str(tmp_path / "tpd_*"))) == 1
+    assert pysge.sge_map_reduce([], operator.add, "test", str(tmp_path), fanin=4, **SUBMIT_KW) is None
+
+def test_map_reduce_overlap(fake_sge, tmp_path):
+    flag_dir = str(tmp_path / "flags")
+    os.makedirs(flag_dir)
+    for idx in range(1, 5):
+        open(os.path.join(flag_dir, str(idx)), 'w').close()
+    total = pysge.sge_map_reduce(
+        _tasks(sge_tasks.slow_once, 5, flag_dir, 5), operator.add, "test",
+        str(tmp_path), fanin=2, **SUBMIT_KW
+    )
+    assert total == sum(idx*idx for idx in range(5))
+    # the results of the fast tasks were reduced while the slow one ran
+    acct = os.path.join(fake_sge.path, "acct")
+    ended = {name[:-len(".json")]: os.path.getmtime(os.path.join(acct, name)) for name in os.listdir(acct)}
+    assert min(t for name, t in ended.items() if not name.startswith("1.")) < ended["1.1"]
+
+@pytest.mark.parametrize("layout", ["dirs", "packed"])
+def test_shards(fake_sge, tmp_path, layout):
+    results = pysge.sge_submit(
+        _tasks(sge_tasks.square, 10), "test", str(tmp_path), layout=layout,
+        tasks_per_job=2, submitter_kw={"shard_size": 2, "max_shards": 1},
+        **SUBMIT_KW
+    )
+    assert results == [idx*idx for idx in range(10)]
+    # 5 bundles in shards of 2 array job elements, each numbered on from the
+    # last shard
+    assert _array_tasks(fake_sge) == ["1.1", "1.2", "2.3", "2.4", "3.5"]
+
+def test_shards_max_aj_tasks(tmp_path, sge_pythonpath):
+    with FakeSGE(slots=4, max_aj_tasks=3, path=str(tmp_path / "sge")):
+        results = pysge.sge_submit(
+            _tasks(sge_tasks.square, 7), "test", str(tmp_path),
+            submitter_kw={"shard_size": 3}, **SUBMIT_KW
+        )
+    assert results == [idx*idx for idx in range(7)]
+
+def test_shards_dependencies(fake_sge, tmp_path):
+    tasks = _tasks(sge_tasks.square, 2)
+    tasks.append({"task": sum, "args": ([pysge.ResultOf(0), pysge.ResultOf(1)],), "kwargs": {}})
+    with pytest.raises(ValueError):
+        pysge.sge_submit(
+            tasks, "test", str(tmp_path), submitter_kw={"max_shards": 1},
+            **SUBMIT_KW
+        )
+
+@pytest.mark.parametrize("layout", ["dirs", "packed"])
+def test_as_completed(fake_sge, tmp_path, layout):
+    flag_dir = str(tmp_path / "flags")
+    os.makedirs(flag_dir)
+    for idx in range(1, 4):
+        open(os.path.join(flag_dir, str(idx)), 'w').close()
+    completed = list(pysge.sge_as_completed(
+        _tasks(sge_tasks.slow_once, 4, flag_dir, 2), "test", str(tmp_path),
+        layout=layout, **SUBMIT_KW
+    ))
+    # each task once, in the order they finished
+    assert sorted(completed) == [(idx, idx*idx) for idx in range(4)]
+    assert completed[-1] == (0, 0)
+
+def test_as_completed_failure(fake_sge, tmp_path):
+    tasks = _tasks(sge_tasks.square, 3) + _tasks(sge_tasks.fail, 1)
+    completed = pysge.sge_as_completed(
+        tasks, "test", str(tmp_path), return_files=True,
+        monitor_kw={"retry_policy": pysge.RetryPolicy(use_qacct=False)},
+        **SUBMIT_KW
+    )
+    # the failed task isn't yielded
+    assert sorted(idx for idx, _ in completed) == [0, 1, 2]
@@ -0,0 +1,60 @@
+import os
+import glob
+import json
+import pytest
+import pysge
+import sge_tasks
+from pysge import hybrid
+from pysge.fakesge import FakeSGE
+
+SUBMIT_KW = dict(quiet=True, sleep=0.2, request_resubmission_options=False)
+
+def _tasks(n, **kwargs):
+    return [
+        dict({"task": sge_tasks.square, "args": (idx,), "kwargs": {}}, **kwargs)
+        for idx in range(n)
+    ]
+
+@pytest.fixture
+def held_sge(tmp_path, sge_pythonpath):
+    """A fake SGE which never starts the jobs"""
+    with FakeSGE(slots=4, hold=True, path=str(tmp_path / "sge")) as sge:
+        yield sge
+
+def test_local_order():
+    tasks = [{"task": abs, "args": (), "kwargs": {}, "seconds": 5}, {"task": abs, "args": (), "kwargs": {}}]
+    tasks += _tasks(3)
+    tasks[3]["seconds"] = 1
+    costs = hybrid.estimate_costs(tasks, {hybrid.task_name(tasks[2]): 2})
+    assert costs == [5, None, 2, 1, 2]
+    assert hybrid.local_order(costs) == [3, 2, 4, 0, 1]
+    assert hybrid.local_order(costs, max_seconds=2, exclude={4: [0]}) == [3, 2, 1]
+
+@pytest.mark.parametrize("layout", ["dirs", "packed"])
+def test_hybrid_local(held_sge, tmp_path, layout):
+    results = pysge.sge_hybrid_submit(
+        _tasks(6), "test", str(tmp_path), ncores=2, layout=layout, **SUBMIT_KW
+    )
+    assert results == [idx*idx for idx in range(6)]
+    # all run locally and the queued jobs deleted
+    assert os.listdir(os.path.join(held_sge.path, "acct")) == []
+    if layout == "dirs":
+        area = glob.glob(str(tmp_path / "tpd_*"))[0]
+        assert len(glob.glob(os.path.join(area, "task_*", "stderr.local.txt"))) == 6
+    # the runtimes are learned for later runs
+    with open(str(tmp_path / hybrid.COSTS_FILE), 'r') as f:
+        assert list(json.load(f)) == ["sge_tasks.square"]
+
+def test_hybrid_mixed(fake_sge, tmp_path):
+    tasks = _tasks(6)
+    for idx, task in enumerate(tasks):
+        task["seconds"] = idx
+    results = pysge.sge_hybrid_submit(
+        tasks, "test", str(tmp_path), ncores=1, local_max_seconds=2,
+        **SUBMIT_KW
+    )
+    assert results == [idx*idx for idx in range(6)]
+    # the tasks estimated to be too long are left to the batch
+    area = glob.glob(str(tmp_path / "tpd_*"))[0]
+    for idx in range(3, 6):
+        assert not os.path.exists(os.path.join(area, "task_{:05d}".format(idx), "stderr.local.txt"))
@@ -0,0 +1,30 @@
+import pytest
+import pysge
+import pysge.retry
+
+@pytest.mark.parametrize("error", [
+    FileNotFoundError("qacct"), (b"", b"error: accounting file not found", 1),
+])
+def test_accounting_failure(monkeypatch, error):
+    calls = []
+    def run_command(cmd, returncode=False):
+        calls.append(cmd)
+        if isinstance(error, Exception):
+            raise error
+        return error
+    monkeypatch.setattr(pysge.retry, "run_command", run_command)
+
+    policy = pysge.RetryPolicy()
+    assert policy.accounting("1.1") == {}
+    assert policy.accounting("1.2") == {}
+    # the failure is cached for the job
+    assert calls == ["qacct -j 1"]
+    assert policy.classify("1.1", "task_00000", "-l h_vmem=1G") == pysge.retry.FAILURE_NODE
+
+def test_accounting(fake_sge, tmp_path):
+    pysge.sge_submit(
+        [{"task": abs, "args": (-1,), "kwargs": {}}], "test", str(tmp_path),
+        quiet=True, sleep=0.2, request_resubmission_options=False,
+    )
+    info = pysge.RetryPolicy().accounting("1.1")
+    assert info["taskid"] == "1"
@@ -0,0 +1,49 @@
+import functools
+import collections
+import pytest
+import pysge
+import sge_tasks
+from pysge.serialization import Codec, loads, check_importable
+
+CODECS = ["dill+gzip", "dill+none", "pickle+gzip:1", "pickle+lz4", "pickle+zstd:3", "pickle"]
+
+@pytest.mark.parametrize("name", CODECS)
+def test_codec(name):
+    codec = Codec(name)
+    obj = {"a": list(range(100)), "b": collections.OrderedDict(c=b"x"*1000)}
+    # read back whatever the compression
+    assert loads(codec.dumps(obj)) == obj
+    assert Codec(codec.name).name == codec.name
+
+@pytest.mark.parametrize("name", ["json+gzip", "dill+bz2"])
+def test_unknown_codec(name):
+    with pytest.raises(ValueError):
+        Codec(name)
+
+def test_check_importable():
+    check_importable(sge_tasks.square)
+    check_importable(functools.partial(sge_tasks.fail_once, flag_dir="."))
+    check_importable(len)
+    check_importable(Codec("pickle").dumps)
+    def local(x):
+        return x
+    for func in (lambda x: x, local, functools.partial(local, 1)):
+        with pytest.raises(ValueError):
+            check_importable(func)
+
+@pytest.mark.parametrize("layout", ["dirs", "packed"])
+@pytest.mark.parametrize("codec", ["pickle+zstd:3", "dill+none"])
+def test_submit_codec(fake_sge, tmp_path, layout, codec):
+    tasks = [{"task": sge_tasks.square, "args": (idx,), "kwargs": {}} for idx in range(4)]
+    results = pysge.sge_submit(
+        tasks, "test", str(tmp_path), layout=layout, codec=codec, quiet=True,
+        sleep=0.2, request_resubmission_options=False,
+    )
+    assert results == [0, 1, 4, 9]
+
+def test_submit_pickle_lambda(fake_sge, tmp_path):
+    with pytest.raises(ValueError):
+        pysge.sge_submit(
+            [{"task": lambda: 1, "args": (), "kwargs": {}}], "test",
+            str(tmp_path), codec="pickle+gzip", quiet=True,
+        )